@@ -1,6 +1,12 @@
+import discord
 import asyncio
+import psycopg2
+from datetime import datetime, timedelta, timezone
 import secrets
 
+from cogs._duel_reactions import emoji_key
+from cogs._duel_sessions import DuelState
+
 
 async def can_duel(self, ctx, player1, player2):
     #check if new duels are enabled
@@ -15,8 +21,14 @@ async def can_duel(self, ctx, player1, player2):
         print("duel: challenge command used outside of valid channel.")
         return False
     
+    #duels in progress must be loaded before any channel is known to be free
+    if not self.sessions.loaded:
+        await ctx.send("Duels are still starting up, please try again in a moment, %s." % player1.mention)
+        print("duel: Duel sessions not loaded yet.")
+        return False
+
     #one duel per channel
-    if ctx.channel.id in self.duels_in_progress:
+    if ctx.channel.id in self.sessions:
         await ctx.send("There is already a duel in progress or pending challenge here, %s." % player1.mention)
         print("duel: Duel already in progress in channel %s" % ctx.channel)
         return False
@@ -52,31 +64,75 @@ async def can_duel(self, ctx, player1, player2):
         return True
 
 
+#compiles the song table into an integer bitmask per DLC pack, where bit n is
+#set if the pack contains song n, with each song's display title worked out once
+def build_song_index(self):
+    self.song_titles = []
+    self.dlc_masks = {}
+    self.shared_songs_cache = {}
+    song_bits = {}
+
+    for song in self.songs:
+        if song['Eng Title'].lower() == song['JP Title'].lower():
+            title = song['Eng Title']
+        else:
+            title = "%s \\ %s" % (song['Eng Title'], song['JP Title'])
+
+        #songs listed more than once share a single bit
+        if title not in song_bits:
+            song_bits[title] = len(self.song_titles)
+            self.song_titles.append(title)
+        bit = 1 << song_bits[title]
+
+        for dlc, owned in song.items():
+            if owned == '✓':
+                self.dlc_masks[dlc] = self.dlc_masks.get(dlc, 0) | bit
+
+
+#every song in any of the player's packs
+def get_player_mask(self, player_dlc):
+    mask = 0
+
+    if player_dlc:
+        for dlc in player_dlc:
+            mask |= self.dlc_masks.get(dlc, 0)
+
+    return mask
+
+
+#number of songs two players have in common, for use by matchmaking
+def count_shared_songs(self, uid1, uid2):
+    p1_info = self.players.get(uid1)
+    p2_info = self.players.get(uid2)
+    if p1_info == None or p2_info == None:
+        return 0
+
+    shared_mask = get_player_mask(self, p1_info[6]) & get_player_mask(self, p2_info[6])
+    return bin(shared_mask).count('1')
+
+
 async def get_shared_songs(self, player1, player2):
-    async def get_player_songs(player_dlc):
-        songs = []
-
-        if not player_dlc:
-            return songs
-
-        for song in self.songs:
-            for dlc in player_dlc:
-                if song[dlc] == '✓':
-                    if song['Eng Title'].lower() == song['JP Title'].lower():
-                        songs.append(song['Eng Title'])
-                    else:
-                        songs.append("%s \ %s" % (song['Eng Title'], song['JP Title']))
-        
-        return songs
-    
     p1_info = await self.fetch_players(player1.id)
     p2_info = await self.fetch_players(player2.id)
 
-    p1_songs = await get_player_songs(p1_info[6])
-    p2_songs = await get_player_songs(p2_info[6])
+    p1_dlc = frozenset(p1_info[6] or ())
+    p2_dlc = frozenset(p2_info[6] or ())
 
-    shared_set = set(p1_songs).intersection(p2_songs)
-    shared_songs = list(shared_set)
+    #the shared list doesn't depend on which player is which
+    cache_key = frozenset((p1_dlc, p2_dlc))
+    if cache_key not in self.shared_songs_cache:
+        shared_mask = get_player_mask(self, p1_dlc) & get_player_mask(self, p2_dlc)
+
+        #convert each set bit back into its song title
+        shared_songs = []
+        while shared_mask:
+            lowest_bit = shared_mask & -shared_mask
+            shared_songs.append(self.song_titles[lowest_bit.bit_length() - 1])
+            shared_mask ^= lowest_bit
+
+        self.shared_songs_cache[cache_key] = shared_songs
+
+    shared_songs = list(self.shared_songs_cache[cache_key])
 
     print("duel: Generated list of %s shared song(s) between %s and %s." % (len(shared_songs), player1, player2))
     return shared_songs
@@ -90,67 +146,56 @@ async def get_max_points(self, ctx, duel_type):
         5 if duel_type == "bo9" else False
 
 
-async def issue_challenge(self, ctx, player1, player2, duel_type):
+async def issue_challenge(self, channel, player1, player2, max_points):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)
     no = self.bot.get_emoji(self.no_emoji)
 
     #issue challenge message to player
-    challenge_message = await ctx.send("%s! You've been challenged to a best of %s by %s! React below with %s to accept or %s to decline.\n"\
-        % (player2.mention, duel_type[2:], player1.mention, str(yes), str(no))\
+    challenge_message = await channel.send("%s! You've been challenged to a best of %s by %s! React below with %s to accept or %s to decline.\n"\
+        % (player2.mention, max_points * 2 - 1, player1.mention, str(yes), str(no))\
         + "*This challenge will expire in one minute.*")
 
+    #only player2 can accept or decline
+    response = self.reactions.wait(challenge_message.id, (player2.id,), (yes, no), 60.0)
+
     #add reactions for accept/decline
-    await challenge_message.add_reaction(yes)
-    await challenge_message.add_reaction(no)
+    try:
+        await challenge_message.add_reaction(yes)
+        await challenge_message.add_reaction(no)
+
+    except discord.HTTPException:
+        response.cancel()
+        raise
 
-    #return message id to be used in checks
-    return challenge_message.id
+    #return message and pending response to be used in confirm_duel
+    return challenge_message, response
 
 
-async def confirm_duel(self, ctx, player1, player2, challenge_id):
+async def confirm_duel(self, channel, player1, player2, challenge_message, response):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)
     no = self.bot.get_emoji(self.no_emoji)
 
-    #checks for the following:
-    # -- reaction must be by player2
-    # -- reaction must be yes or no
-    # -- reaction must be on the message issued by the bot
-    def check(reaction, user):
-        return user == player2\
-            and (str(reaction.emoji) == str(yes) or (str(reaction.emoji) == str(no)))\
-            and reaction.message.id == challenge_id
-
-    #get message object so that it can be edited and have reacts removed
-    challenge_message = await ctx.channel.fetch_message(challenge_id)
-
     #logic for awaiting/dealing with reactions
     try:
-        reaction = await self.bot.wait_for('reaction_add', timeout=60.0, check=check)
+        user_id, emoji = await response
     
     except asyncio.TimeoutError:
         await challenge_message.edit(content="%s! You've been challenged by %s!\n"\
             % (player2.mention, player1.mention)\
             + "*This challenge has now expired.*")
-    
-        #avoids the current duel channel being softlocked if the challenge expires
-        if ctx.channel.id in self.duels_in_progress:
-            self.duels_in_progress.remove(ctx.channel.id)
 
         #return false since duel was not accepted
         return False
 
     else :
+        accepted = emoji == emoji_key(yes)
         await challenge_message.edit(content="%s! You've been challenged by %s!\n*%s*"\
-            % (player2.mention, player1.mention, "Challenge accepted!" if str(reaction[0]) == str(yes) else "Challenge declined."))
-
-        if str(reaction[0]) == str(no)\
-            and ctx.channel.id in self.duels_in_progress:
-            self.duels_in_progress.remove(ctx.channel.id)
+            % (player2.mention, player1.mention, "Challenge accepted!" if accepted else "Challenge declined."))
 
         #duel can continue if accepted, otherwise end it
-        return True if str(reaction[0]) == str(yes) else False
+        return accepted
     
     finally:
         #remove bot reactions
@@ -158,7 +203,17 @@ async def confirm_duel(self, ctx, player1, player2, challenge_id):
         await challenge_message.remove_reaction(no, self.bot.user)
 
 
-async def begin_round(self, ctx, player1, player2, duel_round, shared_songs_list):
+#waits for each player to react to a prompt, announcing each one as they do;
+#pending holds the wait for every player, from ReactionRouter.wait
+async def wait_for_players(self, channel, pending, announcement):
+    async def player_confirm(player, ready):
+        await ready
+        await channel.send(announcement % player.mention)
+
+    await asyncio.gather(*[player_confirm(player, ready) for player, ready in pending])
+
+
+async def begin_round(self, channel, player1, player2, duel_round, shared_songs_list):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)
     
@@ -166,45 +221,23 @@ async def begin_round(self, ctx, player1, player2, duel_round, shared_songs_list
     rolled_song = secrets.choice(shared_songs_list)
 
     #the player being challenged gets to roll on odd rounds
-    duel_message = await ctx.send("**Round #%s**\n" % duel_round\
+    duel_message = await channel.send("**Round #%s**\n" % duel_round\
         +"Your song for this round is: **%s**!\nBoth players react with %s below when you're ready to play.\n"\
         % (rolled_song, str(yes))\
         + "Countdown will begin upon confirming.\n"\
         + "*You have three minutes to confirm.*")
 
-    #reaction for players to ready up
-    await duel_message.add_reaction(yes)
-
-    #variables for check
-    check_id = duel_message.id
-
-    #checks for the following:
-    # -- player1 or player 2 reacts
-    # -- yes only
-    def check_p1(reaction, user):
-        return user == player1\
-            and (str(reaction.emoji) == str(yes))\
-            and reaction.message.id == check_id
-    # -- same as above
-    def check_p2(reaction, user):
-            return user == player2\
-                and (str(reaction.emoji) == str(yes))\
-                and reaction.message.id == check_id
-
-    #allows bot to send message after each ready up react
-    async def player_confirm(player):
-        await self.bot.wait_for('reaction_add', timeout=180.0,\
-            check=check_p1 if player == player1 else check_p2)
-
-        await ctx.send("%s is ready!" % player.mention)
+    #each player readies up separately, yes only
+    pending = [(player, self.reactions.wait(duel_message.id, (player.id,), (yes,), 180.0))
+        for player in (player1, player2)]
 
     #logic for awaiting/dealing with reactions
     try:
+        #reaction for players to ready up
+        await duel_message.add_reaction(yes)
+
         #wait for both players to react
-        await asyncio.gather(
-            player_confirm(player1),
-            player_confirm(player2)
-        )
+        await self.wait_for_players(channel, pending, "%s is ready!")
         
     except asyncio.TimeoutError:
         #player(s) didn't react on time
@@ -218,13 +251,17 @@ async def begin_round(self, ctx, player1, player2, duel_round, shared_songs_list
         return True
     
     finally:
+        #stop waiting on the other player if one timed out
+        for player, ready in pending:
+            ready.cancel()
+
         #remove bot reacts
         await duel_message.remove_reaction(yes, self.bot.user)
 
 
-async def song_countdown(self, ctx):
+async def song_countdown(self, channel):
     countdown = 5
-    countdown_message = await ctx.send("Song confirmed, get ready to begin!\nStart in")
+    countdown_message = await channel.send("Song confirmed, get ready to begin!\nStart in")
 
     while (countdown > 0):
         await countdown_message.edit(content=(countdown_message.content + " %s..." % countdown))
@@ -234,48 +271,26 @@ async def song_countdown(self, ctx):
     await countdown_message.edit(content=(countdown_message.content + " **Go!**"))
 
 
-async def confirm_scores(self, ctx, player1, player2):
+async def confirm_scores(self, channel, player1, player2):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)
 
     #post message prompting upload of score image from both players
-    finished_message = await ctx.send("Please upload a screenshot or photo of your results screen.\n"\
+    finished_message = await channel.send("Please upload a screenshot or photo of your results screen.\n"\
     + "React below with %s to confirm posting your score.\n" % str(yes)\
     + "*You have five minutes to upload from the time this message appears.*")
 
-    #reaction for players to confimr
-    await finished_message.add_reaction(yes)
-
-    #variables for check
-    check_id = finished_message.id
-
-    #checks for the following:
-    # -- player1 or player 2 reacts
-    # -- yes only
-    def check_p1(reaction, user):
-        return user == player1\
-            and (str(reaction.emoji) == str(yes))\
-            and reaction.message.id == check_id
-    # -- same as above
-    def check_p2(reaction, user):
-            return user == player2\
-                and (str(reaction.emoji) == str(yes))\
-                and reaction.message.id == check_id
-
-    #allows bot to send message after each ready up react
-    async def player_confirm(player):
-        await self.bot.wait_for('reaction_add', timeout=300.0,\
-            check=check_p1 if player == player1 else check_p2)
-
-        await ctx.send("%s has confirmed posting their score!" % player.mention)
+    #each player confirms separately, yes only
+    pending = [(player, self.reactions.wait(finished_message.id, (player.id,), (yes,), 300.0))
+        for player in (player1, player2)]
 
     #logic for awaiting/dealing with reactions
     try:
+        #reaction for players to confirm
+        await finished_message.add_reaction(yes)
+
         #wait for both players to react
-        await asyncio.gather(
-            player_confirm(player1),
-            player_confirm(player2)
-        )
+        await self.wait_for_players(channel, pending, "%s has confirmed posting their score!")
 
     except asyncio.TimeoutError:
         await finished_message.edit(content="*The round timed out.*")
@@ -286,34 +301,31 @@ async def confirm_scores(self, ctx, player1, player2):
         return True
     
     finally:
+        #stop waiting on the other player if one timed out
+        for player, ready in pending:
+            ready.cancel()
+
         #remove bot reactions
         await finished_message.remove_reaction(yes, self.bot.user)
 
 
-async def get_winner(self, ctx, player1, player2):
+async def get_winner(self, channel, player1, player2):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)   
     
-    win_message = await ctx.send("Please react below with %s if you are the **winner** of this round.\n"\
+    win_message = await channel.send("Please react below with %s if you are the **winner** of this round.\n"\
         % str(yes)\
         + "The other player **will** be asked to confirm this.\n"\
         + "*You have one minute to confirm.*")
 
-    #reaction for players to confirm
-    await win_message.add_reaction(yes)
-
-    #checks for the following:
-    # -- only player1 or player2
-    # -- reaction must be yes
-    # -- reaction must be on the message issued by the bot
-    def check(reaction, user):
-        return (user == player1 or user == player2)\
-            and str(reaction.emoji) == str(yes)\
-            and reaction.message.id == win_message.id 
+    #only player1 or player2, yes only
+    claim = self.reactions.wait(win_message.id, (player1.id, player2.id), (yes,), 60.0)
 
     try:
-        reaction = await self.bot.wait_for('reaction_add', timeout=60.0, check=check)
-        round_winner = reaction[1]
+        #reaction for players to confirm
+        await win_message.add_reaction(yes)
+
+        user_id, emoji = await claim
     
     except asyncio.TimeoutError:
         await win_message.edit(content="*The round timed out.*")
@@ -321,37 +333,36 @@ async def get_winner(self, ctx, player1, player2):
 
     else:
         #return number of winning player (p1=1, p2=2)
-        return 1 if round_winner == player1 else 2
+        return 1 if user_id == player1.id else 2
 
     finally:
+        claim.cancel()
+
         #remove bot reactions
         await win_message.remove_reaction(yes, self.bot.user)
 
 
-async def confirm_winner(self, ctx, winner, loser):
+async def confirm_winner(self, channel, winner, loser):
     #emoji for reacts
     yes = self.bot.get_emoji(self.yes_emoji)
     no = self.bot.get_emoji(self.no_emoji)
 
     #prompt other player to confirm the winner
-    confirm_message = await ctx.send("%s, can you confirm that %s is the winner of this round?\n"\
+    confirm_message = await channel.send("%s, can you confirm that %s is the winner of this round?\n"\
         % (loser.mention, winner.mention)\
         + "React with %s for yes or %s for no.\n"\
         % (str(yes), str(no))\
         + "*You have one minute to confirm.*")
 
-    #reactions for player response
-    await confirm_message.add_reaction(no)
-    await confirm_message.add_reaction(yes)
-    
     #only listen for reacts from the confirming player
-    def check(reaction, user):
-        return user == loser\
-            and (str(reaction) == str(yes) or str(reaction) == str(no))\
-            and reaction.message.id == confirm_message.id
+    response = self.reactions.wait(confirm_message.id, (loser.id,), (yes, no), 60.0)
 
     try:
-        reaction = await self.bot.wait_for('reaction_add', timeout=60.0, check=check)
+        #reactions for player response
+        await confirm_message.add_reaction(no)
+        await confirm_message.add_reaction(yes)
+
+        user_id, emoji = await response
 
     except asyncio.TimeoutError:
         #player didn't react on time
@@ -359,41 +370,255 @@ async def confirm_winner(self, ctx, winner, loser):
 
     else:
         #confirming player has reacted
-        return True if str(reaction[0]) == str(yes) else False
+        return emoji == emoji_key(yes)
     
     finally:
+        response.cancel()
+
         #remove bot reactions
         await confirm_message.remove_reaction(no, self.bot.user)
         await confirm_message.remove_reaction(yes, self.bot.user)
 
 
-async def process_duel_results(self, ctx, winner, loser, duel_max_points=2):
-    #fetch player info
-    player1 = await self.fetch_players(winner.id)
-    player2 = await self.fetch_players(loser.id)
-
+#records a finished duel and announces the rank changes, returning False if
+#the result couldn't be recorded yet and should be tried again
+async def process_duel_results(self, channel, winner, loser, duel_max_points=2, session_id=None, retries=2):
     #set weighting/multipler depending on duel length
-    multiplier = \
-        1 if duel_max_points == 2 else\
-        1.5 if duel_max_points == 3 else\
-        2.5 if duel_max_points == 5 else 1
+    multiplier = self.multipliers.get(duel_max_points, 1)
+
+    while True:
+        #fetch player info
+        player1 = await self.fetch_players(winner.id)
+        player2 = await self.fetch_players(loser.id)
+
+        #players can only be missing if the player index couldn't be loaded
+        #or one of them has unregistered since the duel began
+        if player1 == None or player2 == None:
+            if not self.players_loaded:
+                return False
+
+            print("duel: Player %s or %s is no longer registered." % (winner, loser))
+            return True
+
+        #calculate new elo
+        p1_elo = player1[2]
+        p2_elo = player2[2]
+        win_points = await self.calculate_elo(p1_elo, p2_elo, multiplier)
 
-    #calculate new elo
-    p1_elo = player1[2]
-    p2_elo = player2[2]
-    win_points = await self.calculate_elo(p1_elo, p2_elo, multiplier)
+        #commit new elo and record duel details to db, recalculating with
+        #the current ratings if either player's changed in the meantime
+        try:
+            recorded = await self.record_result(winner.id, p1_elo, loser.id, p2_elo, win_points, duel_max_points, session_id)
+
+        except psycopg2.Error:
+            return False
+
+        if recorded == None:
+            return True
+
+        if recorded:
+            break
+
+        if retries == 0:
+            print("duel: Ratings for %s and %s kept changing, result not recorded." % (winner, loser))
+            return True
+        retries -= 1
 
     p1_new_elo = p1_elo + win_points
     p2_new_elo = p2_elo - win_points
 
-    #commit new elo to db
-    await self.update_points(winner.id, p1_new_elo, player_win = True)
-    await self.update_points(loser.id, p2_new_elo, player_win = False)
-
     #announce new elo
-    await ctx.send("**Rank change!**\n"\
+    await channel.send("**Rank change!**\n"\
         + "%s: %s -> %s\n" % (winner.mention, p1_elo, p1_new_elo)\
         + "%s: %s -> %s" % (loser.mention, p2_elo, p2_new_elo))
+    return True
+
+
+#each step of a duel runs the prompts for its state, returning the state to
+#move on to or None if the duel is over; steps only change the session once
+#their prompts are answered, so an interrupted step is simply run again
+async def duel_challenged(self, session, channel, player1, player2):
+    challenge_message, response = await self.issue_challenge(channel, player1, player2, session.max_points)
+
+    if not await self.confirm_duel(channel, player1, player2, challenge_message, response):
+        #duel timed out or declined
+        return None
+
+    print("duel: %s accepted the challenge from %s" % (player2, player1))
+    return DuelState.accepted
+
+
+#duels from the matchmaking queue start here, both players having agreed
+async def duel_accepted(self, session, channel, player1, player2):
+    #get shared songs between both players and end duel if list is empty
+    shared_songs_list = await self.get_shared_songs(player1, player2)
+    if len(shared_songs_list) == 0:
+        await channel.send("It seems neither of you have any songs in common to duel with! Please check your settings in the duel DLC channel.")
+        print("duel: Error, no songs in common between %s and %s." % (player1, player2))
+        return None
+
+    print("duel: Beginning duel between %s and %s" % (player1, player2))
+    await channel.send("**Beginning Duel:** %s vs %s\n"\
+        % (player1.mention, player2.mention)\
+        + "First to %s point(s) wins. Priority is Perfects > Percentage > Score."\
+        % session.max_points)
+
+    return DuelState.rolling
+
+
+async def duel_rolling(self, session, channel, player1, player2):
+    shared_songs_list = await self.get_shared_songs(player1, player2)
+
+    #begin round and get song rolls, cancel if returns false
+    if not await self.begin_round(channel, player1, player2, session.duel_round, shared_songs_list):
+        #roll timer ran out
+        return None
+
+    await self.song_countdown(channel)
+
+    #stored as a time rather than a delay so a resumed duel waits only what's left
+    session.resume_at = datetime.now(timezone.utc) + timedelta(seconds=self.wait_time)
+    return DuelState.playing
+
+
+async def duel_playing(self, session, channel, player1, player2):
+    if session.resume_at != None:
+        delay = (session.resume_at - datetime.now(timezone.utc)).total_seconds()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    session.resume_at = None
+    return DuelState.scores
+
+
+async def duel_scores(self, session, channel, player1, player2):
+    #get players to confirm posting their scores
+    if not await self.confirm_scores(channel, player1, player2):
+        #one or both players didn't confirm posting
+        return None
+
+    return DuelState.winner
+
+
+async def duel_winner(self, session, channel, player1, player2):
+    winner = await self.get_winner(channel, player1, player2)
+
+    if winner == 0:
+        #neither player reacted
+        return None
+
+    session.winner = winner
+    return DuelState.confirming
+
+
+async def duel_confirming(self, session, channel, player1, player2):
+    winner = player1 if session.winner == 1 else player2
+    loser = player2 if session.winner == 1 else player1
+
+    #ask for the winner again if the other player doesn't confirm
+    if not await self.confirm_winner(channel, winner, loser):
+        session.winner = None
+        return DuelState.winner
+
+    #increment winning player's score
+    if session.winner == 1:
+        session.p1_score += 1
+    else:
+        session.p2_score += 1
+
+    #send current scores and increment round counter
+    await channel.send("**Point to %s!**\n"\
+        % winner.mention\
+        + "Current scores: %s %s - %s %s"\
+        % (player1.mention, session.p1_score, session.p2_score, player2.mention))
+
+    session.winner = None
+    session.duel_round += 1
+
+    if session.p1_score == session.max_points or session.p2_score == session.max_points:
+        return DuelState.finished
+    else:
+        return DuelState.rolling
+
+
+async def duel_finished(self, session, channel, player1, player2):
+    p1_won = session.p1_score == session.max_points
+    retrying = False
+
+    #duel finished, announce winner and update scores/rankings
+    await channel.send("**Duel finished:** %s wins!"\
+        % (player1.mention if p1_won else player2.mention))
+
+    #the session stays finished until the result is recorded, so it's
+    #retried here and again if the duel is resumed after an unload
+    while not await self.process_duel_results(
+            channel,
+            player1 if p1_won else player2,
+            player2 if p1_won else player1,
+            session.max_points,
+            session.id
+            ):
+        if not retrying:
+            await channel.send("*The result couldn't be recorded right now, it'll be tried again shortly.*")
+            retrying = True
+        await asyncio.sleep(self.result_retry_time)
+
+    return None
+
+
+DUEL_STEPS = {
+    DuelState.challenged: duel_challenged,
+    DuelState.accepted: duel_accepted,
+    DuelState.rolling: duel_rolling,
+    DuelState.playing: duel_playing,
+    DuelState.scores: duel_scores,
+    DuelState.winner: duel_winner,
+    DuelState.confirming: duel_confirming,
+    DuelState.finished: duel_finished
+}
+
+
+#runs a duel from its current state until it's over, saving the session after
+#every step; if the task is cancelled by the cog unloading the session is kept
+#so the duel can be resumed, otherwise it's ended to free up the channel
+async def run_duel(self, session, resumed=False):
+    channel = self.bot.get_channel(session.channel_id)
+
+    try:
+        if channel == None:
+            print("duel: Channel %s for duel session %s no longer exists." % (session.channel_id, session.id))
+            state = None
+        else:
+            state = session.state
+
+        if state != None:
+            players = []
+            for uid in (session.p1_id, session.p2_id):
+                player = channel.guild.get_member(uid) or self.bot.get_user(uid)
+                players.append(player if player != None else await self.bot.fetch_user(uid))
+            player1, player2 = players
+
+        if state != None and resumed:
+            await channel.send("*The duel between %s and %s was interrupted, picking up where it left off.*"\
+                % (player1.mention, player2.mention))
+            print("duel: Resuming duel between %s and %s at %s." % (player1, player2, state.value))
+
+        while state != None:
+            state = await DUEL_STEPS[state](self, session, channel, player1, player2)
+
+            if state != None:
+                session.state = state
+                await self.sessions.save(session)
+
+    except asyncio.CancelledError:
+        #cog is unloading, keep the session so the duel can be resumed
+        raise
+
+    except Exception as e:
+        print("duel: Error during duel session %s, ending it:\n%s" % (session.id, e))
+
+    finally:
+        if self.duel_tasks.get(session.channel_id) is asyncio.current_task():
+            del(self.duel_tasks[session.channel_id])
 
-    #record duel details to db
-    await self.record_duel(winner.id, p1_new_elo, loser.id, p2_new_elo, win_points)
\ No newline at end of file
+    await self.sessions.end(session)
@@ -1,59 +1,127 @@
 import discord
+import asyncio
 import math
 import psycopg2
+import time
 
 
 async def fetch_settings(self, guild_id):
     SQL = "SELECT * FROM duel_settings WHERE guild_id = %s;"
-    cursor = self.database.cursor()
 
     try:
-        cursor.execute(SQL, (guild_id,))
-        duel_settings = cursor.fetchone()
+        async with self.database.acquire() as connection:
+            duel_settings = await connection.fetchone(SQL, (guild_id,))
 
     except psycopg2.OperationalError as e:
         print("duel: Error fetching duel settings from database:\n%s" % e)
         duel_settings = None
-
-    finally:
-        cursor.close()
     
     return duel_settings
 
 
+#reads every player row into the player index the first time it's needed,
+#after which the index is kept up to date by anything writing to players
+async def load_players(self):
+    async with self.players_lock:
+        if self.players_loaded:
+            return
+
+        SQL = "SELECT * FROM players;"
+
+        try:
+            async with self.database.acquire() as connection:
+                players = await connection.fetchall(SQL)
+
+        except psycopg2.OperationalError as e:
+            print("duel: Error loading players from database:\n%s" % e)
+            return
+
+        self.players = {player[1]: player for player in players}
+        self.players_loaded = True
+        print("duel: Player index loaded for %s player(s)." % len(self.players))
+
+
+#stores a player row returned by the database in the player index,
+#or removes the player from it if row is None
+def cache_player(self, uid, row):
+    old_row = self.players.get(uid)
+
+    if row == None:
+        self.players.pop(uid, None)
+    else:
+        self.players[uid] = row
+
+    #rankings only need re-publishing if a player joined, left or changed ELO
+    if (old_row == None) != (row == None)\
+        or (row != None and old_row[2] != row[2]):
+        self.rankings_dirty = True
+
+
 async def fetch_players(self, uid=None):
-    SQL = "SELECT * FROM players"
-    if uid == None: SQL += " ORDER BY points DESC;"
-    else: SQL += " WHERE member_id = %s;"
+    await self.load_players()
 
-    cursor = self.database.cursor()
+    if uid == None:
+        return sorted(self.players.values(), key=lambda player: player[2], reverse=True)
+    else:
+        return self.players.get(uid)
 
-    try:
-        if uid == None:
-            cursor.execute(SQL)
-            players = cursor.fetchall()
+
+async def is_registered(self, member):
+    await self.load_players()
+    return member.id in self.players
+
+
+#resolves names for a list of user IDs, serving from the gateway's user cache
+#and recently fetched names first, then fetching the rest concurrently
+async def resolve_user_names(self, uids):
+    now = time.monotonic()
+    names = {}
+    missing = []
+
+    for uid in uids:
+        user = self.bot.get_user(uid)
+        cached = self.user_names.get(uid)
+
+        if user != None:
+            names[uid] = str(user)
+        elif cached != None and cached[1] > now:
+            self.user_names.move_to_end(uid)
+            names[uid] = cached[0]
         else:
-            cursor.execute(SQL, (uid,))
-            players = cursor.fetchone()
-        return players
+            missing.append(uid)
 
-    except psycopg2.OperationalError as e:
-        print("duel: Error fetching player(s) from database:\n%s" % e)
+    #the semaphore keeps concurrent requests within the REST rate limits,
+    #with discord.py itself waiting out any 429 responses
+    async def fetch_name(uid):
+        async with self.user_fetch_semaphore:
+            try:
+                return str(await self.bot.fetch_user(uid))
 
-    finally:
-        cursor.close()
+            except discord.NotFound:
+                return "Unknown User"
 
+            except discord.HTTPException as e:
+                print("duel: Error fetching user %s:\n%s" % (uid, e))
+                return None
 
-async def is_registered(self, member):
-    uid = member.id
-    players = await self.fetch_players()
+    results = await asyncio.gather(*[fetch_name(uid) for uid in missing])
 
-    if len(players) == 0:
-        return False
+    for uid, name in zip(missing, results):
+        #fall back to an expired name rather than showing nothing
+        if name == None:
+            cached = self.user_names.get(uid)
+            names[uid] = cached[0] if cached != None else str(uid)
+            continue
 
-    else:
-        registered_uids = [player[1] for player in players]
-        return uid in registered_uids
+        names[uid] = name
+        self.user_names[uid] = (name, now + self.user_names_ttl)
+        self.user_names.move_to_end(uid)
+
+    #drop the least recently used names once over the size limit
+    while len(self.user_names) > self.user_names_size:
+        self.user_names.popitem(last=False)
+
+    return names
 
 
 async def generate_rankings_embed(self, players):
@@ -65,7 +133,8 @@ async def generate_rankings_embed(self, players):
     else:
         #list comprehensions to prepare strings for rankings embed
         ranks = "\n".join([str(i) for i in range(1, len(players)+1)])
-        names = "\n".join([str(await self.bot.fetch_user(player[1])) for player in players])
+        user_names = await self.resolve_user_names([player[1] for player in players])
+        names = "\n".join([user_names[player[1]] for player in players])
         points = "\n".join([str(player[2]) for player in players])
 
         embed.set_author(name="Player Rankings")
@@ -76,51 +145,107 @@ async def generate_rankings_embed(self, players):
     return embed
 
 
-async def calculate_elo(self, elo1, elo2, multiplier=1):
+#points won by a player rated elo1 beating a player rated elo2, shared by
+#duels as they finish and by replays of the duel history
+def elo_change(elo1, elo2, k_value, multiplier=1):
     power = (elo2 - elo1) / 400
     p1_chance = round(1 / (1 + math.pow(10, power)), 2)
-    win_points = int(round((1 - p1_chance) * self.k_value, 0))
+    win_points = int(round((1 - p1_chance) * k_value, 0))
 
     return round(win_points * multiplier)
 
 
-async def update_points(self, uid, points, player_win):
-    SQL = "UPDATE players SET points = %s"\
-        + (", win = win + 1, streak = streak + 1" if player_win else ", loss = loss + 1, streak = 0")\
-        +" WHERE member_id = %s;"
-    cursor = self.database.cursor()
+async def calculate_elo(self, elo1, elo2, multiplier=1):
+    return elo_change(elo1, elo2, self.k_value, multiplier)
+
+
+#applies a duel result in one statement: both players' ratings are locked and
+#checked against the ones the change was calculated from, then their points,
+#wins/losses and streaks are updated, the duel is recorded and its session
+#ended, or nothing at all happens if either rating has since changed. the
+#session is only ended once, so a resumed duel can never count twice
+RESULT_SQL = "WITH "\
+    "locked AS ("\
+    "SELECT member_id FROM players "\
+    "WHERE (member_id = %(win_id)s AND points = %(win_elo)s) "\
+    "OR (member_id = %(lose_id)s AND points = %(lose_elo)s) "\
+    "ORDER BY member_id FOR UPDATE), "\
+    "ended AS ("\
+    "DELETE FROM duel_sessions WHERE id = %(session_id)s "\
+    "AND (SELECT count(*) FROM locked) = 2 RETURNING id), "\
+    "updated AS ("\
+    "UPDATE players SET "\
+    "points = CASE WHEN member_id = %(win_id)s "\
+    "THEN %(win_elo)s + %(change)s ELSE %(lose_elo)s - %(change)s END, "\
+    "win = win + (member_id = %(win_id)s)::int, "\
+    "loss = loss + (member_id = %(lose_id)s)::int, "\
+    "streak = CASE WHEN member_id = %(win_id)s THEN streak + 1 ELSE 0 END "\
+    "WHERE member_id IN (%(win_id)s, %(lose_id)s) "\
+    "AND (SELECT count(*) FROM locked) = 2 "\
+    "AND (%(session_id)s::bigint IS NULL OR EXISTS (SELECT 1 FROM ended)) "\
+    "RETURNING *), "\
+    "recorded AS ("\
+    "INSERT INTO duels "\
+    "(win_id, win_points, lose_id, lose_points, change, max_points) "\
+    "SELECT %(win_id)s, %(win_elo)s + %(change)s, "\
+    "%(lose_id)s, %(lose_elo)s - %(change)s, %(change)s, %(max_points)s "\
+    "WHERE EXISTS (SELECT 1 FROM updated)) "\
+    "SELECT *, true FROM updated "\
+    "UNION ALL SELECT *, false FROM players "\
+    "WHERE member_id IN (%(win_id)s, %(lose_id)s) "\
+    "AND NOT EXISTS (SELECT 1 FROM updated);"
+
+
+#records a duel won by a player rated win_elo against one rated lose_elo,
+#returning True once applied or False if either rating was out of date, in
+#which case the player index is refreshed for the change to be recalculated.
+#returns None if it can't be applied at all, and raises psycopg2.Error if the
+#database couldn't be reached so it can be tried again
+async def record_result(self, win_id, win_elo, lose_id, lose_elo, change, max_points, session_id=None):
+    data = {
+        'win_id': win_id,
+        'win_elo': win_elo,
+        'lose_id': lose_id,
+        'lose_elo': lose_elo,
+        'change': change,
+        'max_points': max_points,
+        'session_id': session_id
+    }
 
     try:
-        cursor.execute(SQL, (points, uid))
-
-    except psycopg2.OperationalError as e:
-        print("duel: Error updating player points:\n%s" % e)
+        async with self.database.acquire() as connection:
+            rows = await connection.fetchall(RESULT_SQL, data, label="Duel.record_result")
 
-    finally:
-        cursor.close()
+    except psycopg2.Error as e:
+        print("duel: Error recording duel result:\n%s" % e)
+        raise
 
+    for row in rows:
+        self.cache_player(row[1], row[:-1])
 
-async def record_duel(self, win_id, win_points, lose_id, lose_points, change):
-    SQL = "INSERT INTO duels"\
-        + " (win_id, win_points, lose_id, lose_points, change)"\
-        + " VALUES (%s, %s, %s, %s, %s);"
-    cursor = self.database.cursor()
+    if len(rows) < 2:
+        print("duel: Player %s or %s is no longer registered." % (win_id, lose_id))
+        return None
 
-    try:
-        cursor.execute(SQL,\
-            (win_id, win_points, lose_id, lose_points, change))
+    if rows[0][-1]:
+        return True
 
-    except psycopg2.Error as e:
-        print("duel: Error recording duel:\n%s" % e)
+    #ratings that still match mean the session had already been ended
+    ratings = {row[1]: row[2] for row in rows}
+    if ratings[win_id] == win_elo and ratings[lose_id] == lose_elo:
+        print("duel: Result of duel session %s was already recorded." % session_id)
+        return None
 
-    finally:
-        cursor.close()
+    return False
 
 
 async def update_dlc(self, user, action:str, dlc:str):
     #get player info & current DLC settings from db
     player = await self.fetch_players(user)
     player_dlc = player[6]
+    #copy so the cached row isn't changed before the database is
+    if type(player_dlc) == list:
+        player_dlc = list(player_dlc)
     member = self.bot.get_user(user)
 
     #fixes NoneType error if the player currently has no DLC set
@@ -140,14 +265,12 @@ async def update_dlc(self, user, action:str, dlc:str):
             player_dlc.remove(dlc)
     
     #insert player's new DLC info into db
-    SQL = "UPDATE players SET dlc = %s WHERE member_id = %s"
-    cursor = self.database.cursor()
+    SQL = "UPDATE players SET dlc = %s WHERE member_id = %s RETURNING *;"
 
     try:
-        cursor.execute(SQL, (player_dlc, user))
+        async with self.database.acquire() as connection:
+            player = await connection.fetchone(SQL, (player_dlc, user))
+        self.cache_player(user, player)
 
     except psycopg2.Error as e:
-        print("duel: Error updating player DLC:\n%s" % e)
-
-    finally:
-        cursor.close()
\ No newline at end of file
+        print("duel: Error updating player DLC:\n%s" % e)
\ No newline at end of file
@@ -0,0 +1,155 @@
+import bisect
+import itertools
+
+
+#a player waiting for an opponent
+class QueueEntry:
+
+    __slots__ = ('uid', 'points', 'max_points', 'joined', 'order')
+
+    def __init__(self, uid, points, max_points, joined, order):
+        self.uid = uid
+        self.points = points
+        self.max_points = max_points
+        self.joined = joined
+        self.order = order
+
+
+#players waiting for a duel, kept sorted by ELO for each duel length so that
+#the closest rated opponents are always next to each other. how far apart two
+#players' ELO can be starts at elo_range and widens by elo_growth for every
+#minute the longer waiting of the two has been queued
+class MatchQueue:
+
+    def __init__(self, elo_range: int = 100, elo_growth: int = 50,
+                 shared_songs=None):
+        self.elo_range = elo_range
+        self.elo_growth = elo_growth
+        self.shared_songs = shared_songs
+        self.entries = {}
+        self.ratings = {}
+        self.counter = itertools.count()
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    #queues a player for a duel of max_points, replacing any earlier entry
+    def join(self, uid: int, points: int, max_points: int, now: float):
+        self.leave(uid)
+
+        entry = QueueEntry(uid, points, max_points, now, next(self.counter))
+        self.entries[uid] = entry
+        bisect.insort(self.ratings.setdefault(max_points, []),
+                      (points, entry.order, uid))
+
+    #takes a player out of the queue, returning whether they were in it
+    def leave(self, uid: int) -> bool:
+        entry = self.entries.pop(uid, None)
+        if entry == None:
+            return False
+
+        ratings = self.ratings[entry.max_points]
+        del(ratings[bisect.bisect_left(ratings,
+                                       (entry.points, entry.order, uid))])
+        return True
+
+    #number of players queued for a duel of max_points
+    def waiting(self, max_points: int) -> int:
+        return len(self.ratings.get(max_points, ()))
+
+    #removes everyone who has waited longer than timeout, returning them
+    def expire(self, now: float, timeout: float) -> list:
+        expired = [uid for uid, entry in self.entries.items()
+                   if now - entry.joined > timeout]
+        for uid in expired:
+            self.leave(uid)
+
+        return expired
+
+    #how far from entry's ELO an opponent can be, given how long they waited
+    def allowed_gap(self, entry, now: float) -> float:
+        return self.elo_range + self.elo_growth * (now - entry.joined) / 60
+
+    #finds the best opponent for an entry: the closest in ELO within range,
+    #with the most songs in common among those equally close. players in
+    #busy and those with no songs in common are passed over, and nobody
+    #further away than max_gap is considered at all
+    def find_opponent(self, entry, now: float, busy,
+                      max_gap: float) -> QueueEntry:
+        ratings = self.ratings[entry.max_points]
+        index = bisect.bisect_left(ratings,
+                                   (entry.points, entry.order, entry.uid))
+        gap = self.allowed_gap(entry, now)
+        left = index - 1
+        right = index + 1
+
+        #walk outwards from the entry one ELO distance at a time
+        while left >= 0 or right < len(ratings):
+            distances = []
+            if left >= 0:
+                distances.append(entry.points - ratings[left][0])
+            if right < len(ratings):
+                distances.append(ratings[right][0] - entry.points)
+            distance = min(distances)
+
+            if distance > max_gap:
+                break
+
+            candidates = []
+            while left >= 0 and entry.points - ratings[left][0] == distance:
+                candidates.append(self.entries[ratings[left][2]])
+                left -= 1
+            while right < len(ratings)\
+                and ratings[right][0] - entry.points == distance:
+                candidates.append(self.entries[ratings[right][2]])
+                right += 1
+
+            best = None
+            best_shared = 0
+            for candidate in candidates:
+                if candidate.uid in busy or distance > max(
+                        gap, self.allowed_gap(candidate, now)):
+                    continue
+
+                shared = self.shared_songs(entry.uid, candidate.uid)\
+                    if self.shared_songs else 1
+                if shared > best_shared:
+                    best = candidate
+                    best_shared = shared
+
+            if best != None:
+                return best
+
+        return None
+
+    #pairs up as many waiting players as possible, longest waiting first, up
+    #to limit pairs, returning (uid, uid, max_points) for each pair and taking
+    #them out of the queue. players in busy are left waiting
+    def match(self, now: float, limit: int, busy=()) -> list:
+        pairs = []
+        if not self.entries:
+            return pairs
+
+        #the widest gap anyone in the queue allows
+        longest_wait = min(entry.joined for entry in self.entries.values())
+        max_gap = self.elo_range + self.elo_growth * (now - longest_wait) / 60
+
+        for entry in sorted(self.entries.values(),
+                            key=lambda entry: entry.order):
+            if len(pairs) >= limit:
+                break
+            if not entry.uid in self.entries or entry.uid in busy:
+                continue
+
+            opponent = self.find_opponent(entry, now, busy, max_gap)
+            if opponent == None:
+                continue
+
+            self.leave(entry.uid)
+            self.leave(opponent.uid)
+            pairs.append((entry.uid, opponent.uid, entry.max_points))
+
+        return pairs
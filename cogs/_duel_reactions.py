@@ -0,0 +1,111 @@
+import asyncio
+import heapq
+import itertools
+
+
+#custom emoji are matched by ID and unicode emoji by the emoji itself, which
+#works the same for Emoji from bot.get_emoji and PartialEmoji from payloads
+def emoji_key(emoji):
+    emoji_id = getattr(emoji, 'id', None)
+    return emoji_id if emoji_id != None else str(emoji)
+
+
+#a prompt waiting for one of the given users to react with one of the emoji
+class ReactionWaiter:
+
+    __slots__ = ('message_id', 'user_ids', 'emojis', 'future')
+
+    def __init__(self, message_id, user_ids, emojis, future):
+        self.message_id = message_id
+        self.user_ids = frozenset(user_ids)
+        self.emojis = frozenset(emoji_key(emoji) for emoji in emojis)
+        self.future = future
+
+
+#hands raw reaction events to whichever prompts are waiting on that message,
+#so each reaction is looked up by message ID rather than checked against every
+#prompt, and works whether or not the message is in the message cache.
+#timeouts are kept in a single heap with one timer set for the earliest
+class ReactionRouter:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.waiters = {}
+        self.timeouts = []
+        self.timer = None
+        self.counter = itertools.count()
+
+    #starts waiting for a reaction, returning a future that resolves to the
+    #(user ID, emoji key) of the first matching reaction or raises
+    #asyncio.TimeoutError; call straight after sending the prompt so no
+    #reaction can be missed while its own reactions are being added
+    def wait(self, message_id, user_ids, emojis, timeout: float) -> asyncio.Future:
+        future = self.loop.create_future()
+        waiter = ReactionWaiter(message_id, user_ids, emojis, future)
+        self.waiters.setdefault(message_id, []).append(waiter)
+        future.add_done_callback(lambda future: self.discard(waiter))
+
+        deadline = self.loop.time() + timeout
+        heapq.heappush(self.timeouts, (deadline, next(self.counter), waiter))
+
+        #only the earliest timeout ever has a timer set
+        if self.timeouts[0][2] is waiter:
+            self.schedule()
+
+        return future
+
+    #forgets a waiter once its future is done, however it finished
+    def discard(self, waiter):
+        waiters = self.waiters.get(waiter.message_id)
+        if waiters == None:
+            return
+
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            del(self.waiters[waiter.message_id])
+
+    #passes a raw reaction payload to the prompt waiting for it, returning
+    #whether any prompt was waiting on the message at all
+    def dispatch(self, payload) -> bool:
+        waiters = self.waiters.get(payload.message_id)
+        if waiters == None:
+            return False
+
+        key = emoji_key(payload.emoji)
+        for waiter in list(waiters):
+            if payload.user_id in waiter.user_ids and key in waiter.emojis\
+                and not waiter.future.done():
+                waiter.future.set_result((payload.user_id, key))
+
+        return True
+
+    def schedule(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.timeouts:
+            self.timer = self.loop.call_at(self.timeouts[0][0], self.expire)
+
+    #times out every waiter past its deadline, skipping any already done
+    def expire(self):
+        self.timer = None
+        now = self.loop.time()
+
+        while self.timeouts and self.timeouts[0][0] <= now:
+            waiter = heapq.heappop(self.timeouts)[2]
+            if not waiter.future.done():
+                waiter.future.set_exception(asyncio.TimeoutError())
+
+        self.schedule()
+
+    #cancels every prompt still waiting, e.g. when the cog is unloaded
+    def close(self):
+        if self.timer != None:
+            self.timer.cancel()
+            self.timer = None
+
+        for deadline, count, waiter in self.timeouts:
+            waiter.future.cancel()
+        self.timeouts = []
@@ -0,0 +1,194 @@
+import psycopg2
+
+from cogs._duel_misc import elo_change
+
+
+#duels record how many points were needed to win so they can be re-rated
+#with the right multiplier, and every unregister/reset_user is noted with the
+#last duel before it so replays know when a player started over
+HISTORY_SQL = "ALTER TABLE duels ADD COLUMN IF NOT EXISTS max_points integer; "\
+    "CREATE TABLE IF NOT EXISTS duel_resets ("\
+    "id bigserial PRIMARY KEY, "\
+    "member_id bigint NOT NULL, "\
+    "after_duel bigint NOT NULL, "\
+    "created_at timestamptz NOT NULL DEFAULT now());"
+
+#fills in max_points for duels recorded before it was stored
+BACKFILL_SQL = "UPDATE duels SET max_points = d.max_points "\
+    "FROM unnest(%(ids)s::bigint[], %(max_points)s::integer[]) "\
+    "AS d(id, max_points) "\
+    "WHERE duels.id = d.id;"
+
+#writes replayed duels and ratings back, but only if no duel has been
+#recorded since the history was read and every player being re-rated still
+#has the rating the replay was compared against. their rows are locked first
+#so no result can be recorded for them in between. returns whether it was
+#written, alongside each updated player
+REPLAY_SQL = "WITH "\
+    "locked AS ("\
+    "SELECT member_id, points FROM players "\
+    "WHERE member_id = ANY(%(uids)s::bigint[]) FOR UPDATE), "\
+    "latest AS ("\
+    "SELECT (SELECT coalesce(max(id), 0) FROM duels) = %(last_id)s "\
+    "AND (SELECT count(*) FROM locked "\
+    "JOIN unnest(%(uids)s::bigint[], %(old_points)s::integer[]) "\
+    "AS e(uid, points) "\
+    "ON locked.member_id = e.uid AND locked.points = e.points) "\
+    "= cardinality(%(uids)s::bigint[]) AS current), "\
+    "duels_updated AS ("\
+    "UPDATE duels SET win_points = d.win_points, "\
+    "lose_points = d.lose_points, change = d.change "\
+    "FROM unnest(%(ids)s::bigint[], %(win_points)s::integer[], "\
+    "%(lose_points)s::integer[], %(changes)s::integer[]) "\
+    "AS d(id, win_points, lose_points, change) "\
+    "WHERE duels.id = d.id AND (SELECT current FROM latest)), "\
+    "players_updated AS ("\
+    "UPDATE players SET points = p.points "\
+    "FROM unnest(%(uids)s::bigint[], %(points)s::integer[]) AS p(uid, points) "\
+    "WHERE players.member_id = p.uid AND (SELECT current FROM latest) "\
+    "RETURNING players.*) "\
+    "SELECT latest.current, players_updated.* FROM latest "\
+    "LEFT JOIN players_updated ON true;"
+
+
+#works out which duel length a duel recorded without one was, by finding the
+#multiplier that gives the change it recorded from the ratings before it
+def infer_max_points(win_points, lose_points, change, k_value, multipliers):
+    win_elo = win_points - change
+    lose_elo = lose_points + change
+    base_change = elo_change(win_elo, lose_elo, k_value)
+
+    #closest match, preferring shorter duels if equally close
+    return min(sorted(multipliers), key=lambda max_points:
+        abs(round(base_change * multipliers[max_points]) - change))
+
+
+#recalculates every rating from the duel history, where duels are
+#(id, win_id, lose_id, max_points) in id order and resets are
+#(member_id, after_duel) in after_duel order. returns the replayed duels as
+#(id, win_points, lose_points, change) and each player's final rating
+def replay(duels, resets, k_value, multipliers, starting_elo=1200):
+    ratings = {}
+    replayed = []
+    reset_index = 0
+
+    for duel_id, win_id, lose_id, max_points in duels:
+        #players who were reset before this duel start over
+        while reset_index < len(resets)\
+            and resets[reset_index][1] < duel_id:
+            ratings.pop(resets[reset_index][0], None)
+            reset_index += 1
+
+        win_elo = ratings.get(win_id, starting_elo)
+        lose_elo = ratings.get(lose_id, starting_elo)
+        change = elo_change(win_elo, lose_elo, k_value,
+            multipliers.get(max_points, 1))
+
+        ratings[win_id] = win_elo + change
+        ratings[lose_id] = lose_elo - change
+        replayed.append((duel_id, win_elo + change, lose_elo - change, change))
+
+    #resets after the last duel
+    for member_id, after_duel in resets[reset_index:]:
+        ratings.pop(member_id, None)
+
+    return replayed, ratings
+
+
+#adds the columns and tables replays need, then works out the duel length of
+#any duels recorded before it was stored, using the current k value and
+#multipliers; this only happens once so they can be changed afterwards
+async def prepare_history(self):
+    SQL = "SELECT id, win_points, lose_points, change FROM duels "\
+        "WHERE max_points IS NULL ORDER BY id;"
+
+    try:
+        async with self.database.acquire() as connection:
+            await connection.transaction(HISTORY_SQL,
+                                         label="Duel.prepare_history")
+            duels = await connection.fetchall(SQL,
+                                              label="Duel.fetch_unrated")
+
+            if duels:
+                data = {
+                    'ids': [duel[0] for duel in duels],
+                    'max_points': [infer_max_points(*duel[1:], self.k_value,
+                        self.multipliers) for duel in duels]
+                }
+                await connection.execute(BACKFILL_SQL, data,
+                                         label="Duel.backfill_max_points")
+                print("duel: Duel length worked out for %s earlier duel(s)."
+                      % len(duels))
+
+    except psycopg2.Error as e:
+        print("duel: Error preparing duel history:\n%s" % e)
+
+
+#replays the whole duel history with the current k value and multipliers,
+#returning (duels played, changed duels, changed ratings as
+#{member_id: (old, new)}) and writing the changes back if apply is set.
+#returns None if it couldn't be read or written, or if a duel finished or a
+#rating changed meanwhile, in which case nothing is written
+async def replay_history(self, apply=False):
+    DUELS_SQL = "SELECT id, win_id, lose_id, max_points, win_points, "\
+        "lose_points, change FROM duels ORDER BY id;"
+    RESETS_SQL = "SELECT member_id, after_duel FROM duel_resets "\
+        "ORDER BY after_duel, id;"
+
+    try:
+        async with self.database.acquire() as connection:
+            duels = await connection.fetchall(DUELS_SQL,
+                                              label="Duel.fetch_history")
+            resets = await connection.fetchall(RESETS_SQL,
+                                               label="Duel.fetch_resets")
+
+    except psycopg2.Error as e:
+        print("duel: Error reading duel history:\n%s" % e)
+        return None
+
+    replayed, ratings = replay([duel[:4] for duel in duels], resets,
+        self.k_value, self.multipliers, self.starting_elo)
+
+    #only what has changed needs writing
+    changed_duels = [new for new, old in zip(replayed, duels)
+                     if new[1:] != old[4:]]
+
+    await self.load_players()
+    changed_ratings = {uid: (self.players[uid][2], points)
+                       for uid, points in ratings.items()
+                       if uid in self.players
+                       and self.players[uid][2] != points}
+
+    if not apply or (not changed_duels and not changed_ratings):
+        return len(duels), changed_duels, changed_ratings
+
+    data = {
+        'last_id': duels[-1][0] if duels else 0,
+        'ids': [duel[0] for duel in changed_duels],
+        'win_points': [duel[1] for duel in changed_duels],
+        'lose_points': [duel[2] for duel in changed_duels],
+        'changes': [duel[3] for duel in changed_duels],
+        'uids': list(changed_ratings),
+        'old_points': [old for old, new in changed_ratings.values()],
+        'points': [new for old, new in changed_ratings.values()]
+    }
+
+    try:
+        async with self.database.acquire() as connection:
+            rows = await connection.fetchall(REPLAY_SQL, data,
+                                             label="Duel.write_replay")
+
+    except psycopg2.Error as e:
+        print("duel: Error writing replayed ratings:\n%s" % e)
+        return None
+
+    if not rows or not rows[0][0]:
+        print("duel: Ratings changed during the replay, nothing written.")
+        return None
+
+    #rows are (written, *player), with no player if none were updated
+    for row in rows:
+        if row[1] != None:
+            self.cache_player(row[2], row[1:])
+
+    return len(duels), changed_duels, changed_ratings
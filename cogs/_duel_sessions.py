@@ -0,0 +1,178 @@
+from enum import Enum
+import psycopg2
+
+
+#one row per duel in progress, the unique channel_id doubling as the lock
+#that keeps each duel channel to a single duel at a time
+SESSIONS_SQL = "CREATE TABLE IF NOT EXISTS duel_sessions ("\
+    "id bigserial PRIMARY KEY, "\
+    "channel_id bigint NOT NULL UNIQUE, "\
+    "p1_id bigint NOT NULL, "\
+    "p2_id bigint NOT NULL, "\
+    "max_points integer NOT NULL, "\
+    "state text NOT NULL, "\
+    "p1_score integer NOT NULL DEFAULT 0, "\
+    "p2_score integer NOT NULL DEFAULT 0, "\
+    "duel_round integer NOT NULL DEFAULT 1, "\
+    "winner smallint, "\
+    "resume_at timestamptz, "\
+    "updated_at timestamptz NOT NULL DEFAULT now());"
+
+#columns in the order DuelSession takes them
+SESSION_COLUMNS = "id, channel_id, p1_id, p2_id, max_points, state, "\
+    "p1_score, p2_score, duel_round, winner, resume_at"
+
+
+#each state is the step a duel will run next
+class DuelState(Enum):
+    challenged = 'challenged' #waiting for player 2 to accept
+    accepted = 'accepted' #both players agreed, about to begin
+    rolling = 'rolling' #song rolled, waiting for both players to ready up
+    playing = 'playing' #song being played until resume_at
+    scores = 'scores' #waiting for both players to post their scores
+    winner = 'winner' #waiting for the round winner to claim it
+    confirming = 'confirming' #waiting for the other player to confirm
+    finished = 'finished' #recording the results
+
+
+#everything needed to carry on a duel from its current state
+class DuelSession:
+
+    __slots__ = ('id', 'channel_id', 'p1_id', 'p2_id', 'max_points', 'state',
+                 'p1_score', 'p2_score', 'duel_round', 'winner', 'resume_at')
+
+    def __init__(self, id, channel_id, p1_id, p2_id, max_points, state,
+                 p1_score=0, p2_score=0, duel_round=1, winner=None,
+                 resume_at=None):
+        self.id = id
+        self.channel_id = channel_id
+        self.p1_id = p1_id
+        self.p2_id = p2_id
+        self.max_points = max_points
+        self.state = DuelState(state)
+        self.p1_score = p1_score
+        self.p2_score = p2_score
+        self.duel_round = duel_round
+        self.winner = winner
+        self.resume_at = resume_at
+
+
+#duels in progress by channel, kept in the database after every step so
+#they outlive cog reloads and restarts. which duel channels are free and which
+#players are dueling are kept alongside so both can be checked in O(1)
+class DuelSessions:
+
+    def __init__(self, bot, log):
+        self.bot = bot
+        self.log = log
+        self.sessions = {}
+        self.loaded = False
+
+        self.channels = set()
+        self.free_channels = set()
+        self.players = {}
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.sessions
+
+    #sets which channels duels can be held in
+    def set_channels(self, channel_ids):
+        self.channels = set(channel_ids)
+        self.free_channels = self.channels - self.sessions.keys()
+
+    #any duel channel without a duel in it, or None if they're all in use
+    def free_channel(self) -> int:
+        return next(iter(self.free_channels), None)
+
+    #marks a session's channel and players as in a duel
+    def add(self, session: DuelSession):
+        self.sessions[session.channel_id] = session
+        self.free_channels.discard(session.channel_id)
+        self.players[session.p1_id] = session
+        self.players[session.p2_id] = session
+
+    #frees a session's channel and players
+    def remove(self, session: DuelSession):
+        if self.sessions.get(session.channel_id) is not session:
+            return
+
+        del(self.sessions[session.channel_id])
+        if session.channel_id in self.channels:
+            self.free_channels.add(session.channel_id)
+        for uid in (session.p1_id, session.p2_id):
+            if self.players.get(uid) is session:
+                del(self.players[uid])
+
+    #creates the sessions table if needed and reads every duel in progress,
+    #returning them to be resumed
+    async def load(self) -> list:
+        SQL = "SELECT %s FROM duel_sessions ORDER BY id;" % SESSION_COLUMNS
+
+        try:
+            async with self.bot.database.acquire() as connection:
+                await connection.execute(SESSIONS_SQL,
+                                         label="DuelSessions.prepare")
+                rows = await connection.fetchall(SQL,
+                                                 label="DuelSessions.load")
+
+        except psycopg2.Error as e:
+            self.log("Error loading duel sessions:\n%s" % e)
+            return []
+
+        for row in rows:
+            self.add(DuelSession(*row))
+        self.loaded = True
+        return list(self.sessions.values())
+
+    #starts a duel in a channel, returning None if the channel already has one
+    async def start(self, channel_id: int, p1_id: int, p2_id: int,
+                    max_points: int,
+                    state: DuelState = DuelState.challenged) -> DuelSession:
+        SQL = "INSERT INTO duel_sessions "\
+            "(channel_id, p1_id, p2_id, max_points, state) "\
+            "VALUES (%%s, %%s, %%s, %%s, %%s) "\
+            "ON CONFLICT (channel_id) DO NOTHING RETURNING %s;"\
+            % SESSION_COLUMNS
+
+        async with self.bot.database.acquire() as connection:
+            row = await connection.fetchone(SQL, (channel_id, p1_id, p2_id,
+                max_points, state.value),
+                label="DuelSessions.start")
+
+        if row == None:
+            return None
+
+        session = DuelSession(*row)
+        self.add(session)
+        return session
+
+    #stores a session after a step, which is only ever resumed in memory
+    #if this fails
+    async def save(self, session: DuelSession):
+        SQL = "UPDATE duel_sessions SET state = %s, p1_score = %s, "\
+            "p2_score = %s, duel_round = %s, winner = %s, resume_at = %s, "\
+            "updated_at = now() WHERE id = %s;"
+
+        try:
+            async with self.bot.database.acquire() as connection:
+                await connection.execute(SQL, (session.state.value,
+                    session.p1_score, session.p2_score, session.duel_round,
+                    session.winner, session.resume_at, session.id),
+                    label="DuelSessions.save")
+
+        except psycopg2.Error as e:
+            self.log("Error saving duel session %s:\n%s" % (session.id, e))
+
+    #ends a duel, freeing its channel
+    async def end(self, session: DuelSession):
+        SQL = "DELETE FROM duel_sessions WHERE id = %s;"
+
+        self.remove(session)
+
+        try:
+            async with self.bot.database.acquire() as connection:
+                await connection.execute(SQL, (session.id,),
+                                         label="DuelSessions.end")
+
+        except psycopg2.Error as e:
+            self.log("Error ending duel session %s:\n%s" % (session.id, e))
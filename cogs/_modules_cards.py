@@ -0,0 +1,120 @@
+import asyncio
+from collections import OrderedDict
+from io import BytesIO
+import os
+from PIL import Image
+
+
+# Pastes a module image over its set's card back
+def composite_card(module_image: str, card_back: str) -> Image.Image:
+    top_image = Image.open(module_image)
+    bg_image = Image.open(card_back)
+    bg_image.paste(top_image, (0, 0), top_image)
+    return bg_image
+
+
+# Composites a card and returns it as PNG bytes
+def render_card(module_image: str, card_back: str) -> bytes:
+    modified_image = BytesIO()
+    composite_card(module_image, card_back).save(modified_image, format='png')
+    return modified_image.getvalue()
+
+
+# Reads a card from the disk cache, or renders it and writes it there first;
+# run in an executor, so it must only use its arguments
+def load_card(module_image: str, card_back: str, cache_dir: str,
+              key: str) -> bytes:
+    path = os.path.join(cache_dir, key)
+
+    try:
+        with open(path, 'rb') as card_file:
+            return card_file.read()
+
+    except OSError:
+        pass
+
+    card = render_card(module_image, card_back)
+
+    # Remove renders made from older versions of the source images
+    prefix = key[:key.index('-', 4) + 1]
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(prefix) and file_name != key:
+            try:
+                os.remove(os.path.join(cache_dir, file_name))
+            except OSError:
+                pass
+
+    # Write to a temporary file first so a partial card is never read
+    with open(path + '.tmp', 'wb') as card_file:
+        card_file.write(card)
+    os.replace(path + '.tmp', path)
+
+    return card
+
+
+# Keeps finished card images so that each card is only rendered once; an LRU
+# in memory limited to max_bytes, backed by a directory of rendered PNGs
+# named after the modification times of the images they were made from.
+# Cards missing from both are rendered in the given executor
+class CardCache:
+
+    def __init__(self, data_dir: str, cache_dir: str, max_bytes: int,
+                 executor):
+        self.data_dir = data_dir
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.executor = executor
+        self.size = 0
+        self.cards = OrderedDict()
+        self.rendering = {}
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # File paths to a module's image and the background for its set
+    def source_paths(self, module_set: str, number: int) -> tuple:
+        return (os.path.join(self.data_dir, module_set, '%s.png' % number),
+                os.path.join(self.data_dir, 'back-%s.png' % module_set))
+
+    # Name a card is cached under, which changes if either source image does;
+    # raises FileNotFoundError if either image is missing
+    def cache_key(self, module_set: str, number: int) -> str:
+        module_image, card_back = self.source_paths(module_set, number)
+        return '%s-%s-%s-%s.png' % (module_set, number,
+                                     os.stat(module_image).st_mtime_ns,
+                                     os.stat(card_back).st_mtime_ns)
+
+    # Returns the finished card, loading or rendering it in the executor if
+    # it isn't in memory; requests for a card that is already being loaded
+    # wait for that load instead of starting another
+    async def load(self, module_set: str, number: int) -> bytes:
+        key = self.cache_key(module_set, number)
+
+        if key in self.cards:
+            self.cards.move_to_end(key)
+            return self.cards[key]
+
+        if not key in self.rendering:
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(
+                self.executor, load_card,
+                *self.source_paths(module_set, number), self.cache_dir, key)
+            future.add_done_callback(
+                lambda future: self.rendering.pop(key, None))
+            self.rendering[key] = future
+
+        # Shielded so one cancelled request doesn't cancel the others
+        card = await asyncio.shield(self.rendering[key])
+        self.remember(key, card)
+        return card
+
+    # Keeps a card in memory, evicting the least recently used cards
+    # until the total size is back within the budget
+    def remember(self, key: str, card: bytes):
+        if key in self.cards:
+            self.size -= len(self.cards.pop(key))
+
+        self.cards[key] = card
+        self.size += len(card)
+
+        while self.size > self.max_bytes and len(self.cards) > 1:
+            self.size -= len(self.cards.popitem(last=False)[1])
@@ -0,0 +1,52 @@
+# Everything known about a single module; module_id is e.g. 'mik-123'
+# for number 123 of set 'mik', and index is its position in the catalog
+class Module:
+
+    __slots__ = ('index', 'id', 'set', 'number', 'eng_name', 'jp_name')
+
+    def __init__(self, index: int, module_set: str, number: int,
+                 eng_name: str, jp_name: str):
+        self.index = index
+        self.id = '%s-%s' % (module_set, number)
+        self.set = module_set
+        self.number = number
+        self.eng_name = eng_name
+        self.jp_name = jp_name
+
+    def __repr__(self) -> str:
+        return '<Module %s>' % self.id
+
+
+# Every module read from the CSV files, built once at load and never changed.
+# Modules are numbered densely across all sets in the order given, and can be
+# looked up by module_id in O(1)
+class ModuleCatalog:
+
+    def __init__(self, module_sets: dict):
+        modules = []
+        sets = {}
+
+        # module_sets maps each set to its CSV rows, in module number order
+        for module_set, rows in module_sets.items():
+            sets[module_set] = tuple(
+                Module(len(modules) + number, module_set, number + 1,
+                       row['ENG Name'], row['JP Name'])
+                for number, row in enumerate(rows))
+            modules.extend(sets[module_set])
+
+        self.modules = tuple(modules)
+        self.sets = sets
+        self.ids = {module.id: module for module in self.modules}
+
+    def __contains__(self, module_id: str) -> bool:
+        return module_id in self.ids
+
+    def __getitem__(self, module_id: str) -> Module:
+        return self.ids[module_id]
+
+    def __len__(self) -> int:
+        return len(self.modules)
+
+    # Returns the module for module_id, or None if there isn't one
+    def get(self, module_id: str) -> Module:
+        return self.ids.get(module_id)
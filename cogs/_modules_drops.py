@@ -0,0 +1,89 @@
+from collections import deque
+import time
+
+
+# A module dropped in a guild, waiting to be redeemed
+class Drop:
+
+    __slots__ = ('guild_id', 'module_id', 'dropped_at', 'expires')
+
+    def __init__(self, guild_id: int, module_id: str, ttl: float = None):
+        self.guild_id = guild_id
+        self.module_id = module_id
+        self.dropped_at = time.monotonic()
+        self.expires = None if ttl == None else self.dropped_at + ttl
+
+    # Whether the drop can no longer be redeemed
+    def expired(self, now: float) -> bool:
+        return self.expires != None and now >= self.expires
+
+
+# Keeps track of the drops active in each guild. Drops are claimed without
+# awaiting anything, so the first claim to arrive always wins and any later
+# ones see the drop is gone, however many are waiting on the event loop.
+# Every claim attempt on a drop is kept in a bounded audit log
+class DropManager:
+
+    def __init__(self, ttl: float = None, max_drops: int = 1,
+                 audit_size: int = 200):
+        self.ttl = ttl
+        self.max_drops = max_drops
+        self.drops = {}
+        self.audit = deque(maxlen=audit_size)
+
+        # Drops claimed recently, so later claimants can be told
+        # they were too late rather than ignored
+        self.claimed = {}
+
+    # Drops still active in a guild, oldest first, forgetting expired ones
+    def active(self, guild_id: int) -> list:
+        now = time.monotonic()
+        drops = [drop for drop in self.drops.get(guild_id, [])
+                 if not drop.expired(now)]
+        self.drops[guild_id] = drops
+        return drops
+
+    # Adds a new drop to a guild, replacing the oldest
+    # if the guild already has as many as allowed
+    def add(self, guild_id: int, module_id: str) -> Drop:
+        drops = self.active(guild_id)
+        while len(drops) >= self.max_drops:
+            drops.pop(0)
+
+        drop = Drop(guild_id, module_id, self.ttl)
+        drops.append(drop)
+        return drop
+
+    # Claims the active drop of module_id in a guild for a player,
+    # returning it if they were first, or None if there isn't one
+    def claim(self, guild_id: int, module_id: str, uid: int) -> Drop:
+        for drop in self.active(guild_id):
+            if drop.module_id == module_id:
+                self.drops[guild_id].remove(drop)
+                self.claimed[guild_id] = (module_id, uid)
+                self.audit.append((time.time(), guild_id, module_id, uid,
+                                   True))
+                return drop
+
+        # Only record failed claims on a drop that was just claimed
+        if self.claimed.get(guild_id, (None,))[0] == module_id:
+            self.audit.append((time.time(), guild_id, module_id, uid, False))
+
+        return None
+
+    # Discord user ID of whoever last claimed module_id in a guild, if anyone
+    def claimed_by(self, guild_id: int, module_id: str) -> int:
+        last_claim = self.claimed.get(guild_id)
+        if last_claim and last_claim[0] == module_id:
+            return last_claim[1]
+
+        return None
+
+    # Puts a claimed drop back, e.g. if it couldn't be saved to the player
+    def restore(self, drop: Drop):
+        if drop.expired(time.monotonic()):
+            return
+
+        self.drops.setdefault(drop.guild_id, []).insert(0, drop)
+        if self.claimed.get(drop.guild_id, (None,))[0] == drop.module_id:
+            del(self.claimed[drop.guild_id])
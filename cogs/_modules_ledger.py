@@ -0,0 +1,302 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from enum import Enum
+import psycopg2
+
+
+# Every VP change is kept in vp_ledger with the reason it was made
+LEDGER_SQL = "CREATE TABLE IF NOT EXISTS vp_ledger ("\
+    "id bigserial PRIMARY KEY, "\
+    "member_id bigint NOT NULL, "\
+    "delta integer NOT NULL, "\
+    "reason text NOT NULL, "\
+    "created_at timestamptz NOT NULL DEFAULT now()); "\
+    "CREATE INDEX IF NOT EXISTS vp_ledger_member_id "\
+    "ON vp_ledger (member_id);"
+
+# Logs a batch of changes and adds their total per player to modules.points,
+# registering players who don't have a row yet. Existing rows are updated
+# separately from new ones so that the points CHECK constraint is only ever
+# tested against real balances, never a negative delta on its own. Balances
+# are kept at or above floor, which is NULL (no floor) unless clamping
+FLUSH_SQL = "WITH "\
+    "entries AS ("\
+    "INSERT INTO vp_ledger (member_id, delta, reason, created_at) "\
+    "SELECT * FROM unnest(%(entry_uids)s::bigint[], "\
+    "%(entry_deltas)s::integer[], %(entry_reasons)s::text[], "\
+    "%(entry_times)s::timestamptz[])), "\
+    "points_delta(uid, delta) AS ("\
+    "SELECT * FROM unnest(%(uids)s::bigint[], %(deltas)s::integer[])), "\
+    "points_updated AS ("\
+    "UPDATE modules SET points = "\
+    "GREATEST(modules.points + points_delta.delta, %(floor)s) "\
+    "FROM points_delta WHERE modules.member_id = points_delta.uid) "\
+    "INSERT INTO modules (member_id, points) "\
+    "SELECT uid, GREATEST(delta, %(floor)s) FROM points_delta "\
+    "WHERE NOT EXISTS ("\
+    "SELECT 1 FROM modules WHERE member_id = points_delta.uid) "\
+    "ON CONFLICT (member_id) "\
+    "DO UPDATE SET points = "\
+    "GREATEST(modules.points + EXCLUDED.points, %(floor)s);"
+
+
+class VPReason(Enum):
+    drop = 'drop'
+    daily = 'daily'
+    purchase = 'purchase'
+    gift = 'gift'
+    trade = 'trade'
+    admin = 'admin'
+
+
+# Write-behind ledger of player VP. Changes are applied to cached balances
+# straight away and kept as pending deltas, which are written to the database
+# in batches by flush(). Cached balances always equal what's stored plus
+# what's pending, so checks against them are exact as long as every VP
+# change goes through the ledger or happens while hold() is in effect
+class VPLedger:
+
+    def __init__(self, bot, log, flush_size: int = 100):
+        self.bot = bot
+        self.log = log
+        self.flush_size = flush_size
+
+        # Ledger of the previously loaded cog, still writing its changes
+        self.previous = getattr(bot, 'closed_vp_ledger', None)
+        self.closing = None
+
+        self.balances = {}
+        self.pending = {}
+        self.entries = []
+
+        # Per player locks serialise debits, and flush_lock keeps balances
+        # from being read from the database while a flush is underway
+        self.locks = {}
+        self.flush_lock = asyncio.Lock()
+
+    # Creates the ledger table if needed
+    async def prepare(self):
+        try:
+            async with self.bot.database.acquire() as connection:
+                await connection.execute(LEDGER_SQL, label="VPLedger.prepare")
+
+        except psycopg2.Error as e:
+            self.log("Error creating VP ledger table:\n%s" % e)
+
+    # Locks for the given players, always in the same order
+    def player_locks(self, uids) -> list:
+        return [self.locks.setdefault(uid, asyncio.Lock())
+                for uid in sorted(uids)]
+
+    # Writes everything pending when the cog is unloaded. The ledger is left
+    # on the bot so that the next one can wait for this before reading any
+    # balances, and take over whatever couldn't be written
+    def close(self):
+        self.closing = self.bot.loop.create_task(self.flush())
+        self.bot.closed_vp_ledger = self
+
+    # Waits for the previous ledger to finish closing, then queues any
+    # changes it couldn't write to be written by this one
+    async def take_over(self):
+        previous = self.previous
+        if previous == None:
+            return
+
+        await asyncio.shield(previous.closing)
+
+        # Only the first caller to get here takes the changes over
+        if not self.previous is previous:
+            return
+        self.previous = None
+
+        self.entries[:0] = previous.entries
+        for uid, delta in previous.pending.items():
+            self.pending[uid] = self.pending.get(uid, 0) + delta
+            if uid in self.balances:
+                self.balances[uid] += delta
+        previous.entries = []
+        previous.pending = {}
+
+    # Reads a player's stored balance into the cache if it isn't there
+    async def load(self, uid: int):
+        await self.take_over()
+        if uid in self.balances:
+            return
+
+        SQL = "SELECT points FROM modules WHERE member_id = %s;"
+
+        async with self.flush_lock:
+            async with self.bot.database.acquire() as connection:
+                row = await connection.fetchone(SQL, (uid,),
+                                                label="VPLedger.load")
+
+        # Changes made while waiting are pending, so still need adding
+        if not uid in self.balances:
+            self.balances[uid] = (row[0] if row else 0)\
+                                 + self.pending.get(uid, 0)
+
+    # Returns a player's current balance, including unwritten changes
+    async def balance(self, uid: int) -> int:
+        await self.load(uid)
+        return self.balances[uid]
+
+    # Applies a change to the cache and queues it to be written,
+    # flushing early once enough changes have built up
+    def record(self, uid: int, delta: int, reason: VPReason):
+        self.pending[uid] = self.pending.get(uid, 0) + delta
+        if uid in self.balances:
+            self.balances[uid] += delta
+
+        self.entries.append((uid, delta, reason.value,
+                             datetime.now(timezone.utc)))
+
+        if (len(self.entries) >= self.flush_size
+                and not self.flush_lock.locked()):
+            asyncio.get_event_loop().create_task(self.flush())
+
+    # Adds VP to a player
+    def credit(self, uid: int, amount: int, reason: VPReason):
+        self.record(uid, amount, reason)
+
+    # Takes VP from a player, returning False without changing
+    # anything if they don't have enough
+    async def debit(self, uid: int, amount: int, reason: VPReason) -> bool:
+        async with self.locks.setdefault(uid, asyncio.Lock()):
+            await self.load(uid)
+            if self.balances[uid] < amount:
+                return False
+
+            self.record(uid, -amount, reason)
+            return True
+
+    # Moves VP between players if the giver has enough
+    async def transfer(self, giver: int, receiver: int, amount: int,
+                       reason: VPReason) -> bool:
+        if not await self.debit(giver, amount, reason):
+            return False
+
+        self.credit(receiver, amount, reason)
+        return True
+
+    # Writes pending changes, for only the given players if any,
+    # returning whether they were written
+    async def flush(self, uids=None) -> bool:
+        async with self.flush_lock:
+            return await self.write(uids)
+
+    # Body of flush(), which must be called with flush_lock held
+    async def write(self, uids=None) -> bool:
+        await self.take_over()
+
+        if uids is None:
+            entries, self.entries = self.entries, []
+            deltas, self.pending = self.pending, {}
+        else:
+            entries = [entry for entry in self.entries if entry[0] in uids]
+            self.entries = [entry for entry in self.entries
+                            if not entry[0] in uids]
+            deltas = {uid: self.pending.pop(uid) for uid in uids
+                      if uid in self.pending}
+
+        if not entries:
+            return True
+
+        try:
+            await self.write_changes(entries, deltas)
+
+        # One player's change breaking the points CHECK fails the whole
+        # batch, so write each player separately rather than have every
+        # later flush fail the same way
+        except psycopg2.IntegrityError:
+            return await self.write_each(entries, deltas)
+
+        # Put the changes back to be written by a later flush
+        except psycopg2.Error as e:
+            self.log("Error writing %s VP change(s):\n%s" % (len(entries), e))
+            self.restore(entries, deltas)
+            return False
+
+        return True
+
+    # Writes each player's changes on their own, clamping at 0 the balance
+    # of any player whose changes would take it below
+    async def write_each(self, entries: list, deltas: dict) -> bool:
+        written = True
+
+        for uid in sorted({entry[0] for entry in entries}):
+            player_entries = [entry for entry in entries if entry[0] == uid]
+            player_deltas = {uid: deltas[uid]} if uid in deltas else {}
+
+            try:
+                try:
+                    await self.write_changes(player_entries, player_deltas)
+
+                except psycopg2.IntegrityError:
+                    self.log("VP change(s) of %s for %s would leave a "
+                             "negative balance, clamping it at 0"
+                             % (player_deltas.get(uid, 0), uid))
+                    await self.write_changes(player_entries, player_deltas,
+                                             floor=0)
+
+                    # Read the balance as clamped next time it's needed
+                    self.balances.pop(uid, None)
+
+            except psycopg2.Error as e:
+                self.log("Error writing VP change(s) for %s:\n%s" % (uid, e))
+                self.restore(player_entries, player_deltas)
+                written = False
+
+        return written
+
+    # Logs entries and applies deltas in one statement
+    async def write_changes(self, entries: list, deltas: dict,
+                            floor: int = None):
+        deltas = sorted((uid, delta) for uid, delta in deltas.items() if delta)
+        data = {
+            'entry_uids': [entry[0] for entry in entries],
+            'entry_deltas': [entry[1] for entry in entries],
+            'entry_reasons': [entry[2] for entry in entries],
+            'entry_times': [entry[3] for entry in entries],
+            'uids': [uid for uid, delta in deltas],
+            'deltas': [delta for uid, delta in deltas],
+            'floor': floor
+        }
+
+        async with self.bot.database.acquire() as connection:
+            await connection.execute(FLUSH_SQL, data, label="VPLedger.flush")
+
+    # Puts changes that couldn't be written back to be written later
+    def restore(self, entries: list, deltas: dict):
+        self.entries[:0] = entries
+        for uid, delta in deltas.items():
+            self.pending[uid] = self.pending.get(uid, 0) + delta
+
+    # Holds the given players' balances while their VP is changed in the
+    # database directly, e.g. by a trade. Their pending changes are written
+    # first so the database can check balances itself; call refresh() with
+    # each new balance before leaving the block
+    @asynccontextmanager
+    async def hold(self, uids):
+        if not uids:
+            yield
+            return
+
+        locks = self.player_locks(uids)
+        for lock in locks:
+            await lock.acquire()
+
+        try:
+            async with self.flush_lock:
+                if not await self.write(uids):
+                    raise psycopg2.OperationalError(
+                        "Pending VP changes could not be written")
+                yield
+
+        finally:
+            for lock in locks:
+                lock.release()
+
+    # Updates a held player's cached balance from the database
+    def refresh(self, uid: int, points: int):
+        self.balances[uid] = points + self.pending.get(uid, 0)
@@ -0,0 +1,156 @@
+import argparse
+import io
+import json
+import mmap
+import os
+import re
+import struct
+
+from cogs._modules_cards import composite_card
+
+
+# A pack is PACK_MAGIC, the length of its index, a JSON index of
+# {"format": ..., "cards": {module_id: [offset, length]}} and then
+# every encoded card, with offsets counted from the end of the index
+PACK_MAGIC = b'R39CARD1'
+PACK_HEADER = struct.Struct('<8sI')
+
+
+# Serves a card's bytes from a memory-mapped view of the pack without copying
+class CardView(io.RawIOBase):
+
+    def __init__(self, view: memoryview):
+        self.view = view
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+
+        self.position = max(0, offset)
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        chunk = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.position += len(chunk)
+        return len(chunk)
+
+
+# Memory-maps a pack built by build_pack() for serving cards at runtime
+class CardPack:
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as pack_file:
+            self.map = mmap.mmap(pack_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+        magic, index_length = PACK_HEADER.unpack_from(self.map, 0)
+        if magic != PACK_MAGIC:
+            raise ValueError("%s is not a card pack" % path)
+
+        index_end = PACK_HEADER.size + index_length
+        index = json.loads(bytes(self.map[PACK_HEADER.size:index_end]))
+
+        self.format = index['format']
+        self.filename = 'image.%s' % self.format
+        self.cards = index['cards']
+        self.data = memoryview(self.map)[index_end:]
+
+    def __contains__(self, module_id: str) -> bool:
+        return module_id in self.cards
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    # Returns a file-like object reading the card straight from the pack
+    def open_card(self, module_id: str) -> CardView:
+        offset, length = self.cards[module_id]
+        return CardView(self.data[offset:offset + length])
+
+
+# Encodes a composited card in the pack's format; palette PNGs
+# trade a little colour accuracy for much smaller uploads
+def encode_card(image, card_format: str, palette: bool) -> bytes:
+    card = io.BytesIO()
+
+    if card_format == 'webp':
+        image.save(card, format='webp', quality=90, method=6)
+    else:
+        if palette:
+            image = image.quantize(colors=256, method=2)
+        image.save(card, format='png', optimize=True)
+
+    return card.getvalue()
+
+
+# Composites every module in data_dir onto its set's card back
+# and writes them all to a single pack file at path
+def build_pack(data_dir: str, path: str, card_format: str = 'png',
+               palette: bool = False) -> int:
+    cards = {}
+    blobs = []
+    offset = 0
+
+    # Each set has a back-<set>.png and a <set>/ directory of numbered images
+    for file_name in sorted(os.listdir(data_dir)):
+        match = re.fullmatch(r'back-(\w+)\.png', file_name)
+        if not match:
+            continue
+
+        module_set = match.group(1)
+        card_back = os.path.join(data_dir, file_name)
+        numbers = sorted(int(image[:-4])
+                         for image in os.listdir(os.path.join(data_dir,
+                                                              module_set))
+                         if re.fullmatch(r'\d+\.png', image))
+
+        for number in numbers:
+            module_image = os.path.join(data_dir, module_set, '%s.png' % number)
+            card = encode_card(composite_card(module_image, card_back),
+                               card_format, palette)
+
+            cards['%s-%s' % (module_set, number)] = [offset, len(card)]
+            blobs.append(card)
+            offset += len(card)
+
+    index = json.dumps({'format': card_format, 'cards': cards}).encode()
+
+    # Write to a temporary file first so a running bot never maps half a pack
+    with open(path + '.tmp', 'wb') as pack_file:
+        pack_file.write(PACK_HEADER.pack(PACK_MAGIC, len(index)))
+        pack_file.write(index)
+        for blob in blobs:
+            pack_file.write(blob)
+    os.replace(path + '.tmp', path)
+
+    return len(cards)
+
+
+# Run from the bot's directory with: python -m cogs._modules_pack
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Pre-render every module card into a single pack file.")
+    parser.add_argument('--data', default='data/modules',
+                        help="directory containing the module images")
+    parser.add_argument('--output', default='data/modules/cards.pack',
+                        help="path to write the pack to")
+    parser.add_argument('--format', choices=['png', 'webp'], default='png',
+                        help="image format to encode cards with")
+    parser.add_argument('--palette', action='store_true',
+                        help="reduce PNG cards to a 256 colour palette")
+    args = parser.parse_args()
+
+    count = build_pack(args.data, args.output, args.format, args.palette)
+    print("Wrote %s card(s) to %s" % (count, args.output))
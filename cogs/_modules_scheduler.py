@@ -0,0 +1,278 @@
+import argparse
+import json
+import math
+import random
+
+
+# The original drop model: no drops until min_messages have been sent since
+# the last one, then each message has an initial_percent% chance of dropping,
+# rising by 1% with every message after that
+class LinearScheduler:
+
+    name = 'linear'
+
+    def __init__(self, min_messages: int = 20, initial_percent: float = 5,
+                 rng=random.random):
+        self.min_messages = min_messages
+        self.initial_percent = initial_percent
+        self.random = rng
+        self.count = 0
+
+    # Counts a message sent at now (in seconds), returning whether to drop
+    def message(self, now: float) -> bool:
+        self.count += 1
+        if self.count < self.min_messages:
+            return False
+
+        # Same as random.randint(0, 100) <= threshold
+        threshold = self.count - (self.min_messages - self.initial_percent)
+        if self.random() * 101 >= threshold + 1:
+            return False
+
+        self.count = 0
+        return True
+
+
+# Tracks messages per minute as an exponentially weighted moving average over
+# roughly window seconds. Nothing drops while the rate is below min_rate,
+# otherwise each message has the chance needed to average drops_per_hour at
+# the current rate, with at least cooldown seconds between drops
+class EWMAScheduler:
+
+    name = 'ewma'
+
+    def __init__(self, window: float = 300.0, min_rate: float = 2.0,
+                 drops_per_hour: float = 4.0, cooldown: float = 120.0,
+                 rng=random.random):
+        self.window = window
+        self.min_rate = min_rate
+        self.drops_per_hour = drops_per_hour
+        self.cooldown = cooldown
+        self.random = rng
+
+        self.rate = 0.0
+        self.last_message = None
+        self.last_drop = -math.inf
+
+    # Counts a message sent at now (in seconds), returning whether to drop
+    def message(self, now: float) -> bool:
+        if self.last_message != None:
+            self.rate *= math.exp(-(now - self.last_message) / self.window)
+        self.rate += 1 / self.window
+        self.last_message = now
+
+        messages_per_minute = self.rate * 60
+        if (messages_per_minute < self.min_rate
+                or now - self.last_drop < self.cooldown):
+            return False
+
+        if self.random() >= self.drops_per_hour / (messages_per_minute * 60):
+            return False
+
+        self.last_drop = now
+        return True
+
+
+# Each message adds one to a counter that halves every half_life seconds,
+# dropping once it reaches threshold; bursts of conversation cause drops,
+# while a slow trickle of messages never builds up enough to
+class DecayingScheduler:
+
+    name = 'decaying'
+
+    def __init__(self, threshold: float = 30.0, half_life: float = 600.0,
+                 rng=random.random):
+        self.threshold = threshold
+        self.half_life = half_life
+
+        self.counter = 0.0
+        self.last_message = None
+
+    # Counts a message sent at now (in seconds), returning whether to drop
+    def message(self, now: float) -> bool:
+        if self.last_message != None:
+            self.counter *= 0.5 ** ((now - self.last_message)
+                                    / self.half_life)
+        self.counter += 1
+        self.last_message = now
+
+        if self.counter < self.threshold:
+            return False
+
+        self.counter = 0.0
+        return True
+
+
+SCHEDULERS = {scheduler.name: scheduler
+              for scheduler in (LinearScheduler, EWMAScheduler,
+                                DecayingScheduler)}
+
+# Settings that apply to a whole server rather than its scheduler
+GUILD_SETTINGS = ('channel_id', 'per_channel', 'ignored_channel_ids')
+
+
+# Whether a setting is a whole number, but not true/false
+def is_int(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+# Raises ValueError unless the server-wide settings are usable
+def check_guild_settings(settings: dict):
+    channel_id = settings.get('channel_id')
+    if channel_id != None and not is_int(channel_id):
+        raise ValueError("channel_id must be a channel ID")
+
+    if not isinstance(settings.get('per_channel', False), bool):
+        raise ValueError("per_channel must be true or false")
+
+    ignored_channel_ids = settings.get('ignored_channel_ids', [])
+    if not isinstance(ignored_channel_ids, list)\
+            or not all(is_int(uid) for uid in ignored_channel_ids):
+        raise ValueError("ignored_channel_ids must be a list of channel IDs")
+
+
+# Creates the scheduler described by a server's settings, e.g.
+# {"model": "ewma", "drops_per_hour": 6}; raises ValueError if invalid
+def create_scheduler(settings: dict, rng=random.random):
+    model = settings.get('model', 'linear')
+    if not model in SCHEDULERS:
+        raise ValueError("Unknown drop model '%s', must be one of: %s"
+                         % (model, ", ".join(SCHEDULERS)))
+
+    check_guild_settings(settings)
+    parameters = {key: value for key, value in settings.items()
+                  if key != 'model' and not key in GUILD_SETTINGS}
+
+    # Every scheduler parameter is a positive number, anything else would
+    # only fail once messages are being counted
+    for key, value in parameters.items():
+        if not (is_int(value) or isinstance(value, float))\
+                or not 0 < value < math.inf:
+            raise ValueError("%s must be a number greater than 0" % key)
+
+    try:
+        return SCHEDULERS[model](rng=rng, **parameters)
+
+    except TypeError:
+        raise ValueError("Invalid setting for drop model '%s'" % model)
+
+
+# Drop scheduling for one server: which channel drops are posted in, which
+# channels don't count, and one scheduler for the whole server or, with
+# per_channel set, a separate one for each channel
+class GuildDrops:
+
+    def __init__(self, settings: dict, rng=random.random):
+        # Fail now rather than on the first message if settings are invalid
+        create_scheduler(settings, rng)
+
+        self.settings = settings
+        self.rng = rng
+        self.channel_id = settings.get('channel_id')
+        self.per_channel = settings.get('per_channel', False)
+        self.ignored_channel_ids = frozenset(
+            settings.get('ignored_channel_ids', ()))
+        self.schedulers = {}
+
+    # Counts a message sent in a channel at now (in seconds),
+    # returning whether it causes a drop
+    def message(self, channel_id: int, now: float) -> bool:
+        if channel_id in self.ignored_channel_ids:
+            return False
+
+        key = channel_id if self.per_channel else None
+        scheduler = self.schedulers.get(key)
+        if scheduler == None:
+            scheduler = create_scheduler(self.settings, self.rng)
+            self.schedulers[key] = scheduler
+
+        return scheduler.message(now)
+
+
+# Reads a recorded message timeline of one UNIX timestamp per line,
+# optionally followed by a comma and the ID of the channel it was sent in
+def read_timeline(path: str) -> list:
+    timeline = []
+    with open(path, 'r') as timeline_file:
+        for line in timeline_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            fields = line.split(',')
+            channel_id = int(fields[1]) if len(fields) > 1 else 0
+            timeline.append((float(fields[0]), channel_id))
+
+    return sorted(timeline)
+
+
+# Replays a timeline through a server's drop settings,
+# returning the times at which drops would have happened
+def simulate(timeline: list, settings: dict, seed: int = None) -> list:
+    guild_drops = GuildDrops(settings, random.Random(seed).random)
+
+    return [timestamp for timestamp, channel_id in timeline
+            if guild_drops.message(channel_id, timestamp)]
+
+
+# Run from the bot's directory with: python -m cogs._modules_scheduler
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Predict how often modules would drop by replaying a "
+                    "recorded message timeline through drop settings.")
+    parser.add_argument('timeline',
+                        help="file of one UNIX timestamp per message, "
+                             "optionally followed by ,<channel id>")
+    parser.add_argument('--settings', default='data/modules_drops.json',
+                        help="drop settings file to read server settings from")
+    parser.add_argument('--guild',
+                        help="ID of the server whose settings to use")
+    parser.add_argument('--model', choices=list(SCHEDULERS),
+                        help="drop model to use instead of a server's")
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help="override a setting, e.g. drops_per_hour=6")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="number of runs to average random models over")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed for the first run")
+    args = parser.parse_args()
+
+    settings = {}
+    if args.guild:
+        with open(args.settings, 'r') as settings_file:
+            settings = dict(json.load(settings_file).get(args.guild, {}))
+    if args.model:
+        settings['model'] = args.model
+    for setting in args.set:
+        key, value = setting.split('=', 1)
+        try:
+            settings[key] = json.loads(value)
+        except json.JSONDecodeError:
+            settings[key] = value
+
+    timeline = read_timeline(args.timeline)
+    if not timeline:
+        parser.error("the timeline is empty")
+
+    try:
+        runs = [simulate(timeline, settings, args.seed + run)
+                for run in range(args.runs)]
+    except ValueError as e:
+        parser.error(str(e))
+
+    hours = max((timeline[-1][0] - timeline[0][0]) / 3600, 1 / 60)
+    drops = sum(len(run) for run in runs) / len(runs)
+
+    # Busiest hour of the first run
+    hourly = {}
+    for timestamp in runs[0]:
+        hour = int((timestamp - timeline[0][0]) // 3600)
+        hourly[hour] = hourly.get(hour, 0) + 1
+
+    print("Settings: %s" % json.dumps(settings or {'model': 'linear'}))
+    print("%s message(s) over %.1f hour(s)" % (len(timeline), hours))
+    print("%.1f drop(s) on average over %s run(s), %.2f per hour"
+          % (drops, len(runs), drops / hours))
+    if hourly:
+        print("Most drops in one hour: %s" % max(hourly.values()))
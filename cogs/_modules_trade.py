@@ -0,0 +1,126 @@
+import psycopg2
+import psycopg2.extensions
+
+
+# Applies every VP and module change in a trade as one statement, so it is
+# atomic and takes a single round trip. Rows are only changed by adding a
+# delta to what's stored, which Postgres applies to the latest committed
+# version of each locked row, and the CHECK constraints on modules.points and
+# module_collection.count make the whole statement fail if anyone would be
+# left with a negative amount. Rows that don't exist yet are inserted with
+# the delta as their starting amount, so taking from them fails the same way.
+# VP changes are also logged to vp_ledger
+TRADE_SQL = "WITH "\
+    "points_delta(uid, delta) AS ("\
+    "SELECT * FROM unnest(%(point_uids)s::bigint[], "\
+    "%(point_deltas)s::integer[])), "\
+    "module_delta(uid, module_id, delta) AS ("\
+    "SELECT * FROM unnest(%(module_uids)s::bigint[], "\
+    "%(module_ids)s::text[], %(module_deltas)s::integer[])), "\
+    "points_logged AS ("\
+    "INSERT INTO vp_ledger (member_id, delta, reason) "\
+    "SELECT uid, delta, 'trade' FROM points_delta), "\
+    "points_updated AS ("\
+    "UPDATE modules SET points = modules.points + points_delta.delta "\
+    "FROM points_delta WHERE modules.member_id = points_delta.uid "\
+    "RETURNING modules.member_id, modules.points), "\
+    "points_created AS ("\
+    "INSERT INTO modules (member_id, points) "\
+    "SELECT uid, delta FROM points_delta WHERE NOT EXISTS ("\
+    "SELECT 1 FROM modules WHERE member_id = points_delta.uid) "\
+    "ON CONFLICT (member_id) "\
+    "DO UPDATE SET points = modules.points + EXCLUDED.points "\
+    "RETURNING member_id, points), "\
+    "modules_updated AS ("\
+    "UPDATE module_collection "\
+    "SET count = module_collection.count + module_delta.delta "\
+    "FROM module_delta WHERE module_collection.member_id = module_delta.uid "\
+    "AND module_collection.module_id = module_delta.module_id "\
+    "RETURNING module_collection.member_id, module_collection.module_id, "\
+    "module_collection.count), "\
+    "modules_created AS ("\
+    "INSERT INTO module_collection (member_id, module_id, count) "\
+    "SELECT uid, module_id, delta FROM module_delta WHERE NOT EXISTS ("\
+    "SELECT 1 FROM module_collection "\
+    "WHERE member_id = module_delta.uid "\
+    "AND module_id = module_delta.module_id) "\
+    "ON CONFLICT (member_id, module_id) "\
+    "DO UPDATE SET count = module_collection.count + EXCLUDED.count "\
+    "RETURNING member_id, module_id, count) "\
+    "SELECT member_id, NULL, points FROM points_updated "\
+    "UNION ALL SELECT member_id, NULL, points FROM points_created "\
+    "UNION ALL SELECT member_id, module_id, count FROM modules_updated "\
+    "UNION ALL SELECT member_id, module_id, count FROM modules_created;"
+
+
+# A set of VP and module transfers between players that either all happen or
+# none do; changes to the same player's VP or module are combined into one
+class Trade:
+
+    def __init__(self):
+        self.points = {}
+        self.modules = {}
+
+    # Whether the trade would change anything
+    def __bool__(self) -> bool:
+        return (any(self.points.values())
+                or any(self.modules.values()))
+
+    # Discord user IDs of every player taking part
+    @property
+    def players(self) -> set:
+        return ({uid for uid in self.points}
+                | {uid for uid, module_id in self.modules})
+
+    # Adds to (or with a negative delta takes from) a player's VP
+    def change_vp(self, uid: int, delta: int):
+        self.points[uid] = self.points.get(uid, 0) + delta
+
+    # Adds copies of a module to (or takes them from) a player's collection
+    def change_module(self, uid: int, module_id: str, delta: int):
+        key = (uid, module_id)
+        self.modules[key] = self.modules.get(key, 0) + delta
+
+    # Moves amount VP from one player to another
+    def move_vp(self, giver: int, receiver: int, amount: int):
+        self.change_vp(giver, -amount)
+        self.change_vp(receiver, amount)
+
+    # Moves copies of a module from one player to another
+    def move_module(self, giver: int, receiver: int, module_id: str,
+                    count: int = 1):
+        self.change_module(giver, module_id, -count)
+        self.change_module(receiver, module_id, count)
+
+    # Query parameters for TRADE_SQL, sorted so that concurrent trades
+    # tend to lock shared rows in the same order
+    def parameters(self) -> dict:
+        points = sorted((uid, delta) for uid, delta in self.points.items()
+                        if delta)
+        modules = sorted((uid, module_id, delta)
+                         for (uid, module_id), delta in self.modules.items()
+                         if delta)
+
+        return {
+            'point_uids': [uid for uid, delta in points],
+            'point_deltas': [delta for uid, delta in points],
+            'module_uids': [uid for uid, module_id, delta in modules],
+            'module_ids': [module_id for uid, module_id, delta in modules],
+            'module_deltas': [delta for uid, module_id, delta in modules]
+        }
+
+
+# Runs a trade on a pooled connection, returning a (member_id, module_id,
+# amount) row for every balance changed, where module_id is None for VP.
+# Raises psycopg2.IntegrityError if a player doesn't have what they're
+# giving; trades that deadlock with another are retried
+async def execute_trade(connection, trade: Trade, retries: int = 2) -> list:
+    while True:
+        try:
+            return await connection.fetchall(TRADE_SQL, trade.parameters(),
+                                             label="Modules.trade")
+
+        except psycopg2.extensions.TransactionRollbackError:
+            if retries == 0:
+                raise
+            retries -= 1
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+from natsort import natsorted
+
+
+# Sorted and paginated listings of player collections, built once and kept
+# until the player's collection changes. Each player has a version number
+# which is bumped whenever their collection changes, and a listing is only
+# served while it was built from the player's current version
+class CollectionViews:
+
+    def __init__(self, catalog, page_size: int = 20, max_views: int = 500):
+        self.catalog = catalog
+        self.page_size = page_size
+        self.max_views = max_views
+        self.versions = {}
+        self.views = OrderedDict()
+
+    # Current version of a player's collection
+    def version(self, uid: int) -> int:
+        return self.versions.get(uid, 0)
+
+    # Marks a player's collection as changed so their listings are rebuilt
+    def changed(self, uid: int):
+        self.versions[uid] = self.version(uid) + 1
+
+    # Returns the pages listing a player's collection, or only their
+    # duplicates, or None if they need to be built
+    def get(self, uid: int, duplicates_only: bool) -> list:
+        key = (uid, duplicates_only)
+        view = self.views.get(key)
+        if view is None or view[0] != self.version(uid):
+            return None
+
+        self.views.move_to_end(key)
+        return view[1]
+
+    # Builds pages of 'module_id -- name' lines from (module_id, count) rows
+    # fetched at the given version and keeps them, forgetting the least
+    # recently used listings once there are more than max_views
+    def build(self, uid: int, duplicates_only: bool, rows: list,
+              version: int) -> list:
+        lines = []
+        for module_id, count in natsorted(rows, key=lambda row: row[0]):
+            module = self.catalog[module_id]
+            lines.append("• %s -- %s%s" % (module_id, module.eng_name,
+                                           " (x%s)" % count
+                                           if count > 1 else ""))
+
+        pages = ["\n".join(lines[i:i + self.page_size])
+                 for i in range(0, len(lines), self.page_size)]
+
+        key = (uid, duplicates_only)
+        self.views[key] = (version, pages)
+        self.views.move_to_end(key)
+        while len(self.views) > self.max_views:
+            self.views.popitem(last=False)
+
+        return pages
@@ -1,16 +1,271 @@
 import robot39
-from discord.ext import commands
+from discord.ext import commands, tasks
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+import re
+import time
 
 
 POSTGRES_FILE = 'postgres.txt'
 
+# Errors raised by psycopg2 when the connection itself has gone away
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+# Records how long each statement takes and how many rows it touches,
+# keeping a window of recent durations per statement for percentiles
+class QueryStats:
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self.statements = {}
+
+    # Records a single execution of the statement identified by key
+    def record(self, key: str, duration: float, rows: int,
+               error: bool = False):
+        if not key in self.statements:
+            self.statements[key] = {
+                'count': 0,
+                'errors': 0,
+                'rows': 0,
+                'total': 0.0,
+                'durations': deque(maxlen=self.samples)
+            }
+
+        statement = self.statements[key]
+        statement['count'] += 1
+        statement['total'] += duration
+        statement['durations'].append(duration)
+        if error:
+            statement['errors'] += 1
+        elif rows > 0:
+            statement['rows'] += rows
+
+    # Returns a row per statement of (key, count, errors, rows, p50, p95,
+    # p99, total) with durations in seconds, slowest total time first
+    def summary(self) -> list:
+        rows = []
+        for key, statement in self.statements.items():
+            durations = sorted(statement['durations'])
+            rows.append((key, statement['count'], statement['errors'],
+                         statement['rows'], percentile(durations, 50),
+                         percentile(durations, 95), percentile(durations, 99),
+                         statement['total']))
+
+        return sorted(rows, key=lambda row: row[7], reverse=True)
+
+    # Forgets everything recorded so far
+    def reset(self):
+        self.statements = {}
+
+
+# Nearest-rank percentile of an already sorted list
+def percentile(values: list, percent: int) -> float:
+    if not values:
+        return 0.0
+
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[index]
+
+
+# Collapses whitespace so the same statement is always recorded under one key
+def normalize_sql(SQL: str) -> str:
+    return re.sub(r'\s+', ' ', SQL).strip()
+
+
+# Wraps a connection borrowed from the pool so that queries are executed
+# on a worker thread instead of blocking the bot's event loop
+class PooledConnection:
+
+    def __init__(self, database, pool, connection, timeout: float = None):
+        self.database = database
+        self.pool = pool
+        self.connection = connection
+        self.timeout = timeout
+
+    # Runs a query on a worker thread; fetch can be None, 'one' or 'all'.
+    # Timings are recorded under label, or the SQL itself if not given
+    async def run(self, SQL: str, data: tuple = None, fetch: str = None,
+                  timeout: float = None, label: str = None):
+        key = label or normalize_sql(SQL)
+        start = time.perf_counter()
+
+        try:
+            result = await self._run(SQL, data, fetch, timeout)
+
+        except psycopg2.Error:
+            self.database.record_query(key, time.perf_counter() - start,
+                                       rows=0, error=True)
+            raise
+
+        # Count rows returned for reads, or rows affected otherwise
+        if fetch == 'all':
+            rows = len(result)
+        elif fetch == 'one':
+            rows = 0 if result is None else 1
+        else:
+            rows = result
+
+        self.database.record_query(key, time.perf_counter() - start, rows)
+        return result
+
+    # Reads are retried on a fresh connection if the current one drops
+    async def _run(self, SQL: str, data: tuple, fetch: str, timeout: float):
+        if timeout is None:
+            timeout = self.timeout
+
+        retries = self.database.read_retries if is_read(SQL) else 0
+        while True:
+            try:
+                return await self._run_once(SQL, data, fetch, timeout)
+
+            # Cancelled queries are timeouts rather than a lost connection
+            except psycopg2.extensions.QueryCanceledError:
+                raise
+
+            except CONNECTION_ERRORS:
+                if retries == 0 or self.connection is None\
+                    or not self.connection.closed:
+                    raise
+
+                retries -= 1
+                self.database.log("Connection lost, retrying query")
+                await self.replace()
+
+    # Cancels the query server-side if it takes longer than the timeout
+    async def _run_once(self, SQL: str, data: tuple, fetch: str,
+                        timeout: float):
+        if self.connection is None:
+            raise psycopg2.InterfaceError("Connection was closed after a "
+                                          "query could not be cancelled")
+
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self.database.executor, self._execute,
+                                      SQL, data, fetch)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+        except asyncio.TimeoutError:
+            pass
+
+        # cancel() opens its own connection to the server, so it's sent from
+        # another thread rather than blocking the event loop
+        cancel_timeout = self.database.cancel_timeout
+        try:
+            await asyncio.wait_for(loop.run_in_executor(
+                None, self.connection.cancel), cancel_timeout)
+
+        except (asyncio.TimeoutError, psycopg2.Error) as e:
+            self.database.log("Error cancelling query:\n%s" % e)
+
+        # Wait for the worker thread to hand the connection back,
+        # which raises QueryCanceledError
+        try:
+            return await asyncio.wait_for(asyncio.shield(future),
+                                          cancel_timeout)
+
+        except asyncio.TimeoutError:
+            self.abandon(future)
+            raise psycopg2.extensions.QueryCanceledError(
+                "Query could not be cancelled, connection closed")
+
+    # Gives up on a connection whose query couldn't be cancelled. It's
+    # closed and handed back, along with its place in the pool, once its
+    # worker thread lets go of it
+    def abandon(self, future):
+        pool, connection = self.pool, self.connection
+        self.connection = None
+        self.database.log("Closing connection stuck in a query")
+
+        def release(future):
+            connection.close()
+            self.database.release(pool, connection)
+            self.database.semaphore.release()
+
+        future.add_done_callback(release)
+
+    # Blocking part of run(), only ever called from an executor thread
+    def _execute(self, SQL: str, data: tuple, fetch: str):
+        cursor = self.connection.cursor()
+
+        try:
+            cursor.execute(SQL, data)
+
+            if fetch == 'one':
+                return cursor.fetchone()
+            elif fetch == 'all':
+                return cursor.fetchall()
+            return cursor.rowcount
+
+        finally:
+            cursor.close()
+
+    # Swaps a dropped connection for a new one from the current pool
+    async def replace(self):
+        self.database.release(self.pool, self.connection)
+        self.pool, self.connection = await self.database.checkout()
+
+    # Runs several statements as one transaction in a single round trip,
+    # rolling back if any of them fail; nothing is fetched as only the
+    # result of the final COMMIT would be available
+    async def transaction(self, SQL: str, data: tuple = None,
+                          timeout: float = None, label: str = None):
+        try:
+            await self.run("BEGIN; " + SQL + " COMMIT;", data, timeout=timeout,
+                           label=label or normalize_sql(SQL))
+
+        except psycopg2.Error:
+            if self.connection != None and not self.connection.closed:
+                await self._run_once("ROLLBACK;", None, None, self.timeout)
+            raise
+
+    # Executes a query and returns the number of affected rows
+    async def execute(self, SQL: str, data: tuple = None,
+                      timeout: float = None, label: str = None) -> int:
+        return await self.run(SQL, data, timeout=timeout, label=label)
+
+    # Executes a query and returns the first row of the result
+    async def fetchone(self, SQL: str, data: tuple = None,
+                       timeout: float = None, label: str = None):
+        return await self.run(SQL, data, fetch='one', timeout=timeout,
+                              label=label)
+
+    # Executes a query and returns every row of the result
+    async def fetchall(self, SQL: str, data: tuple = None,
+                       timeout: float = None, label: str = None) -> list:
+        return await self.run(SQL, data, fetch='all', timeout=timeout,
+                              label=label)
+
+
+# Only plain SELECT statements are safe to send to the database twice
+def is_read(SQL: str) -> bool:
+    return SQL.lstrip()[:6].upper() == 'SELECT'
+
 
 class Database(robot39.Cog):
 
     def __init__(self, bot):
         self.bot = bot
 
+        ### !--- CONFIGURABLE ---! ###
+        self.pool_min_size = 1 # Connections kept open at all times
+        self.pool_max_size = 5 # Upper limit of concurrent connections
+        self.query_timeout = 10.0 # Seconds before a query is cancelled
+        self.cancel_timeout = 5.0 # Seconds to wait on a cancel before closing
+        self.read_retries = 2 # Times a read is retried on a new connection
+        self.ping_interval = 30.0 # Seconds between connection health checks
+        self.reconnect_delay = 1.0 # Initial seconds to wait between reconnects
+        self.reconnect_max_delay = 60.0 # Upper limit of the reconnect backoff
+        self.slow_query_time = 0.25 # Seconds before a query is logged as slow
+        self.query_samples = 1000 # Durations kept per statement for percentiles
+        ### !--- • ---! ###
+
         # Read database URL from file
         try:
             postgres_txt = open(POSTGRES_FILE, "r")
@@ -20,21 +275,185 @@ class Database(robot39.Cog):
                   % POSTGRES_FILE)
             raise commands.ExtensionFailed
 
-        postgres_txt = open(POSTGRES_FILE, "r")
         self.DATABASE_URL = postgres_txt.read()
         postgres_txt.close()
 
+        # Latency and row counts of every query run through the pool
+        self.query_stats = QueryStats(samples=self.query_samples)
+
         # Connect to database
         try:
-            self.connection = psycopg2.connect(self.DATABASE_URL,
-                                             sslmode='require')
-            self.connection.autocommit = True
+            self.pool = self.connect()
             self.log("Connected to database")
 
         except psycopg2.Error:
             self.log("Error connecting to the database!")
             raise commands.ExtensionFailed
 
+        # One worker thread per connection, and a semaphore so that callers
+        # wait for a free connection rather than the pool raising PoolError
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_max_size,
+                                           thread_name_prefix='database')
+        self.semaphore = asyncio.Semaphore(self.pool_max_size)
+
+        # Cleared while reconnecting so new queries wait for the new pool
+        self.connected = asyncio.Event()
+        self.connected.set()
+
+        # Connections checked out of each pool, so that a replaced pool is
+        # only closed once every connection has come back to it
+        self.in_use = {}
+        self.retired_pools = set()
+
+        self.health_check.change_interval(seconds=self.ping_interval)
+        self.health_check.start()
+
+    # Closes every pooled connection if the cog is unloaded
+    def cog_unload(self):
+        self.health_check.cancel()
+        self.executor.shutdown(wait=False)
+        self.pool.closeall()
+
+    ### !--- METHODS ---! ###
+    # Opens a new pool of connections to the database
+    def connect(self) -> psycopg2.pool.ThreadedConnectionPool:
+        return psycopg2.pool.ThreadedConnectionPool(
+            self.pool_min_size, self.pool_max_size,
+            self.DATABASE_URL, sslmode='require')
+
+    # Takes a live connection from the current pool, throwing away any
+    # idle connections that were closed by the server in the meantime
+    async def checkout(self):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            pool = self.pool
+            connection = await loop.run_in_executor(self.executor,
+                                                    pool.getconn)
+            if not connection.closed:
+                connection.autocommit = True
+                self.in_use[pool] = self.in_use.get(pool, 0) + 1
+                return pool, connection
+
+            pool.putconn(connection, close=True)
+
+    # Returns a connection to the pool it came from, closing it
+    # if it was dropped or its pool has since been replaced
+    def release(self, pool, connection):
+        self.in_use[pool] = self.in_use.get(pool, 1) - 1
+
+        if pool.closed:
+            connection.close()
+        else:
+            pool.putconn(connection, close=bool(connection.closed)
+                         or pool in self.retired_pools)
+
+        if pool in self.retired_pools and self.in_use[pool] <= 0:
+            self.close_pool(pool)
+
+    # Stops handing out connections from a replaced pool. It's closed once
+    # the last connection checked out of it comes back, as closing a
+    # connection waits for any query still running on it to finish
+    def retire(self, pool):
+        self.retired_pools.add(pool)
+        if self.in_use.get(pool, 0) <= 0:
+            self.close_pool(pool)
+
+    # Closes a pool's remaining idle connections on another thread
+    def close_pool(self, pool):
+        self.retired_pools.discard(pool)
+        self.in_use.pop(pool, None)
+        if not pool.closed:
+            asyncio.get_event_loop().run_in_executor(None, pool.closeall)
+
+    # Records a finished query and logs it if it was slow
+    def record_query(self, key: str, duration: float, rows: int,
+                     error: bool = False):
+        self.query_stats.record(key, duration, rows, error)
+
+        if duration >= self.slow_query_time:
+            self.log("Slow query (%sms, %s row(s)): %s"
+                     % (round(duration * 1000), rows, key))
+
+    # Borrows a connection from the pool for the duration of an async with
+    # block, e.g. async with bot.database.acquire() as connection:
+    @asynccontextmanager
+    async def acquire(self, timeout: float = None):
+        if timeout is None:
+            timeout = self.query_timeout
+
+        # Wait out a reconnect in progress rather than failing immediately
+        try:
+            await asyncio.wait_for(self.connected.wait(), timeout)
+
+        except asyncio.TimeoutError:
+            raise psycopg2.OperationalError("Database is reconnecting")
+
+        # The semaphore is released by hand, as an abandoned connection
+        # keeps its place until its worker thread is done with it
+        await self.semaphore.acquire()
+        try:
+            pool, connection = await self.checkout()
+
+        except BaseException:
+            self.semaphore.release()
+            raise
+
+        pooled = PooledConnection(self, pool, connection, timeout)
+        try:
+            yield pooled
+
+        finally:
+            if pooled.connection != None:
+                self.release(pooled.pool, pooled.connection)
+                self.semaphore.release()
+
+    # Replaces the pool once the database is reachable again,
+    # doubling the wait between each failed attempt
+    async def reconnect(self):
+        self.connected.clear()
+        delay = self.reconnect_delay
+        loop = asyncio.get_event_loop()
+
+        while True:
+            try:
+                pool = await loop.run_in_executor(self.executor, self.connect)
+                break
+
+            except psycopg2.Error as e:
+                self.log("Error reconnecting to the database, retrying in %ss:"
+                         "\n%s" % (delay, e))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+
+        old_pool, self.pool = self.pool, pool
+        self.retire(old_pool)
+        self.connected.set()
+        self.log("Reconnected to database")
+
+    ### !--- TASKS ---! ###
+    # Pings the database and reconnects if the connection has been lost
+    @tasks.loop(seconds=30.0)
+    async def health_check(self):
+        try:
+            async with self.acquire() as connection:
+                await connection.execute("SELECT 1;", label="health_check")
+
+        # A slow ping under load isn't a lost connection
+        except psycopg2.extensions.QueryCanceledError as e:
+            self.log("Database health check timed out:\n%s" % e)
+
+        except CONNECTION_ERRORS as e:
+            self.log("Database health check failed:\n%s" % e)
+            await self.reconnect()
+
+        except psycopg2.Error as e:
+            self.log("Database health check failed:\n%s" % e)
+
+    @health_check.before_loop
+    async def before_health_check(self):
+        await self.bot.wait_until_ready()
+
 
 def setup(bot):
-    bot.add_cog(Database(bot))
\ No newline at end of file
+    bot.add_cog(Database(bot))
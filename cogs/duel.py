@@ -3,13 +3,19 @@ import discord
 from discord.ext import commands, tasks
 import asyncio
 import ast
+from collections import OrderedDict
 import csv
 import psycopg2
 import random
 import secrets
+import time
 
 import cogs._duel_misc as _duel_misc
 import cogs._duel_challenge as _duel_challenge
+import cogs._duel_replay as _duel_replay
+from cogs._duel_queue import MatchQueue
+from cogs._duel_reactions import ReactionRouter
+from cogs._duel_sessions import DuelSessions, DuelState
 
 
 class Duel(robot39.Cog):
@@ -17,10 +23,8 @@ class Duel(robot39.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        # Access bot database connection
-        if bot.database:
-            self.database = bot.database.connection
-        else:
+        # Cog cannot load without the database cog
+        if not bot.database:
             raise commands.ExtensionFailed
 
         ### !--- CONFIGURABLE ---! ###
@@ -41,9 +45,20 @@ class Duel(robot39.Cog):
         self.joke_emoji = 412035754613800970
 
         self.wait_time = 120 #seconds to wait before asking for scores
+        self.result_retry_time = 60 #seconds to wait before trying to record a duel result again
         self.k_value = 50 #k value used in ELO calculations
+        self.starting_elo = 1200 #ELO new players start with
+        self.multipliers = {2: 1, 3: 1.5, 5: 2.5} #ELO weighting for bo3, bo5 and bo9 duels, by points needed to win
+
+        self.queue_elo_range = 100 #max ELO difference between queued players matched straight away
+        self.queue_elo_growth = 50 #how much further apart they can be for every minute waited
+        self.queue_timeout = 1800 #seconds before a queued player is taken out of the queue
 
         self.staff_roles = ["Secret Police"] #names of all staff roles to be mentioned/allowed use this cog
+
+        self.user_names_ttl = 3600 #seconds to keep fetched user names for
+        self.user_names_size = 1000 #max number of fetched user names kept
+        self.user_fetch_limit = 5 #max concurrent user fetches from discord
         
         self.dlc_packs = {
             'FT FS': 'FT Future Sound',
@@ -71,9 +86,37 @@ class Duel(robot39.Cog):
         }
         ### !--- • ---! ###
 
-        self.duels_in_progress = []
         self.duels_enabled = True
 
+        #reactions to duel prompts, passed on by message ID
+        self.reactions = ReactionRouter(bot.loop)
+
+        #duels in progress by channel, each run by a task that is cancelled
+        #on unload and resumed from the database when the cog next loads
+        self.sessions = DuelSessions(bot, self.log)
+        self.duel_tasks = {}
+        self.resume_task = bot.loop.create_task(self.resume_duels())
+
+        #players waiting to be matched, paired up whenever a channel is free
+        self.match_queue = MatchQueue(self.queue_elo_range, self.queue_elo_growth, self.count_shared_songs)
+        self.matchmaking_lock = asyncio.Lock()
+        self.matchmaking_loop.start()
+
+        #index of player rows by member_id, loaded on first use
+        self.players = {}
+        self.players_loaded = False
+        self.players_lock = asyncio.Lock()
+
+        #names of users not in the gateway cache, by member_id
+        self.user_names = OrderedDict()
+        self.user_fetch_semaphore = asyncio.Semaphore(self.user_fetch_limit)
+
+        #rankings are only re-published once the standings change
+        self.settings_loaded = False
+        self.rankings_dirty = True
+        self.rankings_embed = None
+        self.rankings_message_obj = None
+
         #begin loop to keep rankings and settings up to date
         try:
             self.duel_loop.start()
@@ -90,6 +133,9 @@ class Duel(robot39.Cog):
             self.log("Info loaded for %s song(s)." % len(self.songs))
         except:
             self.log("Error reading song data from song_data.csv.")
+
+        #index songs by DLC pack for finding shared songs
+        self.build_song_index()
         
         #read dictionary of DLC packs + emoji equivalents to dict
         try:
@@ -103,24 +149,43 @@ class Duel(robot39.Cog):
 
     def cog_unload(self):
         self.duel_loop.cancel()
+        self.matchmaking_loop.cancel()
+        self.resume_task.cancel()
+        for task in list(self.duel_tasks.values()):
+            task.cancel()
+        self.reactions.close()
+
+    #always reach the currently loaded database cog so that reloading it
+    #doesn't leave this cog holding on to a closed connection pool
+    @property
+    def database(self):
+        return self.bot.database
 
     ### !--- MISC. FUNCTIONS ---! ###
     async def fetch_settings(self, guild_id):
         return await _duel_misc.fetch_settings(self, guild_id)
+    async def load_players(self):
+        await _duel_misc.load_players(self)
+    def cache_player(self, uid, row):
+        _duel_misc.cache_player(self, uid, row)
     async def fetch_players(self, uid=None):
         return await _duel_misc.fetch_players(self, uid)
     async def is_registered(self, member):
         return await _duel_misc.is_registered(self, member)
+    async def resolve_user_names(self, uids):
+        return await _duel_misc.resolve_user_names(self, uids)
     async def generate_rankings_embed(self, players):
         return await _duel_misc.generate_rankings_embed(self, players)
     async def calculate_elo(self, elo1, elo2, multiplier):
         return await _duel_misc.calculate_elo(self, elo1, elo2, multiplier)
-    async def update_points(self, uid, points, player_win):
-        await _duel_misc.update_points(self, uid, points, player_win)
-    async def record_duel(self, win_id, win_points, lose_id, lose_points, change):
-        await _duel_misc.record_duel(self, win_id, win_points, lose_id, lose_points, change)
+    async def record_result(self, win_id, win_elo, lose_id, lose_elo, change, max_points, session_id=None):
+        return await _duel_misc.record_result(self, win_id, win_elo, lose_id, lose_elo, change, max_points, session_id)
     async def update_dlc(self, user, action, dlc):
         await _duel_misc.update_dlc(self, user, action, dlc)
+    async def prepare_history(self):
+        await _duel_replay.prepare_history(self)
+    async def replay_history(self, apply=False):
+        return await _duel_replay.replay_history(self, apply)
 
     ### !--- CHECKS & COMMANDS ---! ###
     @commands.command()
@@ -137,20 +202,17 @@ class Duel(robot39.Cog):
             player = ctx.author
             uid = ctx.message.author.id
 
-        SQL = "INSERT INTO players (member_id, points, win, loss, streak) VALUES (%s, 1200, 0, 0, 0);"
-        cursor = self.database.cursor()
+        SQL = "INSERT INTO players (member_id, points, win, loss, streak) VALUES (%s, %s, 0, 0, 0) RETURNING *;"
 
         try:
-            cursor.execute(SQL, (uid,))
+            async with self.database.acquire() as connection:
+                self.cache_player(uid, await connection.fetchone(SQL, (uid, self.starting_elo)))
             await ctx.send("You've been registered for duels, %s! Please set your owned song packs in the duel DLC channel." % player.mention)
 
         except psycopg2.Error as e:
             self.log("Error registering user %s:\n%s" % (player, e))
             await ctx.send("There was an error registering that user, %s. Are they already registered? If not please PM an admin." % ctx.message.author.mention)
 
-        finally:
-            cursor.close()
-
     @commands.command()
     @commands.guild_only()
     async def convert(self, ctx, game: str, score: int):
@@ -188,76 +250,58 @@ class Duel(robot39.Cog):
     async def rank(self, ctx):
         if not await self.is_registered(ctx.message.author):
             await ctx.send("You must be registered to view your profile, %s! Please use command 39!register in a dueling channel." % ctx.message.author.mention)
+            return
         uid = ctx.message.author.id
-        #fetch all player info for embed
-        SQL1 = "SELECT * FROM players WHERE member_id = %s"
-        #fetch player rank sorted by ELO/points
-        SQL2 = "WITH ranks as (SELECT member_id, RANK() OVER(ORDER BY points DESC) FROM players) SELECT rank FROM ranks WHERE member_id=%s"
-        cursor = self.database.cursor()
-
-        try:
-            #fetch player info
-            cursor.execute(SQL1, (uid,))
-            player = cursor.fetchone()
-
-            #fetch player rank
-            cursor.execute(SQL2, (uid,))
-            rank = cursor.fetchone()[0]
-
-            #calculate winrate
-            wins = player[3]
-            losses = player[4]
-            winrate = "0%" if wins == 0 else "%s%%" % str(round((wins / (wins + losses)) * 100,2)) if losses != 0 else "100%"
-            streak = player[5]
-
-            #player info embed
-            embed=discord.Embed(title=str(ctx.message.author), description="Player Ranking", color=0x80ffff)
-            embed.add_field(name="Rank", value=rank, inline=True)
-            embed.add_field(name="ELO", value=player[2], inline=True)
-            embed.add_field(name="Winrate", value=winrate, inline=False)
-            embed.add_field(name="Wins", value=wins, inline=True)
-            embed.add_field(name="Losses", value=losses, inline=True)
-            embed.add_field(name="Winstreak", value=streak, inline=False)
-            embed.set_footer(text="Use command 39!rank to view your own player info")
-            embed.set_thumbnail(url=ctx.message.author.avatar_url)
+        #fetch all player info for embed from the player index
+        player = await self.fetch_players(uid)
+
+        #player rank sorted by ELO/points, tied players sharing a rank
+        rank = 1 + sum(1 for other in self.players.values() if other[2] > player[2])
+
+        #calculate winrate
+        wins = player[3]
+        losses = player[4]
+        winrate = "0%" if wins == 0 else "%s%%" % str(round((wins / (wins + losses)) * 100,2)) if losses != 0 else "100%"
+        streak = player[5]
+
+        #player info embed
+        embed=discord.Embed(title=str(ctx.message.author), description="Player Ranking", color=0x80ffff)
+        embed.add_field(name="Rank", value=rank, inline=True)
+        embed.add_field(name="ELO", value=player[2], inline=True)
+        embed.add_field(name="Winrate", value=winrate, inline=False)
+        embed.add_field(name="Wins", value=wins, inline=True)
+        embed.add_field(name="Losses", value=losses, inline=True)
+        embed.add_field(name="Winstreak", value=streak, inline=False)
+        embed.set_footer(text="Use command 39!rank to view your own player info")
+        embed.set_thumbnail(url=ctx.message.author.avatar_url)
 
-            await ctx.send(embed=embed)
-
-        finally:
-            cursor.close()
+        await ctx.send(embed=embed)
 
     @commands.command()
     @commands.guild_only()
     async def my_dlc(self, ctx):
         if not await self.is_registered(ctx.message.author):
             await ctx.send("You must be registered to view your DLC, %s! Please use command 39!register in a dueling channel." % ctx.message.author.mention)
+            return
         uid = ctx.message.author.id
-        #fetch all player info for embed
-        SQL1 = "SELECT dlc FROM players WHERE member_id = %s"
-        cursor = self.database.cursor()
-
-        try:
-            #fetch player dlc
-            cursor.execute(SQL1, (uid,))
-            dlc_list = (cursor.fetchone())[0]
-
-            #only continue if player actually has DLC set
-            if not dlc_list:
-                await ctx.send("You haven't selected any DLC yet, %s! Please go to the duel DLC channel.")
+        #fetch player dlc from the player index
+        dlc_list = (await self.fetch_players(uid))[6]
 
-            dlc_owned = [self.dlc_packs[dlc] for dlc in dlc_list]
-            dlc_for_embed = '\n'.join(sorted(dlc_owned))
+        #only continue if player actually has DLC set
+        if not dlc_list:
+            await ctx.send("You haven't selected any DLC yet, %s! Please go to the duel DLC channel." % ctx.message.author.mention)
+            return
 
-            #player info embed
-            embed=discord.Embed(title=str(ctx.message.author), description="Player Games & DLC", color=0x80ffff)
-            embed.add_field(name="Owned:", value=dlc_for_embed, inline=True)
-            embed.set_footer(text="Use command 39!my_dlc to view your own DLC")
-            embed.set_thumbnail(url=ctx.message.author.avatar_url)
+        dlc_owned = [self.dlc_packs[dlc] for dlc in dlc_list]
+        dlc_for_embed = '\n'.join(sorted(dlc_owned))
 
-            await ctx.send(embed=embed)
+        #player info embed
+        embed=discord.Embed(title=str(ctx.message.author), description="Player Games & DLC", color=0x80ffff)
+        embed.add_field(name="Owned:", value=dlc_for_embed, inline=True)
+        embed.set_footer(text="Use command 39!my_dlc to view your own DLC")
+        embed.set_thumbnail(url=ctx.message.author.avatar_url)
 
-        finally:
-            cursor.close()
+        await ctx.send(embed=embed)
     
     @commands.command()
     @commands.guild_only()
@@ -275,7 +319,6 @@ class Duel(robot39.Cog):
         shared_songs_list = await self.get_shared_songs(player1, player2)
         if (len(shared_songs_list) == 0) or (type(shared_songs_list) == None):
             await ctx.send("It seems neither of you have any songs in common to duel with! Please check your settings in the duel DLC channel.")
-            self.duels_in_progress.remove(ctx.channel.id)
             self.log("Error, no songs in common between %s and %s." % (player1, player2))
             return
 
@@ -291,26 +334,39 @@ class Duel(robot39.Cog):
     ### !--- DUEL LOGIC & CHALLENGE FUNCTIONS ---! ###
     async def can_duel(self, ctx, player1, player2):
         return await _duel_challenge.can_duel(self, ctx, player1, player2)
+    def build_song_index(self):
+        _duel_challenge.build_song_index(self)
+    def count_shared_songs(self, uid1, uid2):
+        return _duel_challenge.count_shared_songs(self, uid1, uid2)
     async def get_shared_songs(self, player1, player2):
         return await _duel_challenge.get_shared_songs(self, player1, player2)
     async def get_max_points(self, ctx, duel_type):
         return await _duel_challenge.get_max_points(self, ctx, duel_type)
-    async def issue_challenge(self, ctx, player1, player2, duel_type):
-        return await _duel_challenge.issue_challenge(self, ctx, player1, player2, duel_type)
-    async def confirm_duel(self, ctx, player1, player2, challenge_id):
-        return await _duel_challenge.confirm_duel(self, ctx, player1, player2, challenge_id)
-    async def begin_round(self, ctx, player1, player2, duel_round, shared_songs_list):
-        return await _duel_challenge.begin_round(self, ctx, player1, player2, duel_round, shared_songs_list)
-    async def song_countdown(self, ctx):
-        await _duel_challenge.song_countdown(self, ctx)
-    async def confirm_scores(self, ctx, player1, player2):
-        return await _duel_challenge.confirm_scores(self, ctx, player1, player2)
-    async def get_winner(self, ctx, player1, player2):
-        return await _duel_challenge.get_winner(self, ctx, player1, player2)
-    async def confirm_winner(self, ctx, winner, loser):
-        return await _duel_challenge.confirm_winner(self, ctx, winner, loser)
-    async def process_duel_results(self, ctx, winner, loser, duel_max_points):
-        await _duel_challenge.process_duel_results(self, ctx, winner, loser, duel_max_points)
+    async def issue_challenge(self, channel, player1, player2, max_points):
+        return await _duel_challenge.issue_challenge(self, channel, player1, player2, max_points)
+    async def confirm_duel(self, channel, player1, player2, challenge_message, response):
+        return await _duel_challenge.confirm_duel(self, channel, player1, player2, challenge_message, response)
+    async def wait_for_players(self, channel, pending, announcement):
+        await _duel_challenge.wait_for_players(self, channel, pending, announcement)
+    async def begin_round(self, channel, player1, player2, duel_round, shared_songs_list):
+        return await _duel_challenge.begin_round(self, channel, player1, player2, duel_round, shared_songs_list)
+    async def song_countdown(self, channel):
+        await _duel_challenge.song_countdown(self, channel)
+    async def confirm_scores(self, channel, player1, player2):
+        return await _duel_challenge.confirm_scores(self, channel, player1, player2)
+    async def get_winner(self, channel, player1, player2):
+        return await _duel_challenge.get_winner(self, channel, player1, player2)
+    async def confirm_winner(self, channel, winner, loser):
+        return await _duel_challenge.confirm_winner(self, channel, winner, loser)
+    async def process_duel_results(self, channel, winner, loser, duel_max_points, session_id=None):
+        return await _duel_challenge.process_duel_results(self, channel, winner, loser, duel_max_points, session_id)
+    async def run_duel(self, session, resumed=False):
+        await _duel_challenge.run_duel(self, session, resumed)
+
+    #runs a duel session in the background, keeping the task so it can be
+    #cancelled if the cog is unloaded
+    def start_duel(self, session, resumed=False):
+        self.duel_tasks[session.channel_id] = self.bot.loop.create_task(self.run_duel(session, resumed))
 
     @commands.command()
     @commands.guild_only()
@@ -322,105 +378,102 @@ class Duel(robot39.Cog):
             #duel checks failed
             return
 
-        #block channel from future duels
-        self.duels_in_progress.append(ctx.channel.id)
-
-        #duel logic starts here
         duel_max_points = await self.get_max_points(ctx, duel_type)
         if not duel_max_points:
             await ctx.send("That's not a valid duel option, %s! Your choices are bo3, bo5, or bo9 for a best of 3, 5, or 9 rounds respectively.\n" % player1.mention\
                 +"Leave this option out to default to a best of 3 duel.")
-            self.duels_in_progress.remove(ctx.channel.id)
             return
 
-        challenge_id = await self.issue_challenge(ctx, player1, player2, duel_type)
-        self.log("%s issued a %s challenge to %s" % (player1, duel_type.lower(), player2))
+        #block channel from future duels, the database having the final say
+        #on whether it's free
+        try:
+            session = await self.sessions.start(ctx.channel.id, player1.id, player2.id, duel_max_points)
 
-        if not await self.confirm_duel(ctx, player1, player2, challenge_id):
-            #duel timed out or declined
+        except psycopg2.Error as e:
+            self.log("Error starting duel session:\n%s" % e)
+            await ctx.send("There was an error starting the duel, %s. Please PM an admin if this keeps happening." % player1.mention)
             return
 
-        #duel accepted, beginning
-        #get shared songs between both players and end duel if list is empty
-        shared_songs_list = await self.get_shared_songs(player1, player2)
-        if (len(shared_songs_list) == 0) or (type(shared_songs_list) == None):
-            await ctx.send("It seems neither of you have any songs in common to duel with! Please check your settings in the duel DLC channel.")
-            self.duels_in_progress.remove(ctx.channel.id)
-            self.log("Error, no songs in common between %s and %s." % (player1, player2))
+        if session == None:
+            await ctx.send("There is already a duel in progress or pending challenge here, %s." % player1.mention)
+            self.log("Duel already in progress in channel %s" % ctx.channel)
             return
 
-        self.log("%s accepted the challenge from %s" % (player2, player1))
-        await ctx.send("**Beginning Duel:** %s vs %s\n"\
-            % (player1.mention, player2.mention)\
-            + "First to %s point(s) wins. Priority is Perfects > Percentage > Score."\
-            % duel_max_points)
-        
-        #initialising score/round counter variables
-        p1_score = 0
-        p2_score = 0
-        duel_round = 1
-
-        #duel loop begins here
-        while (p1_score < duel_max_points and p2_score < duel_max_points):
-            #begin round and get song rolls, cancel if returns false
-            if not await self.begin_round(ctx, player1, player2, duel_round, shared_songs_list):
-                #roll timer ran out
-                self.duels_in_progress.remove(ctx.channel.id)
+        #duel logic runs from here in the background
+        self.log("%s issued a %s challenge to %s" % (player1, duel_type.lower(), player2))
+        self.start_duel(session)
+
+    #pairs up queued players and starts their duels in free duel channels
+    async def matchmake(self):
+        async with self.matchmaking_lock:
+            if not self.sessions.loaded or not self.duels_enabled:
                 return
 
-            #continue round
-            await self.song_countdown(ctx)
-            await asyncio.sleep(self.wait_time)
+            pairs = self.match_queue.match(time.monotonic(), len(self.sessions.free_channels), self.sessions.players)
 
-            #get players to confirm posting their scores
-            if not await self.confirm_scores(ctx, player1, player2):
-                #one or both players didn't confirm posting
-                self.duels_in_progress.remove(ctx.channel.id)
-                return
+            for p1_id, p2_id, max_points in pairs:
+                #a challenge may have taken the last free channel meanwhile
+                channel_id = self.sessions.free_channel()
+                session = None
 
-            #continue round
-            #loop for confirming winner
-            while(True):
-                winner = await self.get_winner(ctx, player1, player2)
-                
-                if winner == 0:
-                    #neither player reacted
-                    #unblock channel from future duels
-                    self.duels_in_progress.remove(ctx.channel.id)
-                    return
-            
-                #break loop if winner is confirmed by the other player
-                if await self.confirm_winner(ctx, player1 if winner==1 else player2, player2 if winner==1 else player1):
-                    #increment winning player's score
-                    if winner == 1:
-                        p1_score += 1
-                    else:
-                        p2_score += 1
-
-                    #break loop for confirming winner
-                    break
-
-            #send current scores and increment round counter
-            await ctx.send("**Point to %s!**\n"\
-                % (player1.mention if winner == 1 else player2.mention)\
-                + "Current scores: %s %s - %s %s"\
-                % (player1.mention, p1_score, p2_score, player2.mention))
-
-            duel_round += 1
-        
-        #duel finished, announce winner and update scores/rankings
-        await ctx.send("**Duel finished:** %s wins!"\
-            % (player1.mention if p1_score == duel_max_points else player2.mention))
-
-        await self.process_duel_results(
-                ctx,
-                player1 if p1_score == duel_max_points else player2,
-                player2 if p1_score == duel_max_points else player1,
-                duel_max_points
-                )
-        
-        #unblock channel from future duels
-        self.duels_in_progress.remove(ctx.channel.id)
+                try:
+                    if channel_id != None:
+                        session = await self.sessions.start(channel_id, p1_id, p2_id, max_points, DuelState.accepted)
+
+                except psycopg2.Error as e:
+                    self.log("Error starting matched duel:\n%s" % e)
+
+                #put both players back in the queue to try again
+                if session == None:
+                    for uid in (p1_id, p2_id):
+                        if uid in self.players:
+                            self.match_queue.join(uid, self.players[uid][2], max_points, time.monotonic())
+                    continue
+
+                self.log("Matched %s and %s for a duel in channel %s." % (p1_id, p2_id, channel_id))
+                self.start_duel(session)
+
+    @commands.command()
+    @commands.guild_only()
+    async def queue(self, ctx, duel_type: str = "bo3"):
+        player = ctx.message.author
+
+        if not self.duels_enabled:
+            await ctx.send("New duels are temporarily disabled, most likely due to testing new features. Please go bother Seán if this lasts more than a few minutes.")
+            return
+
+        if not await self.is_registered(player):
+            await ctx.send("You must be registered to queue for a duel, %s! Please use command 39!register." % player.mention)
+            return
+
+        if player.id in self.sessions.players:
+            await ctx.send("You're already in a duel, %s!" % player.mention)
+            return
+
+        duel_max_points = await self.get_max_points(ctx, duel_type)
+        if not duel_max_points:
+            await ctx.send("That's not a valid duel option, %s! Your choices are bo3, bo5, or bo9 for a best of 3, 5, or 9 rounds respectively.\n" % player.mention\
+                +"Leave this option out to default to a best of 3 duel.")
+            return
+
+        self.match_queue.join(player.id, (await self.fetch_players(player.id))[2], duel_max_points, time.monotonic())
+        await ctx.send("You've joined the queue for a best of %s, %s! You'll be pinged in a duel channel once you're matched with an opponent.\n"\
+            % (duel_max_points * 2 - 1, player.mention)\
+            + "Use 39!leave_queue to stop waiting.")
+        self.log("%s joined the %s queue." % (player, duel_type.lower()))
+
+        await self.matchmake()
+
+    @commands.command()
+    @commands.guild_only()
+    async def leave_queue(self, ctx):
+        player = ctx.message.author
+
+        if self.match_queue.leave(player.id):
+            await ctx.send("You've left the duel queue, %s." % player.mention)
+            self.log("%s left the queue." % player)
+        else:
+            await ctx.send("You're not in the duel queue, %s." % player.mention)
 
     ### !--- MODERATION ---! ###
     async def is_mod(self, user):
@@ -436,19 +489,22 @@ class Duel(robot39.Cog):
     @commands.is_owner()
     async def unregister(self, ctx, user: discord.Member):
         member_id = user.id
-        SQL = "DELETE FROM  players WHERE member_id = %s;"
-        cursor = self.database.cursor()
+
+        #noting the last duel before the player was removed lets replays of
+        #the duel history start them over from there
+        SQL = "WITH removed AS (DELETE FROM players WHERE member_id = %s RETURNING member_id) "\
+            "INSERT INTO duel_resets (member_id, after_duel) "\
+            "SELECT member_id, (SELECT coalesce(max(id), 0) FROM duels) FROM removed;"
 
         try:
-            cursor.execute(SQL, (member_id,))
+            async with self.database.acquire() as connection:
+                await connection.execute(SQL, (member_id,))
+            self.cache_player(member_id, None)
             await ctx.send("User unregistered.")
 
         except psycopg2.Error as e:
             self.log("Error unregistering user %s:\n%s" % (user, e))
 
-        finally:
-            cursor.close()
-
     @commands.command()
     @commands.is_owner()
     async def reset_user(self, ctx, user: discord.Member):
@@ -459,19 +515,15 @@ class Duel(robot39.Cog):
     @commands.is_owner()
     async def duel_results(self, ctx, duel_id):
         SQL = "SELECT * FROM duels WHERE id = %s;"
-        cursor = self.database.cursor()
 
         try:
-            cursor.execute(SQL, (duel_id,))
-            duel = cursor.fetchone()
+            async with self.database.acquire() as connection:
+                duel = await connection.fetchone(SQL, (duel_id,))
 
         except psycopg2.OperationalError as e:
             self.log("Error fetching duel from database:\n%s" % e)
             duel = None
 
-        finally:
-            cursor.close()
-
         win_player = self.bot.get_user(duel[1])
         win_points = duel[2]
 
@@ -490,6 +542,37 @@ class Duel(robot39.Cog):
 
         await ctx.send(embed=embed)
 
+    #replays every duel with the current k value and multipliers, showing how
+    #ratings would change unless used with 'apply' to write them back
+    @commands.command()
+    @commands.is_owner()
+    async def rerate(self, ctx, action: str = "preview"):
+        apply = action.lower() == "apply"
+
+        async with ctx.typing():
+            result = await self.replay_history(apply)
+
+        if result == None:
+            await ctx.send("Duel history could not be replayed and nothing was written, please check the log. If a duel just finished, try again.")
+            return
+
+        duel_count, changed_duels, changed_ratings = result
+        summary = "Replayed %s duel(s) with a k value of %s. %s duel(s) and %s rating(s) %s.\n"\
+            % (duel_count, self.k_value, len(changed_duels), len(changed_ratings), "changed" if apply else "would change")
+
+        #biggest changes first
+        changes = sorted(changed_ratings.items(), key=lambda item: abs(item[1][1] - item[1][0]), reverse=True)[:20]
+        user_names = await self.resolve_user_names([uid for uid, ratings in changes])
+        lines = ["%s: %s -> %s (%+d)" % (user_names[uid], old, new, new - old) for uid, (old, new) in changes]
+
+        if lines:
+            summary += "```\n%s\n```" % "\n".join(lines)
+        if changed_ratings and not apply:
+            summary += "Use 39!rerate apply to write these changes."
+
+        await ctx.send(summary[:2000])
+        self.log("Duel history replayed%s." % (" and written" if apply else ""))
+
     @commands.command()
     @commands.is_owner()
     async def add_channel(self, ctx, channel_id: int):
@@ -506,19 +589,17 @@ class Duel(robot39.Cog):
                 duel_channels.append(channel_id)
     
                 SQL = "UPDATE duel_settings SET duel_channels = %s WHERE guild_id = %s"
-                cursor = self.database.cursor()
 
                 try:
-                    cursor.execute(SQL, (duel_channels, self.guild_id))
+                    async with self.database.acquire() as connection:
+                        await connection.execute(SQL, (duel_channels, self.guild_id))
                     self.duel_channels.append(channel_id)
+                    self.sessions.set_channels(self.duel_channels)
                     await ctx.send("Duel channel added.")
 
                 except psycopg2.OperationalError as e:
                     self.log("Error adding duel channel:\n%s" % e)
 
-                finally:
-                    cursor.close()
-
     @commands.command()
     @commands.is_owner()
     async def remove_channel(self, ctx, channel_id: int):
@@ -531,19 +612,17 @@ class Duel(robot39.Cog):
             duel_channels.remove(channel_id)
 
             SQL = "UPDATE duel_settings SET duel_channels = %s WHERE guild_id = %s"
-            cursor = self.database.cursor()
 
             try:
-                cursor.execute(SQL, (duel_channels, self.guild_id))
+                async with self.database.acquire() as connection:
+                    await connection.execute(SQL, (duel_channels, self.guild_id))
                 self.duel_channels.remove(channel_id)
+                self.sessions.set_channels(self.duel_channels)
                 await ctx.send("Duel channel removed.")
 
             except psycopg2.OperationalError as e:
                 self.log("Error removing duel channel:\n%s" % e)
 
-            finally:
-                cursor.close()
-
     @commands.command()
     @commands.is_owner()
     async def duels(self, ctx):
@@ -561,7 +640,10 @@ class Duel(robot39.Cog):
             else 5 if mode == "bo9"\
             else 2
 
-        await self.process_duel_results(ctx, winner, loser, max_points)
+        if not await self.process_duel_results(ctx.channel, winner, loser, max_points):
+            await ctx.send("The result couldn't be recorded, please check the log and try again.")
+            return
+
         self.log("Victory forced in favor of %s vs %s." % (winner, loser))
 
     """
@@ -583,6 +665,10 @@ class Duel(robot39.Cog):
     ### !--- EVENTS ---! ###
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, payload):
+        #reactions to duel prompts
+        if self.reactions.dispatch(payload):
+            return
+
         if (not payload.message_id in self.dlc_msgs):
             return
 
@@ -612,32 +698,97 @@ class Duel(robot39.Cog):
             await self.update_dlc(payload.user_id, 'remove', self.dlc_dict[emoji])
     
     ### !--- TASKS ---! ###
-    @tasks.loop(minutes=1.0)
+    #publishes the rankings embed, but only when the standings have changed
+    #since the last edit so that changes between runs share a single edit
+    @tasks.loop(seconds=15.0)
     async def duel_loop(self):
-        duel_settings = await self.fetch_settings(self.guild_id)
+        #settings are read once, add_channel/remove_channel keep them current
+        if not self.settings_loaded:
+            duel_settings = await self.fetch_settings(self.guild_id)
+            if duel_settings == None:
+                return
 
-        self.rankings_channel = duel_settings[1]
-        self.rankings_message = duel_settings[2]
-        self.yes_emoji = duel_settings[3]
-        self.no_emoji = duel_settings[4]
-        self.duel_channels = duel_settings[5]
-        self.dlc_channel = duel_settings[6]
+            self.rankings_channel = duel_settings[1]
+            self.rankings_message = duel_settings[2]
+            self.yes_emoji = duel_settings[3]
+            self.no_emoji = duel_settings[4]
+            self.duel_channels = duel_settings[5]
+            self.dlc_channel = duel_settings[6]
+            self.sessions.set_channels(self.duel_channels)
+            self.settings_loaded = True
+
+        if not self.rankings_dirty:
+            return
 
         players = await self.fetch_players()
 
+        #wait for the player index rather than publishing empty rankings
+        if not self.players_loaded:
+            return
+        self.rankings_dirty = False
+
         #rankings embed
         embed = await self.generate_rankings_embed(players)
-        embed.set_footer(text="These rankings auto-update every minute")
+        embed.set_footer(text="These rankings auto-update after every duel")
+
+        #skip the edit if the embed would look exactly the same
+        if embed.to_dict() == self.rankings_embed:
+            return
+
+        #edit existing message in #rankings channel, fetching it only once
+        try:
+            if self.rankings_message_obj == None:
+                channel = self.bot.get_channel(self.rankings_channel)
+                self.rankings_message_obj = await channel.fetch_message(self.rankings_message)
+
+            await self.rankings_message_obj.edit(content = "", embed=embed)
+            self.rankings_embed = embed.to_dict()
 
-        #edit existing message in #rankings channel
-        channel = self.bot.get_channel(self.rankings_channel)
-        message = await channel.fetch_message(self.rankings_message)
-        await message.edit(content = "", embed=embed)
+        except discord.HTTPException as e:
+            self.log("Error updating rankings message:\n%s" % e)
+
+            #fetch the message again and retry on the next run
+            self.rankings_message_obj = None
+            self.rankings_dirty = True
 
     @duel_loop.before_loop
     async def before_duel_loop(self):
         await self.bot.wait_until_ready()
 
+    #pairs up players as their allowed ELO range widens or channels free up,
+    #and takes out anyone who has been waiting too long
+    @tasks.loop(seconds=10.0)
+    async def matchmaking_loop(self):
+        for uid in self.match_queue.expire(time.monotonic(), self.queue_timeout):
+            self.log("Player %s timed out of the queue." % uid)
+
+        if len(self.match_queue) > 1:
+            await self.matchmake()
+
+    @matchmaking_loop.before_loop
+    async def before_matchmaking_loop(self):
+        await self.bot.wait_until_ready()
+
+    #picks up every duel that was in progress when the cog was last unloaded
+    #or the bot last stopped, each from the step it had reached
+    async def resume_duels(self):
+        await self.bot.wait_until_ready()
+
+        #duel history must be ready to record results to before duels resume
+        await self.prepare_history()
+
+        #no new duels can start until this succeeds, so keep trying
+        sessions = await self.sessions.load()
+        while not self.sessions.loaded:
+            await asyncio.sleep(30)
+            sessions = await self.sessions.load()
+
+        for session in sessions:
+            self.start_duel(session, resumed=True)
+
+        if sessions:
+            self.log("Resumed %s duel(s) in progress." % len(sessions))
+
 
 def setup(bot):
     bot.add_cog(Duel(bot))
\ No newline at end of file
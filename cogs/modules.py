@@ -1,30 +1,94 @@
 import robot39
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import csv
 from datetime import date
 from enum import Enum
 from io import BytesIO
-from iteration_utilities import duplicates
+import json
 from natsort import natsorted
-from PIL import Image
 import psycopg2
 import random
+import re
+import time
 from typing import Union
 
+from cogs._modules_cards import CardCache
+from cogs._modules_catalog import ModuleCatalog
+from cogs._modules_drops import DropManager
+from cogs._modules_ledger import VPLedger, VPReason
+from cogs._modules_pack import CardPack
+from cogs._modules_scheduler import GuildDrops
+from cogs._modules_trade import Trade, execute_trade
+from cogs._modules_views import CollectionViews
 
+
+# Each action is its SQL statement and what it fetches: None, 'one' or 'all'
 class DatabaseAction(Enum):
-    add_player = "INSERT INTO modules (member_id, points) VALUES (%s, 0);"
-    mark_daily = "UPDATE modules SET last_daily = %s WHERE member_id = %s;"
-    fetch_user = "SELECT * FROM modules WHERE member_id = %s;"
-    add_vp = "UPDATE modules SET points = points + %s WHERE member_id = %s"
-    remove_vp = "UPDATE modules SET points = points - %s WHERE member_id = %s"
-    update_collection = "UPDATE modules SET collection = %s "\
-                        "WHERE member_id = %s"
-
-    def __init__(self, SQL):
+    # Statements that write to a player also register them if they aren't
+    # already, rather than needing a separate INSERT beforehand. This one
+    # only returns a row if the daily hadn't already been marked for the
+    # date, so of two redeems at once only one gets it
+    mark_daily = ("INSERT INTO modules (member_id, points, last_daily) "\
+                  "VALUES (%(uid)s, 0, %(value)s) "\
+                  "ON CONFLICT (member_id) "\
+                  "DO UPDATE SET last_daily = EXCLUDED.last_daily "\
+                  "WHERE modules.last_daily "\
+                  "IS DISTINCT FROM EXCLUDED.last_daily "\
+                  "RETURNING member_id;", 'one')
+    # Lets a daily that couldn't be given out be redeemed again
+    unmark_daily = ("UPDATE modules SET last_daily = NULL "\
+                    "WHERE member_id = %(uid)s "\
+                    "AND last_daily = %(value)s;", None)
+    # Collections are one row per owned module with a count of copies, so
+    # each change is a single statement on one row and returns the new count
+    add_module = ("WITH player AS ("\
+                  "INSERT INTO modules (member_id, points) "\
+                  "VALUES (%(uid)s, 0) ON CONFLICT (member_id) DO NOTHING) "\
+                  "INSERT INTO module_collection (member_id, module_id, count) "\
+                  "VALUES (%(uid)s, %(value)s, 1) "\
+                  "ON CONFLICT (member_id, module_id) "\
+                  "DO UPDATE SET count = module_collection.count + 1 "\
+                  "RETURNING count", 'one')
+    add_modules = ("WITH player AS ("\
+                   "INSERT INTO modules (member_id, points) "\
+                   "VALUES (%(uid)s, 0) ON CONFLICT (member_id) DO NOTHING) "\
+                   "INSERT INTO module_collection (member_id, module_id, count) "\
+                   "SELECT %(uid)s, module_id, count(*) "\
+                   "FROM unnest(%(value)s::text[]) AS added(module_id) "\
+                   "GROUP BY module_id "\
+                   "ON CONFLICT (member_id, module_id) "\
+                   "DO UPDATE SET count = module_collection.count "\
+                   "+ EXCLUDED.count;", None)
+    # Only removes a copy if one is owned; rows left at 0 are kept and
+    # ignored by every read so the row can be reused
+    remove_module = ("UPDATE module_collection SET count = count - 1 "\
+                     "WHERE member_id = %(uid)s AND module_id = %(value)s "\
+                     "AND count > 0 RETURNING count", 'one')
+    fetch_module_count = ("SELECT count FROM module_collection "\
+                          "WHERE member_id = %(uid)s "\
+                          "AND module_id = %(value)s AND count > 0;", 'one')
+    fetch_collection = ("SELECT module_id, count FROM module_collection "\
+                        "WHERE member_id = %(uid)s AND count > 0;", 'all')
+    # Only the spare copies beyond the first of each module
+    fetch_duplicates = ("SELECT module_id, count - 1 FROM module_collection "\
+                        "WHERE member_id = %(uid)s AND count > 1;", 'all')
+    # Number of different modules owned in each set
+    fetch_set_counts = ("SELECT left(module_id, 3), count(*) "\
+                        "FROM module_collection "\
+                        "WHERE member_id = %(uid)s AND count > 0 "\
+                        "GROUP BY left(module_id, 3);", 'all')
+
+    def __init__(self, SQL, fetch):
         self.SQL = SQL
+        self.fetch = fetch
+        # Whether running the statement leaves the player registered
+        self.registers = "INSERT INTO modules " in SQL
+        # Whether running the statement can change the player's collection
+        self.changes_collection = "module_collection" in SQL\
+                                  and not SQL.startswith("SELECT")
 
 
 class Modules(robot39.Cog):
@@ -32,22 +96,56 @@ class Modules(robot39.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-        # Access bot database connection
-        if bot.database:
-            self.database = bot.database.connection
-        else:
+        # Cog cannot load without the database cog
+        if not bot.database:
             raise commands.ExtensionFailed
 
-        self.modules_dict = {}
-        self.active_drops = {}
-        self.message_count = {}
-        self.player_ids = []
+        self.player_ids = set()
 
+        # Default drop channel and drop rate, for servers without their own
+        # settings in drop_settings_file
         self.drop_channel_id = 799282021725110282
-        
         self.min_msgs_before_drop = 20
         self.initial_drop_percent = 5
 
+        # IDs of servers whose messages count towards drops, or None for all
+        self.drop_guild_ids = None
+
+        # Per server drop settings, e.g. {"<guild id>": {"channel_id": ...,
+        # "model": "ewma", "drops_per_hour": 4}}; see cogs/_modules_scheduler
+        self.drop_settings = {}
+        self.drop_settings_file = "data/modules_drops.json"
+        self.load_drop_settings()
+
+        # Drop schedulers for each server, created on their first message
+        self.guild_drops = {}
+
+        # Seconds a drop can be redeemed for (None for no limit), and how
+        # many drops each server can have waiting to be redeemed at once
+        self.drop_ttl = 3600.0
+        self.max_drops_per_guild = 1
+
+        # Seconds a collection listing can be paged through with reactions
+        self.collection_paging_timeout = 300.0
+
+        # Seconds a player has to accept a trade offered to them
+        self.trade_timeout = 120.0
+
+        # VP changes are written to the database every vp_flush_interval
+        # seconds, or sooner once vp_flush_size changes are waiting
+        self.vp_flush_interval = 10.0
+        self.vp_flush_size = 100
+
+        # Memory budget for rendered module cards, in bytes
+        self.card_cache_size = 64 * 1024 * 1024
+
+        # Workers used to render cards, as threads or optionally processes
+        self.card_render_workers = 2
+        self.card_render_processes = False
+
+        # Pack of pre-rendered cards made with python -m cogs._modules_pack
+        self.card_pack_file = 'data/modules/cards.pack'
+
         # List of CSV files to load module info from at load
         self.csv_list = [
             'etc',
@@ -71,6 +169,7 @@ class Modules(robot39.Cog):
         }
 
         # Read module info from CSV files
+        module_sets = {}
         for csv_file in self.csv_list:
             try:
                 # Open each csv file with a csv.DictReader and append each row
@@ -79,314 +178,624 @@ class Modules(robot39.Cog):
                           % csv_file, newline='', encoding='utf-8')\
                           as modules_file:
                     reader = csv.DictReader(modules_file)
-                    self.modules_dict[csv_file] = []
+                    module_sets[csv_file] = []
                     for row in reader:
-                        self.modules_dict[csv_file].append(row)
+                        module_sets[csv_file].append(row)
 
                 # Print how many entries are loaded from each CSV file
                 self.log("Info loaded from %s.csv for %s module(s)"
-                         % (csv_file, len(self.modules_dict[csv_file])))
+                         % (csv_file, len(module_sets[csv_file])))
 
             except Exception as e:
                 self.log("Error reading modules data from %s.csv\n%s"
                          % (csv_file, e))
+
+        # Every module's info, looked up by module_id
+        self.catalog = ModuleCatalog(module_sets)
+
+        # Modules dropped in each server and waiting to be redeemed, and
+        # drops waiting to be posted by the background drop worker
+        self.drops = DropManager(ttl=self.drop_ttl,
+                                 max_drops=self.max_drops_per_guild)
+        self.drop_queue = asyncio.Queue()
+        self.drop_worker = self.bot.loop.create_task(self.post_drops())
+
+        # Collection listings kept until the player's collection changes,
+        # and the state of listing messages that can be paged through,
+        # keyed by message ID
+        self.collection_views = CollectionViews(self.catalog)
+        self.collection_paging = {}
         
-        # Cache all current user IDs from database
-        self.update_player_ids()
+        # Rendered module cards, kept in memory and in data/modules/cache
+        # and rendered away from the event loop when missing from both
+        if self.card_render_processes:
+            self.card_executor = ProcessPoolExecutor(
+                max_workers=self.card_render_workers)
+        else:
+            self.card_executor = ThreadPoolExecutor(
+                max_workers=self.card_render_workers,
+                thread_name_prefix='cards')
 
-    ### !--- METHODS ---! ###
-    # Caches list of currently registered Discord user IDs in database
-    def update_player_ids(self):
-        SQL = "SELECT member_id from modules;"
-        cursor = self.database.cursor()
+        self.card_cache = CardCache('data/modules', 'data/modules/cache',
+                                    self.card_cache_size, self.card_executor)
 
+        # Memory-map the pack of pre-rendered cards if one has been built
+        # with python -m cogs._modules_pack, otherwise rely on the cache
+        self.card_pack = None
         try:
-            cursor.execute(SQL)
-            sql_output = cursor.fetchall()
+            self.card_pack = CardPack(self.card_pack_file)
+            self.log("Loaded %s card(s) from %s"
+                     % (len(self.card_pack), self.card_pack_file))
 
-            # The database returns a list of lists, only
-            # the first element in each list is desired
-            player_ids = [id[0] for id in sql_output]
-            self.player_ids = player_ids
+        except FileNotFoundError:
+            pass
 
-        except psycopg2.Error as e:
-                self.log("Error fetching member IDs from database:\n%s" % e)
+        except (OSError, ValueError) as e:
+            self.log("Error loading card pack %s:\n%s"
+                     % (self.card_pack_file, e))
 
-        finally:
-            cursor.close()
+        # Player VP, cached and written to the database in batches
+        self.vp_ledger = VPLedger(bot, self.log, self.vp_flush_size)
+        self.flush_vp_ledger.change_interval(seconds=self.vp_flush_interval)
+        self.flush_vp_ledger.start()
 
-    # Splits a module_id into its set and number components
-    # For module_id 'mik-123': 'mik' is the set, '123' is the number
-    async def split_module_id(self, module_id: str) -> dict:
-        module_set = module_id[0:3]
-        module_number = int(module_id[4:])
+        # Move any old collection arrays into the collection table, then
+        # cache all current user IDs from database once the bot is running
+        self.bot.loop.create_task(self.prepare_database())
 
-        module = {
-            'set': module_set,
-            'number': module_number
-        }
-        return module
+    # Stops the drop worker and card render workers and writes any
+    # unsaved VP changes if the cog is unloaded
+    def cog_unload(self):
+        self.drop_worker.cancel()
+        self.card_executor.shutdown(wait=False)
 
-    # Fetches the info for a given module_id including
-    # its set, number, English name and Japanese name
-    async def fetch_module_info(self, module_id: str) -> dict:
-        module = await self.split_module_id(module_id)
+        # A flush underway is left to finish rather than cancelled part way
+        # through, as close() waits for it before writing what's left
+        self.flush_vp_ledger.stop()
+        self.vp_ledger.close()
 
-        # Get other module info from info that was read
-        # from the CSV files and add to the dictionary
-        module_info = self.modules_dict[module['set']][module['number']-1]
-        module['ENG Name'] = module_info['ENG Name']
-        module['JP Name'] = module_info['JP Name']
+    ### !--- METHODS ---! ###
+    # Loads the per server drop settings from self.drop_settings_file;
+    # Only called when cog is loaded
+    def load_drop_settings(self):
+        try:
+            settings_json = open(self.drop_settings_file, "r")
+            settings_string = settings_json.read()
+
+            # Only decode the JSON if it isn't empty
+            if settings_string:
+                try:
+                    self.drop_settings = json.loads(settings_string)
+
+                # Cog will not load if it can't be decoded
+                except json.JSONDecodeError:
+                    self.log("Error decoding contents of %s, cannot load cog"
+                             % self.drop_settings_file[5:])
+                    raise commands.ExtensionFailed
+
+            self.log("Loaded drop settings for %s server(s)"
+                     % len(self.drop_settings))
+
+        except OSError:
+            # Create settings file if it's missing
+            self.log("Error opening %s for reading, this file will be created"
+                     % self.drop_settings_file[5:])
+            try:
+                settings_json = open(self.drop_settings_file, "w")
 
-        return module
+            # Cog will not load if it can't find/create settings file
+            except OSError:
+                self.log("Error creating %s, cannot load cog"
+                         % self.drop_settings_file[5:])
+                raise commands.ExtensionFailed
 
-    # Checks if a module_id is valid and that the module exists
-    async def is_valid_module_id(self, module_id: str) -> bool:
-        # The module_id must have a hyphen in position 4
-        # and be between 5 and 7 characters total length
-        if (not module_id[3] == '-'
-                or not (len(module_id) >=5 and len(module_id) <=7)):
+        settings_json.close()
+
+    # Saves the settings currently in self.drop_settings
+    # to self.drop_settings_file
+    async def save_drop_settings(self) -> bool:
+        # Attempt to open settings JSON for writing
+        try:
+            settings_json = open(self.drop_settings_file, "w")
+
+        # Return False if file can't be opened or created
+        except OSError:
+            self.log("Error saving settings to %s!"
+                     % self.drop_settings_file[5:])
             return False
 
-        module = await self.split_module_id(module_id)
+        # Encode the settings to JSON format and save the file
+        settings_string = json.dumps(self.drop_settings, indent=4)
+        settings_json.write(settings_string)
+        settings_json.close()
+        return True
+
+    # Creates the drop scheduler for a server from its settings, falling
+    # back to the default linear model if it has none or they're invalid
+    def create_guild_drops(self, guild_id: int) -> GuildDrops:
+        default_settings = {
+            'model': 'linear',
+            'min_messages': self.min_msgs_before_drop,
+            'initial_percent': self.initial_drop_percent
+        }
+
+        try:
+            guild_drops = GuildDrops(
+                self.drop_settings.get(str(guild_id), default_settings))
+
+        except ValueError as e:
+            self.log("Invalid drop settings for server %s, using defaults:\n%s"
+                     % (guild_id, e))
+            guild_drops = GuildDrops(default_settings)
+
+        self.guild_drops[guild_id] = guild_drops
+        return guild_drops
+
+    # Always reach the currently loaded database cog so that reloading it
+    # doesn't leave this cog holding on to a closed connection pool
+    @property
+    def database(self):
+        return self.bot.database
+
+    # Readies the database for use by this cog
+    async def prepare_database(self):
+        await self.migrate_collections()
+        await self.vp_ledger.prepare()
+        await self.update_player_ids()
+
+    # Creates the collection table if needed and moves every collection still
+    # stored as an array in modules.collection into it; arrays are emptied in
+    # the same transaction, so running this again only moves new arrays.
+    # Also stops VP going negative, which trades rely on, only altering the
+    # table the first time as that locks it, and makes member_id
+    # unique so that players can be registered by their first change; each
+    # is a separate step so one failing doesn't hold back the others
+    async def migrate_collections(self):
+        SQL = "CREATE TABLE IF NOT EXISTS module_collection ("\
+              "member_id bigint NOT NULL, "\
+              "module_id text NOT NULL, "\
+              "count integer NOT NULL DEFAULT 0 CHECK (count >= 0), "\
+              "PRIMARY KEY (member_id, module_id)); "\
+              "CREATE INDEX IF NOT EXISTS module_collection_duplicates "\
+              "ON module_collection (member_id) WHERE count > 1; "\
+              "INSERT INTO module_collection (member_id, module_id, count) "\
+              "SELECT member_id, module_id, count(*) "\
+              "FROM modules, unnest(collection) AS owned(module_id) "\
+              "GROUP BY member_id, module_id "\
+              "ON CONFLICT (member_id, module_id) "\
+              "DO UPDATE SET count = module_collection.count "\
+              "+ EXCLUDED.count; "\
+              "UPDATE modules SET collection = NULL "\
+              "WHERE collection IS NOT NULL; "\
+              "DO $$ BEGIN "\
+              "IF NOT EXISTS (SELECT 1 FROM pg_constraint "\
+              "WHERE conrelid = 'modules'::regclass "\
+              "AND conname = 'modules_points_check') THEN "\
+              "ALTER TABLE modules ADD CONSTRAINT modules_points_check "\
+              "CHECK (points >= 0) NOT VALID; "\
+              "END IF; END $$;"
+
+        # Players registered more than once are merged into a single row
+        # first, keeping their highest VP and latest daily; every row was
+        # updated alike, and their collections have already been combined
+        UNIQUE_SQL = "WITH players AS ("\
+                     "SELECT ctid AS row_id, member_id, "\
+                     "row_number() OVER (PARTITION BY member_id) AS copy, "\
+                     "count(*) OVER (PARTITION BY member_id) AS copies, "\
+                     "max(points) OVER (PARTITION BY member_id) AS points, "\
+                     "max(last_daily) OVER (PARTITION BY member_id) "\
+                     "AS last_daily FROM modules), "\
+                     "merged AS ("\
+                     "UPDATE modules SET points = players.points, "\
+                     "last_daily = players.last_daily FROM players "\
+                     "WHERE modules.ctid = players.row_id "\
+                     "AND players.copy = 1 AND players.copies > 1) "\
+                     "DELETE FROM modules USING players "\
+                     "WHERE modules.ctid = players.row_id "\
+                     "AND players.copy > 1; "\
+                     "CREATE UNIQUE INDEX IF NOT EXISTS modules_member_id "\
+                     "ON modules (member_id);"
+
+        try:
+            async with self.database.acquire() as connection:
+                await connection.transaction(
+                    SQL, label="Modules.migrate_collections")
+
+        except psycopg2.Error as e:
+            self.log("Error migrating module collections:\n%s" % e)
+
+        try:
+            async with self.database.acquire() as connection:
+                await connection.transaction(
+                    UNIQUE_SQL, label="Modules.unique_players")
+
+        except psycopg2.Error as e:
+            self.log("Error making player IDs unique:\n%s" % e)
+
+    # Caches list of currently registered Discord user IDs in database
+    async def update_player_ids(self):
+        SQL = "SELECT member_id from modules;"
+
+        try:
+            async with self.database.acquire() as connection:
+                sql_output = await connection.fetchall(SQL)
 
-        # Check if module set exists and module number exists within that set
-        if (module['set'] in self.modules_dict
-                and module['number']-1 \
-                <= len (self.modules_dict[module['set']])):
-            return True
+            # The database returns a list of lists, only
+            # the first element in each list is desired
+            self.player_ids = {id[0] for id in sql_output}
 
-        # Not a valid module_id
-        return False
+        except psycopg2.Error as e:
+                self.log("Error fetching member IDs from database:\n%s" % e)
+
+    # Checks if a module_id is valid and that the module exists
+    async def is_valid_module_id(self, module_id: str) -> bool:
+        return module_id in self.catalog
 
     # Executes all database actions used by other methods in this cog,
     # using SQL statements defined in the DatabaseAction enum
     async def database_action(self, action: DatabaseAction, uid: int,
                               value: Union[str, list, int] = None):
         # Prepare data to be used in query
-        data = (value, uid)
-        if action == DatabaseAction.add_player\
-                or action == DatabaseAction.fetch_user:
-            data = (uid,)
+        data = {'uid': uid, 'value': value}
 
-        # Execute database action
-        cursor = self.database.cursor()
+        # Execute database action on a pooled connection, only fetching
+        # rows back if the statement returns any
         try:
-            cursor.execute(action.SQL, data)
+            async with self.database.acquire() as connection:
+                result = await connection.run(action.SQL, data,
+                                              fetch=action.fetch,
+                                              label=str(action))
+
+            # Add the Discord user ID to cache if the player was registered
+            if action.registers:
+                self.player_ids.add(uid)
 
-            # Add the Discord user ID to cache if a new player was registered
-            if action == DatabaseAction.add_player:
-                self.player_ids.append(uid)
+            # Have the player's collection listings rebuilt if it changed
+            if action.changes_collection:
+                self.collection_views.changed(uid)
 
-            # Return the fetched info if database was queried for player info
-            elif action == DatabaseAction.fetch_user:
-                return cursor.fetchone()
+            # Return the fetched row(s) if the statement returned any
+            if action.fetch:
+                return result
 
         except psycopg2.Error as e:
                 self.log("Error executing database action '%s':\n%s"
                          % (action, e))
 
-        finally:
-            cursor.close()
+    # Marks a player's daily as redeemed for date in the database, returning
+    # True if it wasn't already, False if it was or None on a database error
+    async def mark_daily_as_redeemed(self, uid: int, date: str) -> bool:
+        action = DatabaseAction.mark_daily
 
-    # Adds guild member to the player database to start tracking collection
-    async def add_player_by_uid(self, uid: int):
-        await self.database_action(DatabaseAction.add_player, uid)
+        try:
+            async with self.database.acquire() as connection:
+                player = await connection.fetchone(
+                    action.SQL, {'uid': uid, 'value': date},
+                    label=str(action))
 
-    # Marks a player's daily as redeemed in the database
-    async def mark_daily_as_redeemed(self, uid: int, date: str):
-        # Do nothing if uid is not registered
-        if not uid in self.player_ids:
-            return
+        except psycopg2.Error as e:
+            self.log("Error executing database action '%s':\n%s"
+                     % (action, e))
+            return None
 
-        await self.database_action(DatabaseAction.mark_daily, uid, date)
+        self.player_ids.add(uid)
+        return player != None
 
-    # Fetches player info from database by given Discord user ID
-    async def fetch_player_info_by_uid(self, uid: int):
-        # Return None if uid is known to not be registered (not cached)
-        if not uid in self.player_ids:
+    # Adds or removes a module (module_id) from a player (uid), returning
+    # the number of copies now owned or None if nothing was changed
+    async def manage_player_collection(self, uid: int,
+                                       module_id: str, action: str) -> int:
+        # Do nothing as a player who isn't registered has no modules to remove
+        if action == "remove_module" and not uid in self.player_ids:
             return None
 
-        return await self.database_action(DatabaseAction.fetch_user, uid)
+        # Add module_id to, or remove one copy of it from, the
+        # player's collection with a single statement
+        if action == "add_module":
+            player = await self.database_action(DatabaseAction.add_module,
+                                                uid, module_id)
+        elif action == "remove_module":
+            player = await self.database_action(DatabaseAction.remove_module,
+                                                uid, module_id)
 
-    # Adds or removes a module (module_id) from a player (uid)
-    async def manage_player_collection(self, uid: int,
-                                       module_id: str,action: str):
-        # Register user if uid is not in the cache
-        if not uid in self.player_ids:
-            await self.add_player_by_uid(uid)
+        return player[0] if player else None
 
-            # Do nothing as the newly registered player has no modules to remove
-            if action == "remove_module":
-                return
+    # Adds a module (module_id) to a player (uid), returning whether it was
+    async def add_module_to_player(self, uid: int, module_id: str) -> bool:
+        count = await self.manage_player_collection(uid, module_id,
+                                                    action="add_module")
+        if count == None:
+            return False
 
-        # Get player info and current module collection
-        player = await self.fetch_player_info_by_uid(uid)
-        player_modules = player[3]
+        user = self.bot.get_user(uid)
+        self.log("Added %s to %s" % (module_id, user))
+        return True
 
-        # Return if player collection is already empty, or initialise empty list
-        # for adding a module to an empty collection
-        if not type(player_modules) == list:
-            if action == "remove_module": return
-            else: player_modules = []
+    # Adds several modules (module_ids) to a player (uid) at once
+    async def add_modules_to_player(self, uid: int, module_ids: list):
+        await self.database_action(DatabaseAction.add_modules, uid, module_ids)
 
-        # Add module_id to the player's collection
-        if action == "add_module":
-            player_modules.append(module_id)
+        user = self.bot.get_user(uid)
+        self.log("Added %s to %s" % (", ".join(module_ids), user))
+
+    # Adds modules to many players with one statement, given a list
+    # of (uid, module_id) grants, registering any new players
+    async def grant_modules(self, grants: list):
+        SQL = "WITH players AS ("\
+              "INSERT INTO modules (member_id, points) "\
+              "SELECT DISTINCT uid, 0 FROM unnest(%(uids)s::bigint[]) AS uid "\
+              "ON CONFLICT (member_id) DO NOTHING) "\
+              "INSERT INTO module_collection (member_id, module_id, count) "\
+              "SELECT uid, module_id, count(*) "\
+              "FROM unnest(%(uids)s::bigint[], %(module_ids)s::text[]) "\
+              "AS grants(uid, module_id) "\
+              "GROUP BY uid, module_id "\
+              "ON CONFLICT (member_id, module_id) "\
+              "DO UPDATE SET count = module_collection.count + EXCLUDED.count;"
 
-        # Or remove module_id from the player's collection if it exists
-        elif action == "remove_module":
-            if not module_id in player_modules: return
-            else: player_modules.remove(module_id)
+        try:
+            async with self.database.acquire() as connection:
+                await connection.execute(
+                    SQL, {'uids': [uid for uid, module_id in grants],
+                          'module_ids': [module_id
+                                         for uid, module_id in grants]},
+                    label="Modules.grant_modules")
 
-        # Commit updated player collection to database
-        await self.database_action(DatabaseAction.update_collection,
-                                   uid, player_modules)
+        except psycopg2.Error as e:
+            self.log("Error granting modules:\n%s" % e)
+            return
 
-    # Adds a module (module_id) to a player (uid)
-    async def add_module_to_player(self, uid: int, module_id: str):
-        await self.manage_player_collection(uid, module_id, action="add_module")
+        for uid in {uid for uid, module_id in grants}:
+            self.player_ids.add(uid)
+            self.collection_views.changed(uid)
 
-        user = self.bot.get_user(uid)
-        self.log("Added %s to %s" % (module_id, user))
+        self.log("Granted %s module(s) to %s player(s)"
+                 % (len(grants), len({uid for uid, module_id in grants})))
 
-    # Removes a module (module_id) from a player (uid)
-    async def remove_module_from_player(self, uid: int, module_id: str):
-        await self.manage_player_collection(uid, module_id,
-                                            action="remove_module")
+    # Removes a module (module_id) from a player (uid), returning
+    # whether the player had a copy of it to remove
+    async def remove_module_from_player(self, uid: int, module_id: str) -> bool:
+        count = await self.manage_player_collection(
+                    uid, module_id, action="remove_module")
+        if count == None:
+            return False
 
         user = self.bot.get_user(uid)
         self.log("Removed %s from %s" % (module_id, user))
+        return True
     
-    # Adds VP amount to player's current total
-    async def add_vp_to_player(self, uid: int, amount: int):
-        await self.database_action(DatabaseAction.add_vp, uid, amount)
+    # Runs a trade between players as a single statement, returning
+    # whether it went through; it won't if a player no longer has
+    # everything they're giving away
+    async def run_trade(self, trade: Trade) -> bool:
+        # Hold the balances of players trading VP so the ledger
+        # stays in step with what the trade writes
+        vp_players = {uid for uid, delta in trade.points.items() if delta}
+
+        try:
+            async with self.vp_ledger.hold(vp_players):
+                async with self.database.acquire() as connection:
+                    balances = await execute_trade(connection, trade)
+
+                for member_id, module_id, amount in balances:
+                    if module_id == None:
+                        self.vp_ledger.refresh(member_id, amount)
+
+        except psycopg2.IntegrityError:
+            return False
+
+        except psycopg2.Error as e:
+            self.log("Error running trade:\n%s" % e)
+            return False
+
+        # Players receiving something are registered by the trade itself
+        self.player_ids.update(member_id
+                               for member_id, module_id, amount in balances)
+
+        for uid, module_id in trade.modules:
+            self.collection_views.changed(uid)
+
+        return True
+
+    # Reads one side of a trade, e.g. ('mik-1', 'mik-1', '500vp'),
+    # into a VP amount and list of module_ids, or None if invalid
+    async def parse_trade_items(self, items: tuple) -> tuple:
+        vp_amount = 0
+        module_ids = []
+
+        for item in items:
+            vp_match = re.fullmatch(r'(\d+)vp', item.lower())
+            if vp_match:
+                vp_amount += int(vp_match.group(1))
+            elif await self.is_valid_module_id(item):
+                module_ids.append(item)
+            else:
+                return None
+
+        return vp_amount, module_ids
+
+    # Describes one side of a trade for the trade embed
+    async def describe_trade_items(self, vp_amount: int,
+                                   module_ids: list) -> str:
+        lines = []
+        for module_id in natsorted(set(module_ids)):
+            module = self.catalog[module_id]
+            count = module_ids.count(module_id)
+            lines.append("• %s -- %s%s" % (module_id, module.eng_name,
+                                           " (x%s)" % count
+                                           if count > 1 else ""))
+        if vp_amount:
+            lines.append("• %s VP" % vp_amount)
+
+        return "\n".join(lines) if lines else "Nothing"
+
+    # Adds VP amount to player's current total, registering them
+    # when the change is written if they're a new player
+    async def add_vp_to_player(self, uid: int, amount: int,
+                               reason: VPReason):
+        self.vp_ledger.credit(uid, amount, reason)
+        self.player_ids.add(uid)
 
         user = self.bot.get_user(uid)
         self.log("Added %s VP to %s" % (amount, user))
 
-    # Removes VP amount from player's current total
-    async def remove_vp_from_player(self, uid: int, amount: int):
-        await self.database_action(DatabaseAction.remove_vp, uid, amount)
+    # Removes VP amount from player's current total, returning whether
+    # they had enough VP for it to be removed, or None if their balance
+    # couldn't be read
+    async def remove_vp_from_player(self, uid: int, amount: int,
+                                    reason: VPReason) -> bool:
+        try:
+            if not await self.vp_ledger.debit(uid, amount, reason):
+                return False
+
+        except psycopg2.Error as e:
+            self.log("Error removing %s VP from %s:\n%s" % (amount, uid, e))
+            return None
 
         user = self.bot.get_user(uid)
         self.log("Removed %s VP from %s" % (amount, user))
+        return True
 
     # Rolls a random valid module_id
-    async def roll_module_id(self, module_set: str = None) -> str:
-        # Roll random set if not specified, weighting each set by
-        # size to give each module an even chance of being rolled
+    def roll_module_id(self, module_set: str = None) -> str:
+        # Roll from every module if no set is specified, giving
+        # each module an even chance of being rolled
         if not module_set:
-            set_weights = [len(self.modules_dict[each_module_set])
-                           for each_module_set in self.csv_list]
-            module_set = random.choices(
-                           self.csv_list, weights=set_weights, k=1)[0]
+            return random.choice(self.catalog.modules).id
 
         # Roll random valid ID from the chosen set
-        random_module = random.randint(1, len(self.modules_dict[module_set]))
-        module_id = "%s-%s" % (module_set, random_module)
-        return module_id
+        return random.choice(self.catalog.sets[module_set]).id
 
     # Prepares an image of a module (module_id) to be posted to Discord
     async def get_module_file(self, module_id: str) -> discord.File:
-        module = await self.split_module_id(module_id)
+        # Serve the card straight from the pre-built pack if it's in there
+        if self.card_pack and module_id in self.card_pack:
+            return discord.File(self.card_pack.open_card(module_id),
+                                filename=self.card_pack.filename)
 
-        # File paths to module images and module background
-        module_image = "data/modules/%s/%s.png"\
-                       % (module['set'], module['number'])
-        card_back = "data/modules/back-%s.png" % module['set']
+        module = self.catalog[module_id]
 
-        # Open the two images with Pillow and paste
-        # the module over the background image
+        # Get the module pasted over its background image, which is
+        # only rendered with Pillow if it isn't already cached
         try:
-            top_image = Image.open(module_image)
-            bg_image = Image.open(card_back)
+            card = await self.card_cache.load(module.set, module.number)
 
         except FileNotFoundError:
-            self.log("Image file(s) not found for module %s" % module)
+            self.log("Image file(s) not found for module %s" % module_id)
             return
 
-        bg_image.paste(top_image,(0, 0), top_image)
-
-        # Save the new image to memory and pass it
-        # to a Discord File object to return
-        modified_image = BytesIO()
-        bg_image.save(modified_image, format='png')
-        modified_image.seek(0)
-        file = discord.File(modified_image, filename="image.png")
+        # Pass the finished image to a Discord File object to return
+        file = discord.File(BytesIO(card), filename="image.png")
 
         return file
 
-    # Prepares embed containing module image and information to post to Discord
-    async def fill_module_embed(self, module_id: str,
-                                embed: discord.Embed) -> discord.Embed:
-        module = await self.fetch_module_info(module_id)
+    # Prepares embed containing module image and information to post to
+    # Discord, pointing at the attached module image file
+    async def fill_module_embed(self, module_id: str, embed: discord.Embed,
+                                file: discord.File = None) -> discord.Embed:
+        module = self.catalog[module_id]
 
-        embed.set_image(url="attachment://image.png")
+        filename = file.filename if file else "image.png"
+        embed.set_image(url="attachment://%s" % filename)
         embed.set_footer(text="Module ID: %s" % module_id)
-        embed.add_field(name=module['ENG Name'], value=module['JP Name'],
+        embed.add_field(name=module.eng_name, value=module.jp_name,
                 inline=False)
 
         return embed
 
+    # Returns pages listing a player's collection, or only their duplicates,
+    # which are only fetched again if the collection has changed
+    async def fetch_collection_pages(self, uid: int,
+                                     duplicates_only: bool) -> list:
+        pages = self.collection_views.get(uid, duplicates_only)
+        if pages != None:
+            return pages
+
+        # Fetch (module_id, count) rows for the player's collection,
+        # or only the spare copies if displaying duplicates
+        version = self.collection_views.version(uid)
+        action = DatabaseAction.fetch_duplicates if duplicates_only\
+                     else DatabaseAction.fetch_collection
+        player_collection = await self.database_action(action, uid)
+
+        # Don't keep anything if the query failed
+        if player_collection == None:
+            return []
+
+        return self.collection_views.build(uid, duplicates_only,
+                                           player_collection, version)
+
+    # Creates the embed showing a page of a player's collection listing
+    def create_collection_embed(self, pages: list, page_number: int,
+                                duplicates_only: bool,
+                                avatar_url: str) -> discord.Embed:
+        embed_title = "Module Collection List"
+        command_name = "39!collection"
+
+        # Change embed text to match command used
+        if duplicates_only:
+            embed_title = "Module Duplicates List"
+            command_name = "39!duplicates"
+
+        embed = discord.Embed(title=embed_title, color=0x80ffff)
+        embed.set_thumbnail(url=avatar_url)
+        embed.set_footer(
+            text="Viewing page %s of %s\n"
+                 "React to turn the page, or add a page number after %s"
+                 % (page_number, len(pages), command_name))
+        embed.add_field(name="Modules:", value=pages[page_number-1],
+                        inline=False)
+
+        return embed
+
     async def display_player_collection(self, ctx, page_number: int = 1,
                                         duplicates_only: bool = False):
-        # Register new player if Discord user ID is not in the cache,
-        # then return as they have no collection
+        # Return if Discord user ID is not in the cache as they have
+        # no collection; they're registered by their first module
         if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
             return
 
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
-        player_collection = player_info[3]
+        pages = await self.fetch_collection_pages(ctx.author.id,
+                                                  duplicates_only)
 
         # Do nothing if collection is empty
-        if not player_collection:
+        if not pages:
             return
 
-        embed_title = "Module Collection List"
-        command_name = "39!collection"
-
-        # If displaying only duplicates, filter the player
-        # collection and check that there are any
-        if duplicates_only:
-            player_collection = list(duplicates(player_collection))
-            if not player_collection:
-                return
-
-            # Change embed text to match command used
-            embed_title = "Module Duplicates List"
-            command_name = "39!duplicates"
-
-        # Sort player collection and split into pages of 20
-        player_collection = natsorted(player_collection)
-        pages = [player_collection[i:i + 20]
-                 for i in range(0, len(player_collection), 20)]
-
         # Default to page 1 if page doesn't exist
         if page_number > len(pages) or page_number < 1:
             page_number = 1
 
-        # Create player collection embed
-        embed = embed=discord.Embed(title=embed_title, color=0x80ffff)
-        embed.set_thumbnail(url=ctx.author.avatar_url)
-        embed.set_footer(
-            text="Viewing page %s of %s\n"
-                 "Add a page number after %s to view other pages"
-                 % (page_number, len(pages), command_name))
+        # Create and send player collection embed
+        avatar_url = str(ctx.author.avatar_url)
+        embed = self.create_collection_embed(pages, page_number,
+                                             duplicates_only, avatar_url)
+        message = await ctx.send(embed=embed)
 
-        # Loop through selected page and append module_id + English name to
-        # string for use in embed
-        module_list = ""
-        for module_id in pages[page_number-1]:
-            module = await self.fetch_module_info(module_id)
-            module_list += "• %s -- %s\n" % (module_id, module['ENG Name'])
+        if len(pages) == 1:
+            return
 
-        embed.add_field(name="Modules:", value=module_list, inline=False)
-        await ctx.send(embed=embed)
+        # Let the player turn pages by reacting, forgetting about
+        # listings that can no longer be paged through
+        now = time.monotonic()
+        self.collection_paging = {
+            message_id: paging
+            for message_id, paging in self.collection_paging.items()
+            if paging['expires'] > now}
+        self.collection_paging[message.id] = {
+            'uid': ctx.author.id,
+            'duplicates_only': duplicates_only,
+            'page': page_number,
+            'avatar_url': avatar_url,
+            'expires': now + self.collection_paging_timeout
+        }
+
+        await message.add_reaction("◀️")
+        await message.add_reaction("▶️")
 
     ### !--- COMMANDS ---! ###
-    # Adds module (module_id) to player (uid)
+    # Adds module (module_id) to player (uid), or several at once if given
+    # as a comma separated list, e.g. 39!add_module mik-1,rin-2 @user
     @commands.command()
     @commands.check_any(commands.is_owner(),
                         commands.has_guild_permissions(administrator=True))
@@ -396,7 +805,27 @@ class Modules(robot39.Cog):
             uid = user.id
         else: uid = user
 
-        await self.add_module_to_player(uid, module_id)
+        module_ids = module_id.split(",")
+        if len(module_ids) > 1:
+            await self.add_modules_to_player(uid, module_ids)
+        else:
+            await self.add_module_to_player(uid, module_id)
+
+        confirm_emoji = self.bot.get_emoji(741503456212418660)
+        await ctx.message.add_reaction(confirm_emoji)
+
+    # Adds a module (module_id) to every mentioned player at once,
+    # e.g. 39!grant_module mik-1 @user1 @user2
+    @commands.command()
+    @commands.check_any(commands.is_owner(),
+                        commands.has_guild_permissions(administrator=True))
+    async def grant_module(self, ctx, module_id: str,
+                           users: commands.Greedy[discord.Member]):
+        if not users:
+            await ctx.reply("Please mention the players to give it to.")
+            return
+
+        await self.grant_modules([(user.id, module_id) for user in users])
 
         confirm_emoji = self.bot.get_emoji(741503456212418660)
         await ctx.message.add_reaction(confirm_emoji)
@@ -411,7 +840,7 @@ class Modules(robot39.Cog):
             uid = user.id
         else: uid = user
 
-        await self.add_vp_to_player(uid, amount)
+        await self.add_vp_to_player(uid, amount, reason=VPReason.admin)
 
         confirm_emoji = self.bot.get_emoji(741503456212418660)
         await ctx.message.add_reaction(confirm_emoji)
@@ -441,11 +870,87 @@ class Modules(robot39.Cog):
             uid = user.id
         else: uid = user
 
-        await self.remove_vp_from_player(uid, amount)
+        await self.remove_vp_from_player(uid, amount, reason=VPReason.admin)
 
         confirm_emoji = self.bot.get_emoji(741503456212418660)
         await ctx.message.add_reaction(confirm_emoji)
 
+    # Shows the drop settings for the server, or changes one of them if a
+    # setting and value are given, e.g. 39!drop_settings model ewma;
+    # a value of 'default' removes a setting and 'reset' removes them all
+    @commands.command()
+    @commands.guild_only()
+    @commands.check_any(commands.is_owner(),
+                        commands.has_guild_permissions(administrator=True))
+    async def drop_settings(self, ctx, setting: str = None,
+                            value: str = None):
+        guild_settings = dict(self.drop_settings.get(str(ctx.guild.id), {}))
+
+        # Display current settings if none are being changed
+        if not setting:
+            if not guild_settings:
+                await ctx.send("This server uses the default drop settings.")
+            else:
+                await ctx.send("```\n%s```"
+                               % json.dumps(guild_settings, indent=4))
+            return
+
+        if setting == "reset":
+            guild_settings = {}
+        elif value == "default":
+            guild_settings.pop(setting, None)
+        elif value == None:
+            await ctx.reply("Please give a value for %s." % setting)
+            return
+        else:
+            # Numbers, true/false and lists are stored as such
+            try:
+                guild_settings[setting] = json.loads(value)
+            except json.JSONDecodeError:
+                guild_settings[setting] = value
+
+        # Check the new settings make a valid scheduler before saving
+        try:
+            GuildDrops(guild_settings)
+
+        except ValueError as e:
+            await ctx.reply(str(e))
+            return
+
+        if guild_settings:
+            self.drop_settings[str(ctx.guild.id)] = guild_settings
+        else:
+            self.drop_settings.pop(str(ctx.guild.id), None)
+
+        # Start counting again with the new settings
+        self.guild_drops.pop(ctx.guild.id, None)
+        if await self.save_drop_settings():
+            await ctx.reply("The drop settings for this server were updated.")
+        else:
+            await ctx.reply("There was an error saving the drop settings.")
+
+    # Lists the active drops and most recent redeem attempts in the server
+    @commands.command()
+    @commands.guild_only()
+    @commands.check_any(commands.is_owner(),
+                        commands.has_guild_permissions(administrator=True))
+    async def drop_log(self, ctx, count: int = 10):
+        active = ", ".join(drop.module_id
+                           for drop in self.drops.active(ctx.guild.id))
+        lines = ["Active drops: %s" % (active or "None")]
+
+        claims = [claim for claim in self.drops.audit
+                  if claim[1] == ctx.guild.id][-count:]
+        for claimed_at, guild_id, module_id, uid, won in claims:
+            lines.append("%s: %s %s by %s"
+                         % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                          time.gmtime(claimed_at)),
+                            module_id,
+                            "redeemed" if won else "missed",
+                            self.bot.get_user(uid) or uid))
+
+        await ctx.send("```\n%s```" % "\n".join(lines))
+
     # Displays module (module_id) in context channel
     @commands.command()
     @commands.is_owner()
@@ -457,58 +962,58 @@ class Modules(robot39.Cog):
         # Get module image and embed
         file = await self.get_module_file(module_id)
         embed = embed=discord.Embed(title="Displaying Module", color=0x80ffff)
-        embed = await self.fill_module_embed(module_id, embed)
+        embed = await self.fill_module_embed(module_id, embed, file)
 
         await ctx.send(file=file, embed=embed)
 
     # Like show_module() but only works if module is in player collection
     @commands.command(name='view', aliases=['show'])
     async def view(self, ctx, module_id: str):
-        # Register and return if the user isn't registered already
+        # Return if the user isn't registered as they own nothing
         if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
             return
 
         # Check for valid module_id
         if not await self.is_valid_module_id(module_id):
             return
 
-        # Fetch player_info and create list of collection
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
-        player_collection = player_info[3]
-
         # Check module_id exists in the player's collection
-        if not module_id in player_collection:
+        if not await self.database_action(DatabaseAction.fetch_module_count,
+                                          ctx.author.id, module_id):
             await ctx.reply("You do not own that module, sorry!")
             return
 
         # Get the image and embed for the module
         file = await self.get_module_file(module_id)
         embed = embed=discord.Embed(title="Displaying Module", color=0x80ffff)
-        embed = await self.fill_module_embed(module_id, embed)
+        embed = await self.fill_module_embed(module_id, embed, file)
         await ctx.send(file=file, embed=embed)
 
     # Redeems a currently active drop in the server
     # if the correct module ID is typed
     @commands.command()
     async def redeem(self, ctx, module_id: str):
-        # Register new players
-        if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
+        if not ctx.guild:
+            return
 
-        # Check for active drop and matching module_id
-        if not (ctx.guild.id in self.active_drops
-                and self.active_drops[ctx.guild.id] == module_id):
+        # Claim the active drop matching module_id, which only
+        # the first player to redeem it will get
+        drop = self.drops.claim(ctx.guild.id, module_id, ctx.author.id)
+        if not drop:
+            if self.drops.claimed_by(ctx.guild.id, module_id):
+                await ctx.reply("Too slow, that module was already redeemed!")
             return
 
-        # Remove the drop and add the module to player collection
-        del(self.active_drops[ctx.guild.id])
-        await self.add_module_to_player(ctx.author.id, module_id)
-        await self.add_vp_to_player(ctx.author.id, amount=100)
+        # Add the module to player collection, putting the
+        # drop back if that fails so it isn't lost
+        if not await self.add_module_to_player(ctx.author.id, module_id):
+            self.drops.restore(drop)
+            return
+        await self.add_vp_to_player(ctx.author.id, amount=100,
+                                    reason=VPReason.drop)
 
         # Send reply message
-        module = await self.fetch_module_info(module_id)
-        module_name = module["ENG Name"]
+        module_name = self.catalog[module_id].eng_name
         await ctx.reply("Redeemed %s! You gained 100 VP." % module_name)
         self.log("%s redeemed by %s" % (module_id, ctx.author))
 
@@ -516,23 +1021,13 @@ class Modules(robot39.Cog):
     @commands.command()
     async def give_module(self, ctx, module_id: str,
                           receiving_user: discord.Member):
-        # Register and return if the author is a new player
+        # Return if the author isn't registered as they own nothing
         if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
             return
 
         if not await self.is_valid_module_id(module_id):
             return
 
-        # Fetch player info and module collection
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
-        player_collection = player_info[3]
-
-        # Check that collection isn't empty and module_id is owned
-        if (not player_collection) or (not module_id in player_collection):
-            await ctx.reply("You do not own that module, sorry!")
-            return
-
         # You can't give something to yourself
         if receiving_user == ctx.author:
             await ctx.reply(
@@ -546,17 +1041,16 @@ class Modules(robot39.Cog):
                 "The bot appreciates the gesture, but politely declines.")
             return
 
-        # Register receiving_user if they're a new player
-        if not receiving_user.id in self.player_ids:
-            await self.add_player_by_uid(receiving_user.id)
-
-        # Swap the module between players
-        await self.remove_module_from_player(ctx.author.id, module_id)
-        await self.add_module_to_player(receiving_user.id, module_id)
+        # Swap the module between players, which registers receiving_user
+        # if needed and only happens if the author owns the module
+        trade = Trade()
+        trade.move_module(ctx.author.id, receiving_user.id, module_id)
+        if not await self.run_trade(trade):
+            await ctx.reply("You do not own that module, sorry!")
+            return
 
         # Send reply
-        module = await self.fetch_module_info(module_id)
-        module_name = module["ENG Name"]
+        module_name = self.catalog[module_id].eng_name
         await ctx.reply("You gave %s -- %s to %s."
                         % (module_id, module_name, receiving_user.mention))
         self.log("%s given to %s by %s"
@@ -565,24 +1059,14 @@ class Modules(robot39.Cog):
     # Gives VP (amount) to mentioned player if author has enough
     @commands.command()
     async def give_vp(self, ctx, amount: int, receiving_user: discord.Member):
-        # Register and return if author isn't registered already
+        # Return if the author isn't registered as they have no VP
         if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
             return
 
         # Do nothing if invalid VP amount specified
         if amount < 1:
             return
 
-        # Fetch author's player info and current VP amount
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
-        player_points = player_info[2]
-
-        # Check author has enough VP to give
-        if amount > player_points:
-            await ctx.reply("You don't have enough VP to do that, sorry!")
-            return
-
         # You can't give VP to yourself
         if receiving_user == ctx.author:
             await ctx.reply("Congratulations, you paid yourself.")
@@ -594,83 +1078,196 @@ class Modules(robot39.Cog):
                 "The bot appreciates the gesture, but politely declines.")
             return
 
-        # Register the receiving user if they're a new player
-        if not receiving_user.id in self.player_ids:
-            await self.add_player_by_uid(receiving_user.id)
+        # Swap the VP between players, which only happens if the author
+        # has enough VP, and reply
+        try:
+            given = await self.vp_ledger.transfer(
+                ctx.author.id, receiving_user.id, amount, VPReason.gift)
+
+        except psycopg2.Error as e:
+            self.log("Error giving %s VP to %s from %s:\n%s"
+                     % (amount, receiving_user, ctx.author, e))
+            await ctx.reply("There was an error giving VP, "
+                            "please try again later.")
+            return
+
+        if not given:
+            await ctx.reply("You don't have enough VP to do that, sorry!")
+            return
+        self.player_ids.add(receiving_user.id)
 
-        # Swap the VP between players and reply
-        await self.remove_vp_from_player(ctx.author.id, amount)
-        await self.add_vp_to_player(receiving_user.id, amount)
         await ctx.reply("You gave %s VP to %s."
                         % (amount, receiving_user.mention))
         self.log("%s VP given to %s by %s"
                  % (amount, receiving_user, ctx.author))
 
-    # Gives a random module and 500 VP to the author, usable once per day
+    # Offers to swap modules and/or VP with another player, who accepts
+    # by reacting, e.g. 39!trade @user mik-1 500vp for rin-2 rin-3
     @commands.command()
-    async def daily(self, ctx):
-        # Register author if they're a new player
+    async def trade(self, ctx, receiving_user: discord.Member, *items):
+        # Return if the author isn't registered as they own nothing
         if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
+            return
+
+        # You can't trade with yourself or a bot account
+        if receiving_user == ctx.author or receiving_user.bot:
+            await ctx.reply("You can't trade with that user, sorry!")
+            return
 
-        # Fetch author's player info and today's date for checking daily status
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
+        # Split the items into what's offered and what's asked for
+        if not "for" in items:
+            await ctx.reply(
+                "Usage: `39!trade @user <modules/VP> for <modules/VP>`")
+            return
+        split = items.index("for")
+        offered = await self.parse_trade_items(items[:split])
+        requested = await self.parse_trade_items(items[split+1:])
+
+        if not offered or not requested:
+            await ctx.reply("That trade contains an invalid module ID!")
+            return
+
+        # Build the trade, which cancels out anything given both ways
+        trade = Trade()
+        offered_vp, offered_modules = offered
+        requested_vp, requested_modules = requested
+        trade.move_vp(ctx.author.id, receiving_user.id, offered_vp)
+        trade.move_vp(receiving_user.id, ctx.author.id, requested_vp)
+        for module_id in offered_modules:
+            trade.move_module(ctx.author.id, receiving_user.id, module_id)
+        for module_id in requested_modules:
+            trade.move_module(receiving_user.id, ctx.author.id, module_id)
+
+        if not trade:
+            return
+
+        # Create and send trade embed for the receiving user to react to
+        embed = discord.Embed(title="Trade Offer", color=0x80ffff)
+        embed.add_field(name="%s gives:" % ctx.author.display_name,
+                        value=await self.describe_trade_items(
+                            offered_vp, offered_modules),
+                        inline=True)
+        embed.add_field(name="%s gives:" % receiving_user.display_name,
+                        value=await self.describe_trade_items(
+                            requested_vp, requested_modules),
+                        inline=True)
+        embed.set_footer(text="React with ✅ to accept or ❌ to decline")
+
+        trade_message = await ctx.send(
+            "%s, you've been offered a trade by %s!"
+            % (receiving_user.mention, ctx.author.mention), embed=embed)
+        await trade_message.add_reaction("✅")
+        await trade_message.add_reaction("❌")
+
+        # Only the receiving user's reactions to this message count
+        def check(reaction, user):
+            return user == receiving_user\
+                and reaction.message.id == trade_message.id\
+                and str(reaction.emoji) in ("✅", "❌")
+
+        try:
+            reaction, user = await self.bot.wait_for(
+                'reaction_add', timeout=self.trade_timeout, check=check)
+
+        except asyncio.TimeoutError:
+            await trade_message.reply("This trade offer has expired.")
+            return
+
+        if str(reaction.emoji) == "❌":
+            await trade_message.reply("The trade was declined.")
+            return
+
+        # Swap everything at once, or nothing if either player
+        # no longer has what they offered
+        if not await self.run_trade(trade):
+            await trade_message.reply(
+                "The trade failed as one of you no longer has"
+                " everything being traded.")
+            return
+
+        await trade_message.reply("Trade complete!")
+        self.log("Trade between %s and %s completed"
+                 % (ctx.author, receiving_user))
+
+    # Gives a random module and 500 VP to the author, usable once per day
+    @commands.command()
+    async def daily(self, ctx):
+        # Mark the daily as redeemed before giving anything out, which
+        # fails if it already was today; new players are registered by
+        # redeeming their first daily
         today = str(date.today())
+        redeemed = await self.mark_daily_as_redeemed(ctx.author.id, today)
+
+        if redeemed == None:
+            await ctx.reply("There was an error redeeming your daily, "
+                            "please try again later.")
+            return
 
-        # Check if daily was already redeemed today
-        if today == player_info[4]:
+        if not redeemed:
             await ctx.reply("You've already redeemed your daily for today!")
             return
 
-    	# Add random module & 500 VP to author
-        module_id = await self.roll_module_id()
-        await self.add_module_to_player(ctx.author.id, module_id)
-        await self.add_vp_to_player(ctx.author.id, amount=500)
+    	# Add random module & 500 VP to author, only giving the VP if the
+        # module was added and otherwise letting the daily be redeemed again
+        module_id = self.roll_module_id()
+        if not await self.add_module_to_player(ctx.author.id, module_id):
+            await self.database_action(DatabaseAction.unmark_daily,
+                                       ctx.author.id, today)
+            await ctx.reply("There was an error redeeming your daily, "
+                            "please try again later.")
+            return
+
+        await self.add_vp_to_player(ctx.author.id, amount=500,
+                                    reason=VPReason.daily)
 
         # Get image and embed for the new module
         file = await self.get_module_file(module_id)
         embed = embed=discord.Embed(title="Daily Redeemed", color=0x80ffff)
-        embed = await self.fill_module_embed(module_id, embed)
+        embed = await self.fill_module_embed(module_id, embed, file)
         embed.add_field(name="** **", value="You gained 500 VP.")
 
-        # Mark the daily as redeemed and reply to author
-        await self.mark_daily_as_redeemed(ctx.author.id, today)
+        # Reply to author
         await ctx.send(file=file, embed=embed)
         self.log("Daily redeemed by %s" % ctx.author)
 
     # Player can buy a random module for 1000 VP or specify a set for 1500 VP
     @commands.command(name='purchase', aliases=['buy'])
     async def purchase(self, ctx, module_set: str = None):
-        # Register author if they're a new player
-        if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
-
-        # Fetch player info and current VP
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
-        player_points = player_info[2]
-
         # Check the module set is valid if specified
-        if module_set and not module_set in self.modules_dict:
+        if module_set and not module_set in self.catalog.sets:
             await ctx.reply("That is not a valid module set!")
             return
 
-        # Check the player can afford the option chosen
+        # Remove the VP cost, if the player can afford the option chosen
         vp_cost = 1500 if module_set else 1000
-        if player_points < vp_cost:
+        paid = await self.remove_vp_from_player(ctx.author.id, amount=vp_cost,
+                                                reason=VPReason.purchase)
+
+        if paid == None:
+            await ctx.reply("There was an error making your purchase, "
+                            "please try again later.")
+            return
+
+        if not paid:
             await ctx.reply(
                 "You must have at least %s VP to perform that action."
                 % vp_cost)
             return
 
-    	# Add random module to author's collection and remove VP cost
-        module_id = await self.roll_module_id(module_set=module_set)
-        await self.add_module_to_player(ctx.author.id, module_id)
-        await self.remove_vp_from_player(ctx.author.id, amount=vp_cost)
+    	# Add random module to author's collection, giving the VP
+        # back if it couldn't be added
+        module_id = self.roll_module_id(module_set=module_set)
+        if not await self.add_module_to_player(ctx.author.id, module_id):
+            await self.add_vp_to_player(ctx.author.id, amount=vp_cost,
+                                        reason=VPReason.purchase)
+            await ctx.reply("There was an error making your purchase, "
+                            "please try again later.")
+            return
 
         # Get module image & embed and send reply
         file = await self.get_module_file(module_id)
         embed = embed=discord.Embed(title="Rolled Module", color=0x80ffff)
-        embed = await self.fill_module_embed(module_id, embed)
+        embed = await self.fill_module_embed(module_id, embed, file)
         embed.add_field(name="** **", value="You spent %s VP." % vp_cost)
         await ctx.send(file=file, embed=embed)
         self.log("%s rolled a module" % ctx.author)
@@ -678,24 +1275,27 @@ class Modules(robot39.Cog):
     # Displays player collection stats including VP and completion percentage
     @commands.command()
     async def modules(self, ctx):
-        # Register author if they're a new player
-        if not ctx.author.id in self.player_ids:
-            await self.add_player_by_uid(ctx.author.id)
-
-        # Fetch player info from database
-        player_info = await self.fetch_player_info_by_uid(ctx.author.id)
+        # Fetch player VP and number of different modules player has in
+        # each set, skipping the database for players who aren't registered
+        player_points = 0
+        set_counts = None
+        if ctx.author.id in self.player_ids:
+            try:
+                player_points = await self.vp_ledger.balance(ctx.author.id)
 
-        # Convert player collection to set to remove duplicates
-        collection_set = {}
-        if player_info[3]:
-            collection_set = set(player_info[3])
+            except psycopg2.Error as e:
+                self.log("Error fetching VP for %s:\n%s" % (ctx.author, e))
+                await ctx.reply("There was an error fetching your stats, "
+                                "please try again later.")
+                return
 
-        # Count number of modules player has in each set
-        collection_counts = {}
-        for module_set in self.csv_list:
-            collection_counts[module_set] =\
-                len([module_id for module_id in collection_set
-                    if module_id.startswith(module_set)])
+            set_counts = await self.database_action(
+                             DatabaseAction.fetch_set_counts, ctx.author.id)
+        collection_counts = {module_set: 0 for module_set in self.csv_list}
+        for module_set, count in set_counts or []:
+            if module_set in collection_counts:
+                collection_counts[module_set] = count
+        owned_modules = sum(collection_counts.values())
 
         # Create embed containing player stats
         embed = embed=discord.Embed(title="Module Collection Stats",
@@ -703,7 +1303,7 @@ class Modules(robot39.Cog):
         embed.set_thumbnail(url=ctx.message.author.avatar_url)
         embed.set_footer(text="Use command 39!collection to view a full list")
         embed.add_field(name="User:", value=ctx.author.mention, inline=True)
-        embed.add_field(name="VP:", value=player_info[2], inline=True)
+        embed.add_field(name="VP:", value=player_points, inline=True)
 
         embed.add_field(name="Collection:", value="** **", inline=False)
 
@@ -713,22 +1313,21 @@ class Modules(robot39.Cog):
                 name="%s:" % self.set_names[module_set],
                 value="%s/%s" 
                     % (collection_counts[module_set],
-                       len(self.modules_dict[module_set])),
+                       len(self.catalog.sets.get(module_set, ()))),
                 inline=True)
 
         # Count total number of modules that can be collected
         # and calculate completion percentage
-        total_modules =\
-            sum(len(module_set) for module_set in self.modules_dict.values())
+        total_modules = len(self.catalog)
         collection_percentage =\
-            0 if len(collection_set) == 0\
-                else round((len(collection_set) / total_modules) * 100, 2)
+            0 if owned_modules == 0\
+                else round((owned_modules / total_modules) * 100, 2)
 
         # Add overall completion and current VP to the embed and send it
         embed.add_field(
             name="Overall:",
             value="**%s/%s (%s%%)**"
-                % (len(collection_set), total_modules, collection_percentage),
+                % (owned_modules, total_modules, collection_percentage),
             inline=False)
         await ctx.send(embed=embed)
 
@@ -743,51 +1342,119 @@ class Modules(robot39.Cog):
         await self.display_player_collection(ctx=ctx, page_number=page_number,
                                              duplicates_only=True)
 
+    ### !--- TASKS ---! ###
+    # Writes VP changes waiting in the ledger to the database
+    @tasks.loop(seconds=10.0)
+    async def flush_vp_ledger(self):
+        await self.vp_ledger.flush()
+
+    @flush_vp_ledger.before_loop
+    async def before_flush_vp_ledger(self):
+        await self.bot.wait_until_ready()
+
+    # Posts a dropped module to a drop channel
+    async def post_drop(self, channel_id: int, module_id: str):
+        # Invoke typing until message containing drop is sent
+        drop_channel = self.bot.get_channel(channel_id)
+        async with drop_channel.typing():
+            # Get module image and create embed
+            file = await self.get_module_file(module_id)
+            embed = embed=discord.Embed(title="Module Drop", color=0x80ffff)
+            embed = await self.fill_module_embed(module_id, embed, file)
+            embed.add_field(
+                name="** **",
+                value="`39!redeem <module id>` to redeem.",
+                inline=False)
+
+            # Pause to let players see the 'typing' indicator
+            # and drop the module
+            await asyncio.sleep(1)
+            await drop_channel.send(file=file, embed=embed)
+            self.log("Dropped %s in %s" % (module_id, drop_channel))
+
+    # Posts drops queued by on_message one at a time, so that image work
+    # and sending never hold up the message listener
+    async def post_drops(self):
+        await self.bot.wait_until_ready()
+
+        while True:
+            channel_id, module_id = await self.drop_queue.get()
+
+            # Keep the worker running whatever goes wrong with one drop
+            try:
+                await self.post_drop(channel_id, module_id)
+
+            except Exception as e:
+                self.log("Error posting drop %s:\n%s" % (module_id, e))
+
     ### !--- EVENTS ---! ###
-    #handles random module drops
+    # Turns the page of a collection listing when its owner reacts,
+    # serving pages from the cached listing where possible
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        paging = self.collection_paging.get(payload.message_id)
+        if (not paging
+                or payload.user_id != paging['uid']
+                or not str(payload.emoji) in ("◀️", "▶️")):
+            return
+
+        if paging['expires'] <= time.monotonic():
+            del(self.collection_paging[payload.message_id])
+            return
+
+        pages = await self.fetch_collection_pages(paging['uid'],
+                                                  paging['duplicates_only'])
+        if not pages:
+            return
+
+        # Move one page either way, wrapping around at each end
+        step = -1 if str(payload.emoji) == "◀️" else 1
+        paging['page'] = (paging['page'] - 1 + step) % len(pages) + 1
+
+        channel = self.bot.get_channel(payload.channel_id)
+        message = channel.get_partial_message(payload.message_id)
+        embed = self.create_collection_embed(pages, paging['page'],
+                                             paging['duplicates_only'],
+                                             paging['avatar_url'])
+        await message.edit(embed=embed)
+
+        # Remove the reaction so the same arrow can be used again
+        try:
+            await message.remove_reaction(payload.emoji,
+                                          discord.Object(payload.user_id))
+
+        except discord.HTTPException:
+            pass
+
+    # Counts messages towards random module drops. This runs for every
+    # message the bot sees, so messages that don't cause a drop return
+    # without awaiting anything; drops are posted by post_drops()
     @commands.Cog.listener()
     async def on_message(self, message):
-        # Don't track DMs, bot messages, or commands
-        if (not message.guild
-                or message.author.bot
-                or message.content.startswith("39!")):
-            return
-
-        # Increment guild message counter
-        self.message_count[message.guild.id] =\
-            1 if not message.guild.id in self.message_count\
-                else self.message_count[message.guild.id] + 1
-
-        # Check if guild message counter has reached the minimum needed
-        if self.message_count[message.guild.id] < self.min_msgs_before_drop:
-            return
-
-        # Roll random number up to 100 and check if it's high enough to drop
-        roll = random.randint(0, 100)
-        if roll <= (self.message_count[message.guild.id]
-                    - (self.min_msgs_before_drop - self.initial_drop_percent)):
-            # Invoke typing until message containing drop is sent
-            drop_channel = self.bot.get_channel(self.drop_channel_id)
-            async with drop_channel.typing():
-                # Reset message count and add random module to active drops
-                self.message_count[message.guild.id] = 0
-                module_id = await self.roll_module_id()
-                self.active_drops[message.guild.id] = module_id
-
-                # Get module image and create embed
-                file = await self.get_module_file(module_id)
-                embed = embed=discord.Embed(title="Module Drop", color=0x80ffff)
-                embed = await self.fill_module_embed(module_id, embed)
-                embed.add_field(
-                    name="** **",
-                    value="`39!redeem <module id>` to redeem.",
-                    inline=False)
-
-                # Pause to let players see the 'typing' indicator
-                # and drop the module
-                await asyncio.sleep(1)
-                await drop_channel.send(file=file, embed=embed)
-                self.log("Dropped %s in %s" % (module_id, drop_channel))
+        # Don't track DMs, other servers or bot messages
+        guild = message.guild
+        if (guild == None
+                or (self.drop_guild_ids != None
+                    and not guild.id in self.drop_guild_ids)
+                or message.author.bot):
+            return
+
+        # Don't track commands
+        if message.content.startswith("39!"):
+            return
+
+        # Count the message with the server's drop scheduler
+        guild_drops = self.guild_drops.get(guild.id)\
+                      or self.create_guild_drops(guild.id)
+        if not guild_drops.message(message.channel.id, time.monotonic()):
+            return
+
+        # Add random module to active drops and queue
+        # it to be posted in the server's drop channel
+        module_id = self.roll_module_id()
+        self.drops.add(guild.id, module_id)
+        self.drop_queue.put_nowait(
+            (guild_drops.channel_id or self.drop_channel_id, module_id))
 
 
 def setup(bot):
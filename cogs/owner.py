@@ -121,6 +121,40 @@ class Owner(robot39.Cog):
         message = ' '.join(msg)
         await self.send(ctx, channel, message, msg_id = msg_id, reply = True)
 
+    # Sends a table of the query latencies recorded by the database cog,
+    # slowest total time first; 'reset' clears them after sending
+    @commands.command(name="query_stats", aliases=["db_stats"])
+    async def query_stats(self, ctx, option: str = None):
+        if not self.bot.database:
+            await self.say(ctx, "Database cog is not loaded.")
+            return
+
+        summary = self.bot.database.query_stats.summary()
+        if not summary:
+            await self.say(ctx, "No queries have been recorded yet.")
+            return
+
+        # One line per statement with latencies in milliseconds
+        lines = ["%-40s %6s %4s %7s %7s %7s %7s"
+                 % ("Statement", "Count", "Err", "Rows", "p50", "p95", "p99")]
+        for key, count, errors, rows, p50, p95, p99, total in summary:
+            lines.append("%-40s %6s %4s %7s %7.1f %7.1f %7.1f"
+                         % (key[:40], count, errors, rows,
+                            p50 * 1000, p95 * 1000, p99 * 1000))
+
+        # Split the table into code blocks under the message length limit
+        block = ""
+        for line in lines:
+            if len(block) + len(line) > 1900:
+                await ctx.send("```\n%s```" % block)
+                block = ""
+            block += line + "\n"
+        await ctx.send("```\n%s```" % block)
+
+        if option == "reset":
+            self.bot.database.query_stats.reset()
+            await self.say(ctx, "Query stats have been reset.")
+
     # Adds a reaction to a message given by channel ID/mention,
     # message ID and emoji as string
     @commands.command(name="add_reaction", aliases=["react"])
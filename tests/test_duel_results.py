@@ -0,0 +1,121 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("discord")
+psycopg2 = pytest.importorskip("psycopg2")
+
+from cogs.duel import Duel
+
+
+# Stands in for the players table, applying RESULT_SQL the way Postgres
+# would: only if both ratings still match the ones the change was worked out
+# from, returning the updated rows or the current ones with a flag
+class FakeConnection:
+
+    def __init__(self, players):
+        self.players = players
+        self.duels = []
+        self.error = None
+
+    async def fetchall(self, SQL, data=None, label=None):
+        assert label == "Duel.record_result"
+        if self.error != None:
+            raise self.error
+        win = self.players[data['win_id']]
+        lose = self.players[data['lose_id']]
+
+        if win[2] != data['win_elo'] or lose[2] != data['lose_elo']:
+            return [win + (False,), lose + (False,)]
+
+        change = data['change']
+        self.players[win[1]] = (win[0], win[1], win[2] + change, win[3] + 1,
+                                win[4], win[5] + 1, win[6])
+        self.players[lose[1]] = (lose[0], lose[1], lose[2] - change, lose[3],
+                                 lose[4] + 1, 0, lose[6])
+        self.duels.append((data['win_id'], data['lose_id'], change,
+                           data['max_points'], data['session_id']))
+
+        return [self.players[win[1]] + (True,),
+                self.players[lose[1]] + (True,)]
+
+
+class FakeDatabase:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @asynccontextmanager
+    async def acquire(self, timeout=None):
+        yield self.connection
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, content):
+        self.sent.append(content)
+
+
+def create_duel(players):
+    connection = FakeConnection(dict(players))
+    duel = Duel.__new__(Duel)
+    duel.bot = SimpleNamespace(database=FakeDatabase(connection))
+    duel.k_value = 50
+    duel.multipliers = {2: 1, 3: 1.5, 5: 2.5}
+    duel.players = dict(players)
+    duel.players_loaded = True
+    duel.players_lock = asyncio.Lock()
+    duel.rankings_dirty = False
+    return duel, connection
+
+
+def player(uid, points):
+    return (uid, uid, points, 0, 0, 0, None)
+
+
+def test_finished_duel_is_recorded():
+    duel, connection = create_duel({1: player(1, 1200), 2: player(2, 1200)})
+    winner = SimpleNamespace(id=1, mention="<@1>")
+    loser = SimpleNamespace(id=2, mention="<@2>")
+    channel = FakeChannel()
+
+    asyncio.run(duel.process_duel_results(channel, winner, loser, 3, 7))
+
+    assert connection.duels == [(1, 2, 38, 3, 7)]
+    assert duel.players[1][2] == 1238
+    assert duel.players[2][2] == 1162
+    assert channel.sent[-1].endswith("<@2>: 1200 -> 1162")
+
+
+def test_stale_rating_is_recalculated():
+    duel, connection = create_duel({1: player(1, 1200), 2: player(2, 1200)})
+    connection.players[2] = player(2, 1400)
+    winner = SimpleNamespace(id=1, mention="<@1>")
+    loser = SimpleNamespace(id=2, mention="<@2>")
+
+    asyncio.run(duel.process_duel_results(FakeChannel(), winner, loser, 2))
+
+    assert connection.duels == [(1, 2, 38, 2, None)]
+    assert duel.players[2][2] == 1362
+
+
+def test_failed_record_is_retried():
+    duel, connection = create_duel({1: player(1, 1200), 2: player(2, 1200)})
+    connection.error = psycopg2.OperationalError("connection lost")
+    winner = SimpleNamespace(id=1, mention="<@1>")
+    loser = SimpleNamespace(id=2, mention="<@2>")
+    channel = FakeChannel()
+
+    assert not asyncio.run(
+        duel.process_duel_results(channel, winner, loser, 2, 7))
+    assert connection.duels == []
+
+    connection.error = None
+    assert asyncio.run(
+        duel.process_duel_results(channel, winner, loser, 2, 7))
+    assert connection.duels == [(1, 2, 25, 2, 7)]